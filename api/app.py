@@ -1,10 +1,15 @@
-from flask import Flask, request, jsonify
-import pandas as pd
-from src.inference import predict_clv, predict_segment # Simplified, needs path adjustment
+from flask import Flask, request, jsonify, Response, stream_with_context, g
+from src.inference import MODELS, SEGMENTATION_FEATURES # Simplified, needs path adjustment
 from src.utils_io import load_config
-from src.labeler import assign_segment_labels
+from src.feature_store import FeatureStore
+from src.serving import MicroBatcher, score_clv, score_segment, stream_bulk_predictions
+from src.prediction_cache import PredictionCache
+from src.instrumentation import REGISTRY, REQUEST_SECONDS, profiled
+from functools import partial
 import os
 import sys
+import threading
+import time
 
 # Add src to path to allow imports
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
@@ -12,9 +17,60 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
 app = Flask(__name__)
 CONFIG = load_config()
 
-# A placeholder for a feature store lookup
-ALL_FEATURES_DF = pd.read_csv(CONFIG['data']['processed_path'])
-ALL_FEATURES_DF.set_index('CustomerID', inplace=True)
+# Memory-mapped feature store shared by all worker processes; newly published
+# snapshots are swapped in on the next request once they carry the model inputs.
+FEATURE_STORE = FeatureStore(required_columns=SEGMENTATION_FEATURES)
+
+# Models are loaded on the first prediction (from a local snapshot when one exists) and
+# swapped in the background when a new version is promoted to Production
+MODELS.start_polling()
+
+# Predictions only change with a new snapshot or model version, so they are cached per
+# (customer, snapshot, model) and shared with other workers through the disk tier
+if CONFIG['prediction_cache']['enabled']:
+    CLV_CACHE = PredictionCache('clv')
+    SEGMENT_CACHE = PredictionCache('segment', dtype='int64', fill_value=-1)
+
+    def clv_scorer(ids):
+        models = MODELS.models()
+        return CLV_CACHE.score(partial(score_clv, models=models), FEATURE_STORE.snapshot(), ids, models.clv_version)
+
+    def segment_scorer(ids):
+        # The models are returned too, so the response is labeled by the set that clustered it
+        models = MODELS.models()
+        segments, found = SEGMENT_CACHE.score(partial(score_segment, models=models), FEATURE_STORE.snapshot(), ids, models.segmentation_version)
+        return segments, found, models
+else:
+    CLV_CACHE = SEGMENT_CACHE = None
+    clv_scorer = lambda ids: score_clv(FEATURE_STORE.snapshot(), ids)
+
+    def segment_scorer(ids):
+        models = MODELS.models()
+        return (*score_segment(FEATURE_STORE.snapshot(), ids, models), models)
+
+# Concurrent requests are coalesced and scored on NumPy arrays in one call per micro-batch
+if CONFIG['serving']['micro_batching']:
+    CLV_BATCHER = MicroBatcher(clv_scorer, name="clv-batcher")
+    SEGMENT_BATCHER = MicroBatcher(segment_scorer, name="segment-batcher")
+else:
+    CLV_BATCHER = SEGMENT_BATCHER = None
+
+@app.before_request
+def start_request_timer():
+    g.start = time.perf_counter()
+    # Opt-in profile of this request (and the micro-batcher threads that score it)
+    if CONFIG['instrumentation']['request_profiling'] and request.args.get('profile') == '1':
+        batcher_threads = [b._thread.ident for b in (CLV_BATCHER, SEGMENT_BATCHER) if b is not None]
+        g.profile = profiled(f"request-{request.endpoint}", [threading.get_ident()] + batcher_threads)
+        g.profile.__enter__()
+
+@app.after_request
+def observe_request(response):
+    if CONFIG['instrumentation']['enabled'] and request.endpoint != 'handle_metrics':
+        REQUEST_SECONDS.observe(time.perf_counter() - g.start, request.endpoint or "unknown", str(response.status_code))
+    if g.get('profile') is not None:
+        g.pop('profile').__exit__(None, None, None)
+    return response
 
 @app.route('/predict-clv', methods=['POST'])
 def handle_clv():
@@ -25,9 +81,13 @@ def handle_clv():
         return jsonify({"error": "customer_ids not provided"}), 400
         
     try:
-        customer_features = ALL_FEATURES_DF.loc[customer_ids]
-        clv_preds = predict_clv(customer_features)
-        response = dict(zip(customer_ids, clv_preds))
+        if CLV_BATCHER is not None:
+            clv_preds, found = CLV_BATCHER.submit(customer_ids).result()
+        else:
+            clv_preds, found = clv_scorer(customer_ids)
+        if not found.all():
+            raise KeyError(customer_ids)
+        response = dict(zip(customer_ids, clv_preds.tolist()))
         return jsonify(response)
     except KeyError:
         return jsonify({"error": "One or more customer_ids not found"}), 404
@@ -43,19 +103,58 @@ def handle_segment():
         return jsonify({"error": "customer_ids not provided"}), 400
 
     try:
-        customer_features = ALL_FEATURES_DF.loc[customer_ids].copy()
-        segments = predict_segment(customer_features)
-        customer_features['segment'] = segments
-        
-        # Assign business labels
-        labeled_df, label_map = assign_segment_labels(customer_features.reset_index())
-        
-        response = labeled_df[['CustomerID', 'segment', 'segment_label']].to_dict(orient='records')
-        return jsonify({"predictions": response, "label_mapping": label_map})
+        if SEGMENT_BATCHER is not None:
+            segments, found, models = SEGMENT_BATCHER.submit(customer_ids).result()
+        else:
+            segments, found, models = segment_scorer(customer_ids)
+        if not found.all():
+            raise KeyError(customer_ids)
+        labels = models.label_segments(segments)
+        response = [
+            {'CustomerID': customer_id, 'segment': segment, 'segment_label': label}
+            for customer_id, segment, label in zip(customer_ids, segments.tolist(), labels.tolist())
+        ]
+        return jsonify({"predictions": response, "label_mapping": models.segment_labels})
     except KeyError:
         return jsonify({"error": "One or more customer_ids not found"}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/predict-bulk', methods=['POST'])
+def handle_bulk():
+    """Scores CLV and segment for many customers, streamed back as NDJSON."""
+    data = request.get_json()
+    customer_ids = data.get('customer_ids', [])
+
+    if not customer_ids:
+        return jsonify({"error": "customer_ids not provided"}), 400
+
+    try:
+        snapshot = FEATURE_STORE.snapshot()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    return Response(
+        stream_with_context(stream_bulk_predictions(snapshot, customer_ids)),
+        mimetype='application/x-ndjson'
+    )
+
+@app.route('/cache-stats', methods=['GET'])
+def handle_cache_stats():
+    """Hit/miss counters of this worker's prediction caches."""
+    if CLV_CACHE is None:
+        return jsonify({"error": "prediction cache disabled"}), 404
+    return jsonify({"clv": CLV_CACHE.stats(), "segment": SEGMENT_CACHE.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def handle_metrics():
+    """Per-stage and per-endpoint latency histograms of this worker, in the Prometheus text format."""
+    return Response(REGISTRY.expose(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/model-info', methods=['GET'])
+def handle_model_info():
+    """Model versions served by this worker, with their import/download/load timings."""
+    return jsonify(MODELS.info())
+
 if __name__ == "__main__":
     app.run(debug=True, port=5001)
\ No newline at end of file
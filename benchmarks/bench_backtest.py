@@ -0,0 +1,68 @@
+"""Benchmarks the one-pass multi-snapshot feature kernel against one compute_customer_features call per cutoff.
+
+Usage: python -m benchmarks.bench_backtest [--sizes 1000000 10000000] [--snapshots 12] [--step-days 30]
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from src.incremental_loader import generate_transaction_batches
+from src.feature_kernel import compute_customer_features, compute_snapshot_features, FEATURE_COLUMNS
+
+def per_cutoff_features(df, snapshot_dates, windows_days):
+    """The per-cutoff path: filter the history, rebuild the features and group the forward spend, once per snapshot."""
+    frames = []
+    for snapshot in snapshot_dates:
+        features = compute_customer_features(df[df['TransactionDate'] <= snapshot], snapshot)
+        features['CustomerID'] = features['CustomerID'].astype(str)
+        for w in windows_days:
+            in_window = (df['TransactionDate'] > snapshot) & (df['TransactionDate'] <= snapshot + pd.Timedelta(days=w))
+            target = df[in_window].groupby(df['CustomerID'].astype(str), observed=True)['Amount'].sum()
+            features[f'CLV_{w}_days'] = features['CustomerID'].map(target).fillna(0).to_numpy()
+        features.insert(1, 'snapshot_date', snapshot)
+        frames.append(features)
+    return pd.concat(frames, ignore_index=True)
+
+def check_equivalence(reference, kernel, windows_days):
+    """Asserts the one-pass output matches the per-cutoff one row for row, within float32 precision."""
+    assert len(reference) == len(kernel), "Row counts differ"
+    reference = reference.sort_values(['snapshot_date', 'CustomerID'])
+    kernel = kernel.assign(CustomerID=kernel['CustomerID'].astype(str)).sort_values(['snapshot_date', 'CustomerID'])
+    for col in ['CustomerID', 'snapshot_date']:
+        assert (reference[col].to_numpy() == kernel[col].to_numpy()).all(), f"{col} differs"
+    for col in FEATURE_COLUMNS + [f'CLV_{w}_days' for w in windows_days]:
+        np.testing.assert_allclose(
+            kernel[col].to_numpy(dtype=np.float64), reference[col].to_numpy(dtype=np.float64),
+            rtol=1e-5, atol=1e-3, equal_nan=True, err_msg=col,
+        )
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def run(sizes, customers_per_row, num_snapshots, step_days, windows_days):
+    print(f"{'rows':>12} {'snapshots':>9} {'impl':>10} {'seconds':>9}")
+    for rows in sizes:
+        num_customers = max(1, int(rows * customers_per_row))
+        df = pd.concat(generate_transaction_batches(num_customers, rows, 1_000_000), ignore_index=True)
+        df = df.drop(columns=['Quantity'])
+        latest_cutoff = df['TransactionDate'].max() - pd.Timedelta(days=max(windows_days))
+        snapshot_dates = [latest_cutoff - pd.Timedelta(days=i * step_days) for i in reversed(range(num_snapshots))]
+
+        kernel, seconds = _timed(compute_snapshot_features, df, snapshot_dates, windows_days)
+        print(f"{rows:>12} {num_snapshots:>9} {'one-pass':>10} {seconds:>9.2f}")
+        reference, seconds = _timed(per_cutoff_features, df, snapshot_dates, windows_days)
+        print(f"{rows:>12} {num_snapshots:>9} {'per-cutoff':>10} {seconds:>9.2f}")
+        check_equivalence(reference, kernel, windows_days)
+        print(f"{rows:>12} outputs equivalent for {len(kernel)} (customer, snapshot) rows")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--customers-per-row', type=float, default=0.01)
+    parser.add_argument('--snapshots', type=int, default=12)
+    parser.add_argument('--step-days', type=int, default=30)
+    parser.add_argument('--windows-days', type=int, nargs='+', default=[30, 90])
+    args = parser.parse_args()
+    run(args.sizes, args.customers_per_row, args.snapshots, args.step_days, args.windows_days)
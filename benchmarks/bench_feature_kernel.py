@@ -0,0 +1,73 @@
+"""Benchmarks the single-pass feature kernel against the original groupby functions.
+
+Usage: python -m benchmarks.bench_feature_kernel [--sizes 1000000 10000000 50000000]
+"""
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from src.incremental_loader import generate_transaction_batches
+from src.feature_engineering import calculate_rfm, add_behavioral_features
+from src.feature_kernel import compute_customer_features, FEATURE_COLUMNS
+
+def reference_features(df, snapshot_date):
+    """The pre-kernel path: calculate_rfm + add_behavioral_features + merge.
+
+    It is given string CustomerIDs, as produced by the CSV reader it was written for.
+    """
+    rfm = calculate_rfm(df, snapshot_date)
+    behavioral = add_behavioral_features(df, snapshot_date)
+    return pd.merge(rfm, behavioral, on='CustomerID', how='left')
+
+def check_equivalence(reference, kernel):
+    """Asserts the kernel output matches the reference within float32 precision."""
+    assert len(reference) == len(kernel), "Customer counts differ"
+    # groupby on a categorical follows category order, the kernel follows CustomerID order
+    reference = reference.assign(CustomerID=reference['CustomerID'].astype(str)).sort_values('CustomerID')
+    kernel = kernel.assign(CustomerID=kernel['CustomerID'].astype(str)).sort_values('CustomerID')
+    assert (reference['CustomerID'].to_numpy() == kernel['CustomerID'].to_numpy()).all(), "CustomerIDs differ"
+    for col in FEATURE_COLUMNS:
+        np.testing.assert_allclose(
+            kernel[col].to_numpy(dtype=np.float64), reference[col].to_numpy(dtype=np.float64),
+            rtol=1e-6, atol=1e-3, equal_nan=True, err_msg=col,
+        )
+
+def _measure(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+def run(sizes, customers_per_row, skip_reference_above):
+    print(f"{'rows':>12} {'impl':>10} {'seconds':>9} {'peak MB':>9}")
+    for rows in sizes:
+        num_customers = max(1, int(rows * customers_per_row))
+        df = pd.concat(generate_transaction_batches(num_customers, rows, 1_000_000), ignore_index=True)
+        df = df.drop(columns=['Quantity'])
+        snapshot_date = df['TransactionDate'].max()
+
+        kernel, seconds, peak = _measure(compute_customer_features, df, snapshot_date)
+        print(f"{rows:>12} {'kernel':>10} {seconds:>9.2f} {peak:>9.0f}")
+
+        if rows > skip_reference_above:
+            print(f"{rows:>12} {'reference':>10} {'skipped':>9}")
+            continue
+        reference, seconds, peak = _measure(reference_features, df.astype({'CustomerID': str}), snapshot_date)
+        print(f"{rows:>12} {'reference':>10} {seconds:>9.2f} {peak:>9.0f}")
+        check_equivalence(reference, kernel)
+        print(f"{rows:>12} outputs equivalent for {len(kernel)} customers")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000, 50_000_000])
+    parser.add_argument('--customers-per-row', type=float, default=0.01)
+    parser.add_argument('--skip-reference-above', type=int, default=50_000_000,
+                        help="Only time the kernel for larger sizes (the reference needs far more memory)")
+    args = parser.parse_args()
+    run(args.sizes, args.customers_per_row, args.skip_reference_above)
@@ -0,0 +1,107 @@
+"""Benchmarks the BG/NBD + Gamma-Gamma fit against lifetimes and checks they agree.
+
+Usage: python -m benchmarks.bench_probabilistic [--sizes 100000 1000000] [--customers-per-row 0.05]
+
+Each size is summarized and fitted with lifetimes (summary_data_from_transaction_data,
+BetaGeoFitter.fit, GammaGammaFitter.fit) and with the kernel summary plus the
+compressed-row fits, cold and warm-started. Fitted parameters can be
+ill-determined (a and b collapse towards 0 when nobody drops out), so the
+models are compared on their predictions, which must agree within PREDICTION_RTOL.
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from lifetimes import BetaGeoFitter, GammaGammaFitter
+from lifetimes.utils import summary_data_from_transaction_data
+from src.incremental_loader import generate_transaction_batches
+from src.feature_kernel import repeat_purchase_summary
+from src.probabilistic import fitters_from_params, predict_probabilistic_features, PROBABILISTIC_FEATURES
+from src.probabilistic_fit import fit_bgnbd, fit_gamma_gamma
+
+PENALIZER_COEF = 0.001
+PREDICTION_RTOL = 1e-4 # Both optimizers stop at tol=1e-7 on the mean log-likelihood, not on the parameters
+SUMMARY_RTOL = 1e-9
+
+def lifetimes_path(df, observation_period_end):
+    summary = summary_data_from_transaction_data(
+        df, 'CustomerID', 'TransactionDate', monetary_value_col='Amount', observation_period_end=observation_period_end
+    )
+    summary_seconds = time.perf_counter()
+    bgf = BetaGeoFitter(penalizer_coef=PENALIZER_COEF).fit(summary['frequency'], summary['recency'], summary['T'])
+    returning = summary[summary['frequency'] > 0]
+    ggf = GammaGammaFitter(penalizer_coef=PENALIZER_COEF).fit(returning['frequency'], returning['monetary_value'])
+    return summary, bgf.params_, ggf.params_, summary_seconds
+
+def fast_path(df, observation_period_end, initial_params=(None, None)):
+    summary = repeat_purchase_summary(df['CustomerID'], df['TransactionDate'], df['Amount'], observation_period_end)
+    summary_seconds = time.perf_counter()
+    bg_params, bg_report = fit_bgnbd(
+        summary['frequency'], summary['recency'], summary['T'], PENALIZER_COEF, initial_params[0]
+    )
+    returning = summary[summary['frequency'] > 0]
+    gg_params, gg_report = fit_gamma_gamma(
+        returning['frequency'], returning['monetary_value'], PENALIZER_COEF, initial_params[1]
+    )
+    return summary, bg_params, gg_params, summary_seconds, bg_report, gg_report
+
+def _timed(fn, *args, **kwargs):
+    """Runs fn and splits its time at the timestamp it returns as its 4th value (summary / fit)."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    end = time.perf_counter()
+    return result, result[3] - start, end - result[3]
+
+def check_equivalence(reference, fast):
+    """Asserts identical summaries and predictions within PREDICTION_RTOL; returns the largest relative differences."""
+    ref_summary, ref_bg, ref_gg = reference[:3]
+    summary, bg_params, gg_params = fast[:3]
+    assert ref_summary.index.equals(summary.index), "CustomerIDs differ"
+    for col in ref_summary.columns:
+        np.testing.assert_allclose(summary[col], ref_summary[col], rtol=SUMMARY_RTOL, err_msg=col)
+
+    ref_predictions = predict_probabilistic_features(ref_summary, *fitters_from_params(ref_bg, ref_gg))
+    predictions = predict_probabilistic_features(summary, *fitters_from_params(bg_params, gg_params))
+    differences = {}
+    for col in PROBABILISTIC_FEATURES:
+        expected, actual = ref_predictions[col].to_numpy(), predictions[col].to_numpy()
+        np.testing.assert_allclose(actual, expected, rtol=PREDICTION_RTOL, err_msg=col)
+        # lifetimes itself returns NaN for some customers when a and b collapse; both paths must agree on those
+        differences[col] = float(np.nanmax(np.abs(actual - expected) / np.maximum(np.abs(expected), 1e-12)))
+    return differences
+
+def run(sizes, customers_per_row):
+    print(f"{'rows':>10} {'customers':>10} {'impl':>10} {'summary s':>10} {'fit s':>8} {'unique rows':>12} {'iterations':>11}")
+    for rows in sizes:
+        num_customers = max(1, int(rows * customers_per_row))
+        df = pd.concat(generate_transaction_batches(
+            num_customers, rows, 1_000_000, rate_config={'distribution': 'gamma', 'shape': 1.0, 'scale': 1.0}
+        ), ignore_index=True)
+        df['CustomerID'] = df['CustomerID'].astype(str)
+        observation_period_end = df['TransactionDate'].max() - pd.Timedelta(days=90)
+
+        reference, summary_seconds, fit_seconds = _timed(lifetimes_path, df, observation_period_end)
+        print(f"{rows:>10} {len(reference[0]):>10} {'lifetimes':>10} {summary_seconds:>10.3f} {fit_seconds:>8.3f}")
+
+        fast, summary_seconds, fit_seconds = _timed(fast_path, df, observation_period_end)
+        bg_report, gg_report = fast[4], fast[5]
+        print(f"{rows:>10} {len(fast[0]):>10} {'cold':>10} {summary_seconds:>10.3f} {fit_seconds:>8.3f} "
+              f"{bg_report['unique_rows']:>5}/{gg_report['unique_rows']:<6} {bg_report['iterations']:>4}/{gg_report['iterations']:<6}")
+        differences = check_equivalence(reference, fast)
+
+        # A warm start as on the next feature build: the previous parameters, slightly off
+        initial_params = (fast[1] * 1.05, fast[2] * 1.05)
+        warm, summary_seconds, fit_seconds = _timed(fast_path, df, observation_period_end, initial_params)
+        bg_report, gg_report = warm[4], warm[5]
+        print(f"{rows:>10} {len(warm[0]):>10} {'warm':>10} {summary_seconds:>10.3f} {fit_seconds:>8.3f} "
+              f"{bg_report['unique_rows']:>5}/{gg_report['unique_rows']:<6} {bg_report['iterations']:>4}/{gg_report['iterations']:<6}")
+        check_equivalence(reference, warm)
+        print(f"{rows:>10} predictions agree (rtol {PREDICTION_RTOL:g}); max relative difference: "
+              + ", ".join(f"{col} {diff:.1e}" for col, diff in differences.items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--customers-per-row', type=float, default=0.05)
+    args = parser.parse_args()
+    run(args.sizes, args.customers_per_row)
@@ -0,0 +1,291 @@
+"""End-to-end scale benchmark: loader, features, probabilistic models, training and the API.
+
+Usage: python -m benchmarks.bench_scale [--sizes 10000:1000 100000:10000] [--output PATH] [--compare BASELINE.json]
+
+Each size is TRANSACTIONS:CUSTOMERS. For every size a fresh process runs in a
+throwaway workspace (its own raw store, feature store and MLflow registry) and
+times, with current and peak RSS, load_new_data, build_feature_set,
+add_probabilistic_features_to_main_set (fit_probabilistic_models),
+train_clv_model and train_segmentation_models. It then promotes the models and
+drives the Flask handlers with an in-process load generator (p50/p99 latency,
+throughput). Instrumented sub-stages are broken out per step.
+
+Results are written as JSON (one file per invocation, tagged with the git
+commit); --compare prints the ratio to an earlier file, flagging slowdowns.
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+REGRESSION_RATIO = 1.2 # Default --threshold: --compare flags steps at least this much slower
+
+# (name, endpoint, customers per request, requests, concurrency)
+API_SCENARIOS = [
+    ('predict_clv_1', '/predict-clv', 1, 2000, 8),
+    ('predict_clv_100', '/predict-clv', 100, 500, 8),
+    ('predict_segment_1', '/predict-segment', 1, 2000, 8),
+    ('predict_bulk_1000', '/predict-bulk', 1000, 50, 2),
+]
+
+# ------------------
+# Workspace (parent process)
+# ------------------
+def make_workspace(num_transactions, num_customers):
+    """Temporary directory with the repo's config (sized for this run) and expectation suite."""
+    workspace = tempfile.mkdtemp(prefix=f"bench_scale_{num_transactions}_")
+    with open(os.path.join(REPO_ROOT, "src", "config.yaml"), 'r') as f:
+        config = yaml.safe_load(f)
+    config['data_generation'].update(num_customers=num_customers, num_transactions=num_transactions)
+    config['data']['raw_path'] = "data/raw/none.csv" # Never import a CSV into the benchmark store
+    config['model_manager']['poll_interval_seconds'] = 0
+    os.makedirs(os.path.join(workspace, "src"))
+    with open(os.path.join(workspace, "src", "config.yaml"), 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    shutil.copytree(os.path.join(REPO_ROOT, "expectations"), os.path.join(workspace, "expectations"))
+    for path in ("data/raw", "data/processed", "models"):
+        os.makedirs(os.path.join(workspace, path), exist_ok=True)
+    return workspace
+
+def run_size(num_transactions, num_customers, keep_workspace):
+    """Runs one size in a child process (fresh interpreter, so memory peaks are its own)."""
+    workspace = make_workspace(num_transactions, num_customers)
+    result_path = os.path.join(workspace, "result.json")
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    env.pop('MLFLOW_TRACKING_URI', None) # The workspace config points at its own registry
+    try:
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_scale", "--child", result_path,
+             "--sizes", f"{num_transactions}:{num_customers}"],
+            cwd=workspace, env=env, check=True,
+        )
+        with open(result_path, 'r') as f:
+            return json.load(f)
+    finally:
+        if keep_workspace:
+            print(f"Workspace kept at '{workspace}'")
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+# ------------------
+# Measurements (child process, cwd = workspace)
+# ------------------
+def measure(name, fn, steps):
+    """Runs fn, recording wall time, RSS, the step's own peak RSS and the instrumented sub-stages it ran."""
+    from src.instrumentation import STAGE_SECONDS, rss_bytes, peak_rss_bytes, reset_peak_rss
+    print(f"\n=== {name} ===")
+    stages_before = STAGE_SECONDS.summary()
+    rss_before = rss_bytes()
+    reset_peak_rss()
+    start = time.perf_counter()
+    value = fn()
+    seconds = time.perf_counter() - start
+    stages = {}
+    for (stage,), (count, total) in STAGE_SECONDS.summary().items():
+        before_count, before_total = stages_before.get((stage,), (0, 0.0))
+        if count > before_count:
+            stages[stage] = {'calls': count - before_count, 'seconds': total - before_total}
+    steps[name] = {
+        'seconds': seconds,
+        'rss_mb': rss_bytes() / 2**20,
+        'rss_delta_mb': (rss_bytes() - rss_before) / 2**20,
+        'peak_rss_mb': peak_rss_bytes() / 2**20,
+        'stages': stages,
+    }
+    return value
+
+def load_generator(client_factory, endpoint, payloads, concurrency):
+    """Sends the payloads from `concurrency` threads as fast as they are answered; returns latency and throughput."""
+    latencies = np.zeros(len(payloads))
+    errors = []
+    next_index = iter(range(len(payloads)))
+    lock = threading.Lock()
+
+    def worker():
+        client = client_factory()
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            response = client.post(endpoint, json={'customer_ids': payloads[i]})
+            response.get_data() # Drains streamed responses
+            latencies[i] = time.perf_counter() - start
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    return {
+        'requests': len(payloads),
+        'concurrency': concurrency,
+        'p50_ms': float(np.percentile(latencies, 50) * 1e3),
+        'p99_ms': float(np.percentile(latencies, 99) * 1e3),
+        'mean_ms': float(latencies.mean() * 1e3),
+        'throughput_rps': len(payloads) / wall,
+        'customers_per_second': sum(len(p) for p in payloads) / wall,
+        'errors': len(errors),
+    }
+
+def benchmark_api(seed=0):
+    """Drives the Flask handlers in-process; the first request's latency includes the lazy model load."""
+    start = time.perf_counter()
+    from api import app as api_app
+    import_seconds = time.perf_counter() - start
+    client_factory = api_app.app.test_client
+    ids = np.asarray(api_app.FEATURE_STORE.snapshot().ids).astype(str)
+    rng = np.random.default_rng(seed)
+
+    start = time.perf_counter()
+    client_factory().post('/predict-clv', json={'customer_ids': [ids[0]]}).get_data()
+    results = {'import_seconds': import_seconds, 'cold_request_ms': (time.perf_counter() - start) * 1e3, 'scenarios': {}}
+    for name, endpoint, batch, requests, concurrency in API_SCENARIOS:
+        payloads = [rng.choice(ids, size=min(batch, len(ids)), replace=False).tolist() for _ in range(requests)]
+        results['scenarios'][name] = stats = load_generator(client_factory, endpoint, payloads, concurrency)
+        print(f"  {name:<18} p50 {stats['p50_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms  "
+              f"{stats['throughput_rps']:9.1f} req/s  ({stats['errors']} errors)")
+    return results
+
+def promote_latest_models():
+    import mlflow
+    from src.utils_io import load_config
+    config = load_config()
+    client = mlflow.tracking.MlflowClient()
+    for key in ('clv_model_name', 'segmentation_model_name'):
+        versions = client.search_model_versions(f"name='{config['models'][key]}'")
+        latest = max(versions, key=lambda v: int(v.version))
+        client.transition_model_version_stage(config['models'][key], latest.version, 'Production')
+
+def run_child(num_transactions, num_customers, result_path):
+    """All steps for one size, in the current directory's workspace."""
+    import mlflow
+    from src.utils_io import load_config
+    from src.incremental_loader import generate_synthetic_data, load_new_data
+    from src.feature_engineering import build_feature_set
+    from src.probabilistic import add_probabilistic_features_to_main_set
+    from src.train_regression import train_clv_model
+    from src.tree_export import export_clv_model
+    from src.train_segmentation import train_segmentation_models
+
+    config = load_config()
+    mlflow.set_tracking_uri(config['mlflow']['tracking_uri'])
+    mlflow.set_experiment(config['mlflow']['experiment_name'])
+    steps = {}
+    measure('generate_synthetic_data', lambda: generate_synthetic_data(num_customers, num_transactions), steps)
+    measure('load_new_data', load_new_data, steps)
+    measure('build_feature_set', build_feature_set, steps)
+    with mlflow.start_run(run_name="Benchmark"):
+        measure('fit_probabilistic_models', add_probabilistic_features_to_main_set, steps)
+        measure('train_clv_model', lambda: (train_clv_model(), export_clv_model()), steps)
+        measure('train_segmentation_models', train_segmentation_models, steps)
+    promote_latest_models()
+    api = measure('api', benchmark_api, steps)
+    api_step = steps.pop('api')
+
+    result = {
+        'transactions': num_transactions, 'customers': num_customers,
+        'steps': steps, 'api': dict(api, peak_rss_mb=api_step['peak_rss_mb'], stages=api_step['stages']),
+    }
+    with open(result_path, 'w') as f:
+        json.dump(result, f, indent=2)
+
+# ------------------
+# Report and comparison
+# ------------------
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_summary(runs):
+    print(f"\n{'transactions':>12} {'customers':>10} {'step':<28} {'seconds':>9} {'peak MB':>9}")
+    for run in runs:
+        for name, step in run['steps'].items():
+            print(f"{run['transactions']:>12} {run['customers']:>10} {name:<28} {step['seconds']:>9.2f} {step['peak_rss_mb']:>9.0f}")
+        for name, stats in run['api']['scenarios'].items():
+            print(f"{run['transactions']:>12} {run['customers']:>10} {'api ' + name:<28} "
+                  f"p50 {stats['p50_ms']:.2f} ms, p99 {stats['p99_ms']:.2f} ms, {stats['throughput_rps']:.0f} req/s")
+
+def compare(results, baseline_path, threshold=REGRESSION_RATIO):
+    """Prints current / baseline for step seconds, peak memory and API p99 at the sizes both files cover."""
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    baseline_runs = {(r['transactions'], r['customers']): r for r in baseline['runs']}
+    print(f"\nCompared with {baseline_path} (commit {baseline['meta'].get('git_commit')}):")
+    regressions = 0
+    for run in results['runs']:
+        old = baseline_runs.get((run['transactions'], run['customers']))
+        if old is None:
+            continue
+        pairs = [(f"{name} seconds", step['seconds'], old['steps'].get(name, {}).get('seconds')) for name, step in run['steps'].items()]
+        pairs += [(f"{name} peak MB", step['peak_rss_mb'], old['steps'].get(name, {}).get('peak_rss_mb')) for name, step in run['steps'].items()]
+        pairs += [(f"api {name} p99", stats['p99_ms'], old['api']['scenarios'].get(name, {}).get('p99_ms'))
+                  for name, stats in run['api']['scenarios'].items()]
+        for label, current, previous in pairs:
+            if not previous:
+                continue
+            ratio = current / previous
+            flag = "  REGRESSION" if ratio >= threshold else ""
+            regressions += bool(flag)
+            print(f"  {run['transactions']:>10}/{run['customers']:<8} {label:<36} {ratio:6.2f}x{flag}")
+    return regressions
+
+def run(sizes, output, baseline_path, threshold, keep_workspace):
+    runs = [run_size(num_transactions, num_customers, keep_workspace) for num_transactions, num_customers in sizes]
+    results = {
+        'meta': {
+            'git_commit': _git_commit(),
+            'created_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'platform': platform.platform(),
+        },
+        'runs': runs,
+    }
+    print_summary(runs)
+    output = output or os.path.join(RESULTS_DIR, f"scale-{datetime.now().strftime('%Y%m%dT%H%M%S')}-{results['meta']['git_commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to '{output}'")
+    if baseline_path:
+        compare(results, baseline_path, threshold)
+
+def _size(value):
+    num_transactions, num_customers = value.split(":")
+    return int(float(num_transactions)), int(float(num_customers))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=_size, nargs='+', default=[(10_000, 1_000), (100_000, 10_000)],
+                        help="TRANSACTIONS:CUSTOMERS pairs, e.g. 1e6:1e5")
+    parser.add_argument('--output', help="Results JSON (default: benchmarks/results/scale-<time>-<commit>.json)")
+    parser.add_argument('--compare', help="Earlier results JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_RATIO, help="Ratio flagged as a regression by --compare")
+    parser.add_argument('--keep-workspace', action='store_true')
+    parser.add_argument('--child', help=argparse.SUPPRESS) # Internal: run one size here and write its result
+    args = parser.parse_args()
+    if args.child:
+        run_child(*args.sizes[0], args.child)
+    else:
+        run(args.sizes, args.output, args.compare, args.threshold, args.keep_workspace)
@@ -0,0 +1,74 @@
+"""Benchmarks the flat tree evaluator against LightGBM's Booster.predict across batch sizes.
+
+Usage: python -m benchmarks.bench_tree_eval [--batch-sizes 1 10 100 1000 10000] [--model-version N]
+
+Without --model-version a booster is trained on synthetic data with the
+configured regression_params, so the benchmark runs without a registry.
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+import mlflow
+from src.utils_io import load_config
+from src.tree_export import flatten_booster, FlatTreeEnsemble, check_flat_model
+
+CONFIG = load_config()
+
+def synthetic_booster(num_rows=20_000, num_features=11, seed=0):
+    """A booster with the production tree shape (trees, leaves, depth) on random data with missing values."""
+    rng = np.random.default_rng(seed)
+    X = rng.lognormal(size=(num_rows, num_features))
+    X[rng.random(X.shape) < 0.05] = np.nan
+    y = np.nansum(X[:, :4], axis=1) * rng.lognormal(sigma=0.3, size=num_rows)
+    params = CONFIG['regression_params']
+    booster = lgb.train(
+        {'objective': params['objective'], 'learning_rate': params['learning_rate'], 'num_leaves': params['num_leaves'],
+         'max_depth': params['max_depth'], 'colsample_bytree': params['colsample_bytree'], 'seed': params['random_state'],
+         'verbose': -1},
+        lgb.Dataset(X, y), num_boost_round=params['n_estimators'],
+    )
+    return booster, X
+
+def registered_booster(model_version):
+    mlflow.set_tracking_uri(CONFIG['mlflow']['tracking_uri'])
+    model_name = CONFIG['models']['clv_model_name']
+    booster = mlflow.lightgbm.load_model(f"models:/{model_name}/{model_version}")
+    booster = getattr(booster, 'booster_', booster)
+    X = pd.read_csv(CONFIG['data']['processed_path'])[booster.feature_name()].to_numpy(dtype=np.float64)
+    return booster, X
+
+def _latency(fn, X, repeats):
+    """Median and 99th percentile seconds per call."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(X)
+        timings.append(time.perf_counter() - start)
+    return np.median(timings), np.percentile(timings, 99)
+
+def run(batch_sizes, repeats, model_version=None):
+    booster, X = registered_booster(model_version) if model_version else synthetic_booster()
+    flat_model = FlatTreeEnsemble(flatten_booster(booster))
+    check_flat_model(booster, flat_model, X)
+    print(f"{flat_model.num_trees()} trees: outputs match on {len(X)} rows")
+
+    rng = np.random.default_rng(1)
+    print(f"{'batch':>8} {'impl':>10} {'p50 ms':>9} {'p99 ms':>9} {'rows/s':>12}")
+    for batch_size in batch_sizes:
+        batch = X[rng.integers(0, len(X), batch_size)]
+        # 'lgb+pandas' is the DataFrame call predict_clv makes on a loaded LightGBM model
+        frame = pd.DataFrame(batch, columns=booster.feature_name())
+        for name, fn, data in (('lgb+pandas', booster.predict, frame), ('lightgbm', booster.predict, batch),
+                               ('flat', flat_model.predict, batch)):
+            p50, p99 = _latency(fn, data, repeats)
+            print(f"{batch_size:>8} {name:>10} {p50 * 1e3:>9.3f} {p99 * 1e3:>9.3f} {batch_size / p50:>12.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--model-version', help="Benchmark a registered CLV model version instead of a synthetic one")
+    args = parser.parse_args()
+    run(args.batch_sizes, args.repeats, args.model_version)
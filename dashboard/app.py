@@ -1,67 +1,78 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import sys, os
 
 # Add src to path to allow imports
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
-from src.inference import predict_segment
-from src.labeler import assign_segment_labels
+from src.batch_scoring import ScoredResults, LATEST_FILE
 from src.utils_io import load_config
 
 st.set_page_config(layout="wide")
 CONFIG = load_config()
 
-@st.cache_data
-def load_data():
-    df = pd.read_csv(CONFIG['data']['processed_path'])
-    return df
+# Predictions and segment aggregates are materialized by `make score`; the dashboard
+# only reads them, so page loads do not grow with the number of customers.
+@st.cache_resource
+def load_results(version):
+    return ScoredResults()
 
-st.title("📈 Advanced CLV & Customer Segmentation Dashboard")
+def latest_version():
+    with open(os.path.join(CONFIG['batch_scoring']['scored_path'], LATEST_FILE), 'r') as f:
+        return f.read().strip()
 
-df = load_data()
+st.title("📈 Advanced CLV & Customer Segmentation Dashboard")
 
-# --- Assign segments to all data for visualization ---
-segments = predict_segment(df)
-df['segment'] = segments
-df, label_map = assign_segment_labels(df)
+results = load_results(latest_version())
+segments = results.summary['segments']
+st.caption(f"{results.summary['customers']} customers scored at {results.summary['scored_at']} "
+           f"(feature snapshot {results.summary['snapshot_version']})")
 
 # --- Main Dashboard ---
 col1, col2 = st.columns(2)
 
 with col1:
     st.header("Segment Distribution")
-    segment_counts = df['segment_label'].value_counts()
+    segment_counts = results.segment_frame()
     fig_pie = px.pie(
-        values=segment_counts.values, 
-        names=segment_counts.index, 
+        values=segment_counts['count'], 
+        names=segment_counts['segment_label'], 
         title="Customer Segments"
     )
     st.plotly_chart(fig_pie, use_container_width=True)
 
 with col2:
     st.header("CLV Distribution by Segment")
-    fig_box = px.box(
-        df, 
-        x='segment_label', 
-        y='CLV_90_days', 
-        color='segment_label',
-        title="90-Day CLV by Segment"
-    )
+    # Boxes are drawn from the precomputed quartiles and whiskers
+    fig_box = go.Figure()
+    for segment in segments:
+        stats = segment.get('CLV_90_days')
+        if stats is None:
+            continue
+        fig_box.add_trace(go.Box(
+            name=segment['segment_label'],
+            q1=[stats['q1']], median=[stats['median']], q3=[stats['q3']], mean=[stats['mean']],
+            lowerfence=[stats['lowerfence']], upperfence=[stats['upperfence']],
+        ))
+    fig_box.update_layout(title="90-Day CLV by Segment", yaxis_title="CLV_90_days")
     st.plotly_chart(fig_box, use_container_width=True)
 
 st.header("Customer Lookup")
-customer_id_input = st.selectbox("Select a CustomerID to inspect:", df['CustomerID'].unique())
+customer_id_input = st.text_input("Enter a CustomerID to inspect:", value=str(results.snapshot.ids[0]))
 
 if customer_id_input:
-    customer_data = df[df['CustomerID'] == customer_id_input].iloc[0]
-    
-    st.subheader(f"Profile for Customer: {customer_id_input}")
-    
-    # Display key metrics
-    st.metric("Assigned Segment", customer_data['segment_label'])
-    st.metric("Predicted 90-Day CLV", f"${customer_data['CLV_90_days']:.2f}")
-    st.metric("Probabilistic 90-Day CLV", f"${customer_data['probabilistic_clv_90d']:.2f}")
+    customer_data = results.customer(customer_id_input)
+
+    if customer_data is None:
+        st.warning(f"CustomerID '{customer_id_input}' not found.")
+    else:
+        st.subheader(f"Profile for Customer: {customer_id_input}")
+        
+        # Display key metrics
+        st.metric("Assigned Segment", customer_data['segment_label'])
+        st.metric("Predicted 90-Day CLV", f"${customer_data['predicted_clv']:.2f}")
+        st.metric("Probabilistic 90-Day CLV", f"${customer_data['probabilistic_clv_90d']:.2f}")
 
-    with st.expander("View all features for this customer"):
-        st.dataframe(customer_data)
\ No newline at end of file
+        with st.expander("View all features for this customer"):
+            st.dataframe(customer_data)
@@ -0,0 +1,185 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import datetime
+import json
+import os
+import shutil
+import time
+from src.utils_io import load_config
+from src.feature_store import FeatureStore, FeatureSnapshot
+from src.instrumentation import instrumented
+
+CONFIG = load_config()
+
+LATEST_FILE = "LATEST"
+SNAPSHOT_FILES = ["features.npy", "ids.npy", "index_hashes.npy", "index_rows.npy", "meta.json"]
+
+def _scored_root(scored_root=None):
+    return scored_root or CONFIG['batch_scoring']['scored_path']
+
+def _link_snapshot(snapshot_path, output_path):
+    """Hard-links the snapshot's files next to the scores, so pruning the snapshot does not break lookups."""
+    for name in SNAPSHOT_FILES:
+        try:
+            os.link(os.path.join(snapshot_path, name), os.path.join(output_path, name))
+        except OSError:
+            shutil.copy2(os.path.join(snapshot_path, name), os.path.join(output_path, name))
+
+# ------------------
+# Segment aggregates
+# ------------------
+def _box_stats(values):
+    """Tukey box-plot statistics (whiskers at the furthest points within 1.5 IQR)."""
+    if values.size == 0:
+        return None
+    q1, median, q3 = np.quantile(values, [0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    return {
+        'q1': float(q1), 'median': float(median), 'q3': float(q3), 'mean': float(values.mean()),
+        'lowerfence': float(inside.min()), 'upperfence': float(inside.max()),
+        'min': float(values.min()), 'max': float(values.max()),
+    }
+
+def segment_summary(segments, segment_labels, columns):
+    """Per-segment counts and box-plot statistics of each column in `columns`."""
+    total = len(segments)
+    summary = []
+    for segment in np.unique(segments):
+        in_segment = segments == segment
+        count = int(in_segment.sum())
+        summary.append({
+            'segment': int(segment),
+            'segment_label': segment_labels.get(int(segment), "Unknown"),
+            'count': count,
+            'share': count / total,
+            **{name: _box_stats(values[in_segment]) for name, values in columns.items()},
+        })
+    return summary
+
+# ------------------
+# Batch scoring
+# ------------------
+@instrumented('scoring.batch')
+def score_all_customers(chunk_size=None, scored_root=None):
+    """Scores every customer of the current feature snapshot in chunks and publishes the results.
+
+    Writes, under <scored_path>/<snapshot version>/: predicted_clv.npy and
+    segment.npy (row-aligned with the snapshot, which is hard-linked alongside
+    for indexed lookups), scores.parquet and summary.json with per-segment
+    aggregates. LATEST then points at the new directory.
+    """
+    # Imported here so that readers of the results (the dashboard) never load the models
+    from src.inference import MODELS, SEGMENTATION_FEATURES
+    models = MODELS.models()
+    chunk_size = chunk_size or CONFIG['batch_scoring']['chunk_size']
+    scored_root = _scored_root(scored_root)
+    start = time.perf_counter()
+
+    store = FeatureStore(required_columns=SEGMENTATION_FEATURES)
+    snapshot = store.snapshot()
+    snapshot_path = os.path.join(store.store_root, "snapshots", snapshot.version)
+    print(f"Batch scoring {len(snapshot)} customers from snapshot '{snapshot.version}' in chunks of {chunk_size}...")
+
+    output_path = os.path.join(scored_root, snapshot.version)
+    tmp_path = output_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    clv_columns = [snapshot.column_index[c] for c in models.clv_feature_names()]
+    segment_columns = [snapshot.column_index[c] for c in SEGMENTATION_FEATURES]
+    predicted_clv = np.lib.format.open_memmap(os.path.join(tmp_path, "predicted_clv.npy"), mode='w+', dtype=np.float64, shape=(len(snapshot),))
+    segments = np.lib.format.open_memmap(os.path.join(tmp_path, "segment.npy"), mode='w+', dtype=np.int64, shape=(len(snapshot),))
+
+    schema = pa.schema([('CustomerID', pa.string()), ('predicted_clv', pa.float64()),
+                        ('segment', pa.int64()), ('segment_label', pa.string())])
+    with pq.ParquetWriter(os.path.join(tmp_path, "scores.parquet"), schema) as writer:
+        for chunk_start in range(0, len(snapshot), chunk_size):
+            rows = slice(chunk_start, chunk_start + chunk_size)
+            features = np.asarray(snapshot.matrix[rows])
+            predicted_clv[rows] = models.predict_clv_array(features[:, clv_columns])
+            segments[rows] = models.predict_segment_array(features[:, segment_columns])
+            writer.write_table(pa.table({
+                'CustomerID': np.asarray(snapshot.ids[rows]),
+                'predicted_clv': predicted_clv[rows],
+                'segment': segments[rows],
+                'segment_label': models.label_segments(segments[rows]),
+            }, schema=schema))
+    predicted_clv.flush()
+    segments.flush()
+
+    summary_columns = {'predicted_clv': np.asarray(predicted_clv)}
+    if 'CLV_90_days' in snapshot.column_index:
+        summary_columns['CLV_90_days'] = np.asarray(snapshot.matrix[:, snapshot.column_index['CLV_90_days']])
+    meta = {
+        'snapshot_version': snapshot.version,
+        'clv_model_version': models.clv_version,
+        'segmentation_model_version': models.segmentation_version,
+        'segment_labels': {str(k): v for k, v in models.segment_labels.items()},
+        'customers': len(snapshot),
+        'scored_at': datetime.now().isoformat(),
+        'segments': segment_summary(np.asarray(segments), models.segment_labels, summary_columns),
+    }
+    with open(os.path.join(tmp_path, "summary.json"), 'w') as f:
+        json.dump(meta, f, indent=2)
+    _link_snapshot(snapshot_path, tmp_path)
+
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.rename(tmp_path, output_path)
+    latest_path = os.path.join(scored_root, LATEST_FILE)
+    with open(latest_path + ".tmp", 'w') as f:
+        f.write(snapshot.version)
+    os.replace(latest_path + ".tmp", latest_path)
+    _prune_scored(scored_root, keep=CONFIG['batch_scoring']['keep_results'])
+
+    print(f"Scored {len(snapshot)} customers in {time.perf_counter() - start:.2f}s; results in '{output_path}'")
+    return output_path
+
+def _prune_scored(scored_root, keep):
+    versions = sorted(v for v in os.listdir(scored_root) if v != LATEST_FILE and not v.endswith(".tmp"))
+    for version in versions[:-keep]:
+        shutil.rmtree(os.path.join(scored_root, version), ignore_errors=True)
+
+# ------------------
+# Reader (dashboard)
+# ------------------
+class ScoredResults:
+    """The latest batch-scoring output: summary, plus per-customer lookups in O(1) via the hash index."""
+
+    def __init__(self, scored_root=None):
+        scored_root = _scored_root(scored_root)
+        latest_path = os.path.join(scored_root, LATEST_FILE)
+        if not os.path.exists(latest_path):
+            raise FileNotFoundError(f"No batch scoring results in '{scored_root}'. Run `make score` first.")
+        with open(latest_path, 'r') as f:
+            self.version = f.read().strip()
+        path = os.path.join(scored_root, self.version)
+        with open(os.path.join(path, "summary.json"), 'r') as f:
+            self.summary = json.load(f)
+        self.snapshot = FeatureSnapshot(path)
+        self.predicted_clv = np.load(os.path.join(path, "predicted_clv.npy"), mmap_mode='r')
+        self.segments = np.load(os.path.join(path, "segment.npy"), mmap_mode='r')
+
+    def segment_frame(self):
+        """One row per segment with its count and share."""
+        return pd.DataFrame([
+            {'segment': s['segment'], 'segment_label': s['segment_label'], 'count': s['count'], 'share': s['share']}
+            for s in self.summary['segments']
+        ])
+
+    def customer(self, customer_id):
+        """Features and scores of one customer as a Series, or None if unknown."""
+        row = self.snapshot.rows_for([customer_id])[0]
+        if row < 0:
+            return None
+        record = pd.Series(np.asarray(self.snapshot.matrix[row]), index=self.snapshot.columns)
+        segment = int(self.segments[row])
+        record['predicted_clv'] = self.predicted_clv[row]
+        record['segment'] = segment
+        record['segment_label'] = self.summary['segment_labels'].get(str(segment), "Unknown")
+        return record
+
+if __name__ == "__main__":
+    score_all_customers()
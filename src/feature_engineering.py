@@ -2,9 +2,18 @@ import pandas as pd
 from datetime import datetime
 import os
 from src.utils_io import load_config
+from src import raw_store, customer_state, feature_store
+from src.feature_kernel import compute_customer_features, compute_snapshot_features
+from src.probabilistic import point_in_time_probabilistic_features
+from src.instrumentation import instrumented
 
 CONFIG = load_config()
 
+# Raw transaction columns needed to build features; Quantity is never read
+FEATURE_SOURCE_COLUMNS = ['CustomerID', 'TransactionDate', 'UnitPrice', 'Amount']
+
+# calculate_rfm and add_behavioral_features are the original groupby implementations,
+# kept as the reference that benchmarks/bench_feature_kernel.py checks the kernel against.
 def calculate_rfm(df, snapshot_date):
     """Calculates Recency, Frequency, and Monetary features."""
     rfm = df.groupby('CustomerID').agg(
@@ -36,47 +45,127 @@ def add_behavioral_features(df, snapshot_date):
     features = pd.merge(behavioral, interpurchase, on='CustomerID', how='left')
     return features.drop(columns=['FirstPurchaseDate', 'LastPurchaseDate'])
 
-def build_feature_set():
-    """Main function to build and save the complete feature set."""
-    print("Building feature set...")
-    raw_data_path = CONFIG['data']['raw_path']
-    processed_feature_path = CONFIG['data']['processed_path']
-    
-    if not os.path.exists(raw_data_path):
-        raise FileNotFoundError(f"Raw data not found at {raw_data_path}. Run `make data` first.")
+@instrumented('features.compute')
+def compute_feature_set(transactions=None):
+    """Builds the feature set with its CLV target in memory.
+
+    `transactions` (every row up to the latest timestamp, FEATURE_SOURCE_COLUMNS)
+    can be passed by callers that already hold them, to skip reading the raw store.
+    """
+    if not raw_store.store_exists():
+        raise FileNotFoundError(f"Raw data not found at {CONFIG['data']['raw_store_path']}. Run `make data` first.")
 
-    df = pd.read_csv(raw_data_path, parse_dates=['TransactionDate'])
+    # The snapshot date comes from the manifest, so it costs no data scan
+    snapshot_date = raw_store.max_timestamp()
     
     # For CLV, we define a prediction period. Let's predict value in the last 90 days.
     # This is a common way to frame a supervised CLV problem.
-    snapshot_date = df['TransactionDate'].max()
     train_end_date = snapshot_date - pd.Timedelta(days=90)
     
-    # Features are built on data BEFORE the prediction period
-    train_df = df[df['TransactionDate'] <= train_end_date]
-    
-    # Target (MonetaryValue) is calculated on data WITHIN the prediction period
-    target_df = df[df['TransactionDate'] > train_end_date]
-    clv_target = target_df.groupby('CustomerID')['Amount'].sum().reset_index()
+    if CONFIG['feature_engineering']['incremental']:
+        # Only transactions the persisted state has not absorbed yet are read and merged
+        state = customer_state.update_state(train_end_date)
+        features = customer_state.features_from_state(state, train_end_date)
+        if transactions is not None:
+            target_df = transactions.loc[transactions['TransactionDate'] > train_end_date, ['CustomerID', 'Amount']]
+        else:
+            target_df = raw_store.read_transactions(
+                start=train_end_date, end=snapshot_date, columns=['CustomerID', 'Amount'], categorical_ids=True
+            )
+    else:
+        if transactions is not None:
+            df = transactions
+        else:
+            df = raw_store.read_transactions(end=snapshot_date, columns=FEATURE_SOURCE_COLUMNS, categorical_ids=True)
+
+        # Features are built on data BEFORE the prediction period
+        before_cutoff = df['TransactionDate'] <= train_end_date
+        
+        # Target (MonetaryValue) is calculated on data WITHIN the prediction period
+        target_df = df[~before_cutoff]
+
+        # Engineer all features in a single sorted pass over the training data
+        features = compute_customer_features(df[before_cutoff], train_end_date)
+
+    clv_target = target_df.groupby('CustomerID', observed=True)['Amount'].sum().reset_index()
     clv_target.rename(columns={'Amount': 'CLV_90_days'}, inplace=True)
     
-    # Engineer features using training data
-    rfm_features = calculate_rfm(train_df, train_end_date)
-    behavioral_features = add_behavioral_features(train_df, train_end_date)
-    
-    # Combine all features
-    features = pd.merge(rfm_features, behavioral_features, on='CustomerID', how='left')
-    
     # Combine features with the target
     final_df = pd.merge(features, clv_target, on='CustomerID', how='left')
     
     # Fill NaNs - target may be NaN if customer didn't purchase in the last 90 days
-    final_df['CLV_90_days'].fillna(0, inplace=True)
-    final_df.fillna(0, inplace=True) # Fill other NaNs (e.g., for single-purchase customers)
-    
+    final_df['CLV_90_days'] = final_df['CLV_90_days'].fillna(0)
+    value_cols = final_df.columns.drop('CustomerID') # CustomerID is categorical and never missing
+    final_df[value_cols] = final_df[value_cols].fillna(0) # Fill other NaNs (e.g., for single-purchase customers)
+    return final_df
+
+@instrumented('features.save')
+def save_feature_set(final_df):
+    """Writes the feature CSV and publishes the feature store snapshot; returns the snapshot version."""
+    processed_feature_path = CONFIG['data']['processed_path']
     final_df.to_csv(processed_feature_path, index=False)
+    version = feature_store.write_snapshot(final_df)
     print(f"Complete feature set saved to '{processed_feature_path}'")
+    return version
+
+@instrumented('features.build')
+def build_feature_set():
+    """Main function to build and save the complete feature set."""
+    print("Building feature set...")
+    final_df = compute_feature_set()
+    save_feature_set(final_df)
     return final_df
 
+def backtest_snapshot_dates(windows_days):
+    """Configured backtest cutoffs, else num_snapshots cutoffs step_days apart ending at the latest
+    one whose longest target window is complete."""
+    config = CONFIG['backtest']
+    if config['snapshot_dates']:
+        return sorted(pd.to_datetime(config['snapshot_dates']))
+    latest_cutoff = raw_store.max_timestamp() - pd.Timedelta(days=max(windows_days))
+    return [latest_cutoff - pd.Timedelta(days=i * config['step_days']) for i in reversed(range(config['num_snapshots']))]
+
+@instrumented('features.backtest')
+def compute_backtest_set(transactions, snapshot_dates, windows_days, probabilistic=True):
+    """Point-in-time features and CLV_<w>_days targets for every snapshot date, one row per (CustomerID, snapshot_date).
+
+    Features at a snapshot only see transactions up to it and each target only
+    the spend after it, so every snapshot can serve as a rolling-origin fold.
+    `probabilistic` adds the BG/NBD + Gamma-Gamma features, refitted per snapshot.
+    """
+    panel = compute_snapshot_features(transactions, snapshot_dates, windows_days)
+    if probabilistic:
+        prob_features = point_in_time_probabilistic_features(transactions, snapshot_dates)
+        panel = panel.merge(prob_features, on=['CustomerID', 'snapshot_date'], how='left')
+    value_cols = panel.columns.drop(['CustomerID', 'snapshot_date'])
+    panel[value_cols] = panel[value_cols].fillna(0) # Single-purchase customers have no volatility or interpurchase time
+    return panel
+
+def build_backtest_set(snapshot_dates=None, windows_days=None):
+    """Builds the backtest training set from one read of the raw store and saves it as Parquet."""
+    if not raw_store.store_exists():
+        raise FileNotFoundError(f"Raw data not found at {CONFIG['data']['raw_store_path']}. Run `make data` first.")
+    config = CONFIG['backtest']
+    windows_days = list(windows_days or config['windows_days'])
+    snapshot_dates = sorted(pd.to_datetime(snapshot_dates)) if snapshot_dates else backtest_snapshot_dates(windows_days)
+
+    # A target window running past the data would understate the spend of the last snapshots
+    horizon_end = max(snapshot_dates) + pd.Timedelta(days=max(windows_days))
+    if horizon_end > raw_store.max_timestamp():
+        raise ValueError(
+            f"The {max(windows_days)}-day target window after {max(snapshot_dates)} ends after "
+            f"the latest transaction ({raw_store.max_timestamp()})."
+        )
+
+    print(f"Building backtest set for {len(snapshot_dates)} snapshots and windows {windows_days} days...")
+    df = raw_store.read_transactions(end=horizon_end, columns=FEATURE_SOURCE_COLUMNS, categorical_ids=True)
+    panel = compute_backtest_set(df, snapshot_dates, windows_days, probabilistic=config['probabilistic'])
+
+    output_path = config['output_path']
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    panel.to_parquet(output_path, index=False)
+    print(f"Backtest set ({len(panel)} rows) saved to '{output_path}'")
+    return panel
+
 if __name__ == "__main__":
     build_feature_set()
\ No newline at end of file
@@ -0,0 +1,216 @@
+import pandas as pd
+import numpy as np
+
+DAY_NS = 86_400_000_000_000
+
+FEATURE_COLUMNS = [
+    'Recency', 'Frequency', 'MonetaryValue', 'AvgOrderValue', 'SpendingVolatility',
+    'UniqueProducts', 'CustomerTenure', 'AvgInterpurchaseTime',
+]
+FEATURE_DTYPES = {
+    'Recency': np.int32,
+    'Frequency': np.int32,
+    'MonetaryValue': np.float32,
+    'AvgOrderValue': np.float32,
+    'SpendingVolatility': np.float32,
+    'UniqueProducts': np.int32,
+    'CustomerTenure': np.int32,
+    'AvgInterpurchaseTime': np.float32,
+}
+
+def _customer_date_order(codes, dates):
+    """Row order by (customer, date) from one argsort of a combined int64 key.
+
+    Dates are replaced by their dense rank so that customer code and date fit in
+    a single key; this is markedly faster than np.lexsort on the two columns.
+    """
+    date_order = np.argsort(dates)
+    sorted_dates = dates[date_order]
+    date_rank = np.empty(len(dates), dtype=np.int64)
+    date_rank[date_order] = np.cumsum(np.r_[0, sorted_dates[1:] != sorted_dates[:-1]])
+    del date_order, sorted_dates
+    # int64 before multiplying: NumPy 1.x keeps int32 codes times a scalar in int32, which overflows
+    return np.argsort(codes.astype(np.int64) * (date_rank.max(initial=0) + 1) + date_rank, kind='stable')
+
+def sort_transactions(customer_ids, transaction_dates):
+    """Factorizes CustomerID once and sorts rows by (customer, date) once.
+
+    Returns the sorted customer codes and int64 nanosecond dates, the row order
+    (to gather any other column), the sorted customer labels and the start/end
+    offsets of each customer's segment.
+    """
+    if isinstance(customer_ids.dtype, pd.CategoricalDtype):
+        # Dictionary order from Parquet is arbitrary; reorder so codes follow the ID order
+        customer_ids = customer_ids.cat.reorder_categories(customer_ids.cat.categories.sort_values())
+    codes, customers = pd.factorize(customer_ids, sort=True)
+    codes = codes.astype(np.int32 if len(customers) < 2**31 else np.int64)
+    dates = np.asarray(transaction_dates, dtype='datetime64[ns]').view(np.int64)
+    order = _customer_date_order(codes, dates)
+    codes, dates = codes[order], dates[order]
+
+    same_customer = codes[1:] == codes[:-1]
+    starts = np.flatnonzero(np.r_[True, ~same_customer])
+    ends = np.r_[starts[1:], len(codes)]
+    return codes, dates, order, customers, starts, ends
+
+def interpurchase_gaps(codes, dates):
+    """Day-truncated gap to the previous purchase of the same customer (0 on each first row)."""
+    same_customer = codes[1:] == codes[:-1]
+    return np.r_[0, np.where(same_customer, np.diff(dates) // DAY_NS, 0)]
+
+def distinct_counts(codes, values, num_customers):
+    """Exact number of distinct 2-decimal values per customer, via hashing rather than sorting."""
+    keys = (codes.astype(np.int64) << 32) | np.round(values * 100).astype(np.int64)
+    return np.bincount((pd.unique(keys) >> 32).astype(np.int64), minlength=num_customers)
+
+def finalize_features(features):
+    """Applies the compact feature dtypes (categorical IDs, float32/int32 values)."""
+    features['CustomerID'] = features['CustomerID'].astype('category')
+    return features.astype(FEATURE_DTYPES)
+
+def compute_customer_features(df, snapshot_date):
+    """Computes every RFM and behavioral feature in one sorted pass over NumPy arrays."""
+    snapshot_ns = pd.Timestamp(snapshot_date).value
+    codes, dates, order, customers, starts, ends = sort_transactions(df['CustomerID'], df['TransactionDate'])
+    amounts = df['Amount'].to_numpy(dtype=np.float64)[order]
+
+    count = ends - starts
+    amount_sum = np.add.reduceat(amounts, starts)
+    mean = amount_sum / count
+    # Squared deviations are computed in place to keep peak memory at one float column
+    amounts -= np.repeat(mean, count)
+    amounts *= amounts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        volatility = np.sqrt(np.add.reduceat(amounts, starts) / (count - 1))
+        interpurchase = np.add.reduceat(interpurchase_gaps(codes, dates), starts) / (count - 1)
+    del amounts
+
+    features = pd.DataFrame({
+        'CustomerID': customers,
+        'Recency': (snapshot_ns - dates[ends - 1]) // DAY_NS,
+        'Frequency': count,
+        'MonetaryValue': amount_sum,
+        'AvgOrderValue': mean,
+        'SpendingVolatility': volatility,
+        'UniqueProducts': distinct_counts(codes, df['UnitPrice'].to_numpy(dtype=np.float64)[order], len(customers)),
+        'CustomerTenure': (snapshot_ns - dates[starts]) // DAY_NS,
+        'AvgInterpurchaseTime': interpurchase,
+    })
+    return finalize_features(features)
+
+def compute_snapshot_features(df, snapshot_dates, windows_days):
+    """Point-in-time features at every snapshot date plus forward spend targets, from one sorted pass.
+
+    Rows are sorted by (customer, date) once and turned into per-customer running
+    totals; a customer's features at cutoff c are read off its last row dated
+    <= c (one searchsorted per cutoff) and CLV_<w>_days is its spend in
+    (c, c + w days].
+    Returns one row per (CustomerID, snapshot_date) for customers with a
+    purchase by the cutoff, with the same values compute_customer_features gives.
+    """
+    snapshots = pd.DatetimeIndex(sorted(set(pd.to_datetime(snapshot_dates))))
+    if len(snapshots) == 0:
+        raise ValueError("compute_snapshot_features needs at least one snapshot date")
+    codes, dates, order, customers, starts, ends = sort_transactions(df['CustomerID'], df['TransactionDate'])
+    amounts = df['Amount'].to_numpy(dtype=np.float64)[order]
+    prices = df['UnitPrice'].to_numpy(dtype=np.float64)[order]
+
+    def running_total(values):
+        # Restarted per customer rather than one global cumsum, so no total is a difference of large sums
+        return pd.Series(values).groupby(codes, sort=False).cumsum().to_numpy()
+
+    amount_total = running_total(amounts)
+    # Shifting by each customer's first amount keeps the sum-of-squares variance from cancelling
+    amounts -= np.repeat(amounts[starts], ends - starts)
+    shifted_total, squared_total = running_total(amounts), running_total(amounts * amounts)
+    del amounts
+    gap_total = running_total(interpurchase_gaps(codes, dates))
+    # Each (customer, 2-decimal price) counts once, on its earliest row
+    keys = (codes.astype(np.int64) << 32) | np.round(prices * 100).astype(np.int64)
+    first_seen = np.zeros(len(keys), dtype=np.int64)
+    first_seen[np.unique(keys, return_index=True)[1]] = 1
+    distinct_total = running_total(first_seen)
+    del keys, first_seen, prices
+
+    # Each row is keyed by (customer, number of cutoff/window-end times before it); the keys are
+    # sorted with the rows, so each customer's rows up to any of those times are one search away
+    cutoffs = snapshots.asi8
+    times = np.unique(np.concatenate([cutoffs] + [cutoffs + w * DAY_NS for w in windows_days]))
+    row_keys = codes.astype(np.int64) * (len(times) + 1) + np.searchsorted(times, dates, side='left')
+    customer_keys = np.arange(len(customers), dtype=np.int64) * (len(times) + 1)
+
+    def rows_through(time_ns):
+        """End offset (exclusive) of each customer's rows dated <= time_ns."""
+        return np.searchsorted(row_keys, customer_keys + np.searchsorted(times, time_ns), side='right')
+
+    # Columns are gathered per snapshot and concatenated once; concatenating DataFrames re-matches the categories
+    per_snapshot = []
+    for cutoff in cutoffs:
+        end = rows_through(cutoff)
+        known = end > starts
+        start, last = starts[known], end[known] - 1
+        count = last - start + 1
+        amount_sum, shifted_sum = amount_total[last], shifted_total[last]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = np.maximum(squared_total[last] - shifted_sum * shifted_sum / count, 0)
+            volatility = np.sqrt(variance / (count - 1))
+            interpurchase = gap_total[last] / (count - 1)
+        columns = {
+            'CustomerID': np.flatnonzero(known),
+            'snapshot_date': np.full(len(last), cutoff),
+            'Recency': (cutoff - dates[last]) // DAY_NS,
+            'Frequency': count,
+            'MonetaryValue': amount_sum,
+            'AvgOrderValue': amount_sum / count,
+            'SpendingVolatility': volatility,
+            'UniqueProducts': distinct_total[last],
+            'CustomerTenure': (cutoff - dates[start]) // DAY_NS,
+            'AvgInterpurchaseTime': interpurchase,
+        }
+        for w in windows_days:
+            columns[f'CLV_{w}_days'] = amount_total[rows_through(cutoff + w * DAY_NS)[known] - 1] - amount_sum
+        per_snapshot.append(columns)
+
+    features = pd.DataFrame({name: np.concatenate([columns[name] for columns in per_snapshot]) for name in per_snapshot[0]})
+    features['CustomerID'] = pd.Categorical.from_codes(features['CustomerID'], categories=customers)
+    features['snapshot_date'] = features['snapshot_date'].astype('datetime64[ns]')
+    return finalize_features(features)
+
+def repeat_purchase_summary(customer_ids, transaction_dates, amounts, observation_period_end=None):
+    """frequency/recency/T/monetary_value per customer from one sorted pass, as lifetimes computes them.
+
+    Purchases are grouped by calendar day: frequency counts the days with a
+    purchase after the first one, recency and T are measured in days from the
+    first purchase day, and monetary_value is the mean daily spend over the
+    repeat days (0 for customers without any).
+    """
+    dates_ns = np.asarray(transaction_dates, dtype='datetime64[ns]').view(np.int64)
+    end_day = (dates_ns.max() if observation_period_end is None else pd.Timestamp(observation_period_end).value) // DAY_NS
+    keep = dates_ns // DAY_NS <= end_day
+    if not keep.all():
+        customer_ids = pd.Series(customer_ids)[keep]
+        transaction_dates, amounts = np.asarray(transaction_dates)[keep], np.asarray(amounts)[keep]
+    codes, dates, order, customers, starts, ends = sort_transactions(pd.Series(customer_ids), transaction_dates)
+    amounts = np.asarray(amounts, dtype=np.float64)[order]
+    days = dates // DAY_NS
+
+    # One row per (customer, day) with the day's total spend
+    new_day = np.r_[True, (codes[1:] != codes[:-1]) | (days[1:] != days[:-1])]
+    day_starts = np.flatnonzero(new_day)
+    day_codes, day_values = codes[day_starts], days[day_starts]
+    day_spend = np.add.reduceat(amounts, day_starts)
+
+    first_row = np.searchsorted(day_codes, np.arange(len(customers)), side='left')
+    last_row = np.r_[first_row[1:], len(day_codes)] - 1
+    frequency = (last_row - first_row).astype(np.float64)
+    first_day = day_values[first_row]
+    repeat_spend = np.add.reduceat(day_spend, first_row) - day_spend[first_row]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        monetary_value = np.where(frequency > 0, repeat_spend / frequency, 0.0)
+
+    return pd.DataFrame({
+        'frequency': frequency,
+        'recency': (day_values[last_row] - first_day).astype(np.float64),
+        'T': (end_day - first_day).astype(np.float64),
+        'monetary_value': monetary_value,
+    }, index=pd.Index(customers, name='CustomerID'))
@@ -0,0 +1,222 @@
+import pandas as pd
+import numpy as np
+from datetime import datetime
+import json
+import os
+import shutil
+import threading
+import time
+from src.utils_io import load_config
+
+CONFIG = load_config()
+
+CURRENT_FILE = "CURRENT"
+SNAPSHOT_DIR = "snapshots"
+EMPTY_SLOT = -1
+
+def _store_root(store_root=None):
+    return store_root or CONFIG['data']['feature_store_path']
+
+def _hash_ids(customer_ids):
+    """Stable 64-bit hash of CustomerIDs, identical in every process."""
+    return pd.util.hash_array(np.asarray(customer_ids, dtype=object))
+
+# ------------------
+# Writer
+# ------------------
+def _build_index(hashes):
+    """Builds an open-addressing (linear probing) table mapping hash -> row, at most half full."""
+    size = 1 << max(1, int(2 * len(hashes) - 1).bit_length())
+    mask = np.uint64(size - 1)
+    slot_rows = np.full(size, EMPTY_SLOT, dtype=np.int64)
+    slot_hashes = np.zeros(size, dtype=np.uint64)
+
+    pending = np.arange(len(hashes))
+    probes = np.zeros(len(hashes), dtype=np.uint64)
+    max_probe = 0
+    while pending.size:
+        slots = ((hashes[pending] + probes[pending]) & mask).astype(np.int64)
+        free = slot_rows[slots] == EMPTY_SLOT
+        # Several keys may want the same free slot in one round; the first one wins it
+        _, first = np.unique(slots[free], return_index=True)
+        winners = np.flatnonzero(free)[first]
+        placed = pending[winners]
+        slot_rows[slots[winners]] = placed
+        slot_hashes[slots[winners]] = hashes[placed]
+        max_probe = max(max_probe, int(probes[placed].max(initial=0)))
+
+        losers = np.ones(pending.size, dtype=bool)
+        losers[winners] = False
+        pending = pending[losers]
+        probes[pending] += np.uint64(1)
+    return slot_hashes, slot_rows, max_probe
+
+def write_snapshot(df, store_root=None):
+    """Publishes a feature DataFrame as a new read-only snapshot and makes it current atomically."""
+    store_root = _store_root(store_root)
+    # Fixed-width time to the nanosecond, so versions sort chronologically even within one second
+    now_ns = time.time_ns()
+    version = f"{datetime.fromtimestamp(now_ns // 10**9):%Y%m%dT%H%M%S}-{now_ns % 10**9:09d}"
+    snapshot_path = os.path.join(store_root, SNAPSHOT_DIR, version)
+    tmp_path = snapshot_path + ".tmp"
+    os.makedirs(tmp_path)
+
+    ids = df['CustomerID'].astype(str).to_numpy()
+    columns = [c for c in df.columns if c != 'CustomerID']
+    # One C-contiguous row per customer, so a lookup gathers whole rows
+    matrix = np.ascontiguousarray(df[columns].to_numpy(dtype=np.float64))
+    slot_hashes, slot_rows, max_probe = _build_index(_hash_ids(ids))
+
+    np.save(os.path.join(tmp_path, "features.npy"), matrix)
+    np.save(os.path.join(tmp_path, "ids.npy"), ids.astype(str))
+    np.save(os.path.join(tmp_path, "index_hashes.npy"), slot_hashes)
+    np.save(os.path.join(tmp_path, "index_rows.npy"), slot_rows)
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+        json.dump({'version': version, 'columns': columns, 'rows': len(ids), 'max_probe': max_probe}, f)
+    os.rename(tmp_path, snapshot_path)
+
+    current_path = os.path.join(store_root, CURRENT_FILE)
+    with open(current_path + ".tmp", 'w') as f:
+        f.write(version)
+    os.replace(current_path + ".tmp", current_path)
+    print(f"Feature store snapshot '{version}' published ({len(ids)} customers).")
+
+    _prune_snapshots(store_root, keep=CONFIG['feature_store']['keep_snapshots'])
+    return version
+
+def _prune_snapshots(store_root, keep):
+    """Deletes all but the newest snapshots; readers still mapping them keep their pages."""
+    snapshots_path = os.path.join(store_root, SNAPSHOT_DIR)
+    versions = sorted(v for v in os.listdir(snapshots_path) if not v.endswith(".tmp"))
+    for version in versions[:-keep]:
+        shutil.rmtree(os.path.join(snapshots_path, version), ignore_errors=True)
+
+def current_version(store_root=None):
+    """Reads the version name of the current snapshot, or None before the first build."""
+    current_path = os.path.join(_store_root(store_root), CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path, 'r') as f:
+        return f.read().strip()
+
+# ------------------
+# Reader
+# ------------------
+class FeatureSnapshot:
+    """One immutable, memory-mapped snapshot. Pages are shared by every process mapping it."""
+
+    def __init__(self, snapshot_path):
+        with open(os.path.join(snapshot_path, "meta.json"), 'r') as f:
+            meta = json.load(f)
+        self.version = meta['version']
+        self.columns = meta['columns']
+        self.column_index = {c: i for i, c in enumerate(self.columns)}
+        self.max_probe = meta['max_probe']
+        self.matrix = np.load(os.path.join(snapshot_path, "features.npy"), mmap_mode='r')
+        self.ids = np.load(os.path.join(snapshot_path, "ids.npy"), mmap_mode='r')
+        self.slot_hashes = np.load(os.path.join(snapshot_path, "index_hashes.npy"), mmap_mode='r')
+        self.slot_rows = np.load(os.path.join(snapshot_path, "index_rows.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows_for(self, customer_ids):
+        """Maps CustomerIDs to row numbers (-1 when unknown) with O(1) expected probes each."""
+        requested = np.asarray(customer_ids, dtype=str)
+        hashes = _hash_ids(requested)
+        mask = np.uint64(len(self.slot_rows) - 1)
+        rows = np.full(len(requested), EMPTY_SLOT, dtype=np.int64)
+
+        active = np.arange(len(requested))
+        for probe in range(self.max_probe + 1):
+            slots = ((hashes[active] + np.uint64(probe)) & mask).astype(np.int64)
+            candidate = self.slot_rows[slots]
+            occupied = candidate != EMPTY_SLOT
+            hit = occupied & (self.slot_hashes[slots] == hashes[active])
+            # Confirm hash matches against the stored ID to rule out collisions
+            hit[hit] = self.ids[candidate[hit]] == requested[active[hit]]
+            rows[active[hit]] = candidate[hit]
+            active = active[occupied & ~hit]
+            if not active.size:
+                break
+        return rows
+
+    def lookup(self, customer_ids, columns=None):
+        """Returns a contiguous (n_customers, n_columns) feature matrix; raises KeyError for unknown IDs."""
+        rows = self.rows_for(customer_ids)
+        if (rows == EMPTY_SLOT).any():
+            missing = [c for c, r in zip(customer_ids, rows) if r == EMPTY_SLOT]
+            raise KeyError(f"Unknown customer_ids: {missing[:10]}")
+        if columns is None:
+            return self.matrix[rows]
+        return self.matrix[np.ix_(rows, [self.column_index[c] for c in columns])]
+
+    def lookup_frame(self, customer_ids, columns=None):
+        """lookup() as a DataFrame indexed by CustomerID, for pandas-based callers."""
+        return pd.DataFrame(
+            self.lookup(customer_ids, columns),
+            index=pd.Index(customer_ids, name='CustomerID'),
+            columns=columns or self.columns,
+        )
+
+class FeatureStore:
+    """Serves the current snapshot and hot-swaps to a newly published one without a restart.
+
+    Callers grab `snapshot()` once per request; a swap only replaces the reference,
+    so requests already holding the previous snapshot finish against it.
+    """
+
+    def __init__(self, store_root=None, required_columns=None, reload_interval=None):
+        self.store_root = _store_root(store_root)
+        self.required_columns = list(required_columns or [])
+        self.reload_interval = reload_interval if reload_interval is not None else CONFIG['feature_store']['reload_interval_seconds']
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._skipped_version = None
+        self._last_check = 0.0
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """Swaps in the current snapshot if it changed; checks the pointer at most every reload_interval."""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.reload_interval:
+            return False
+        with self._lock:
+            self._last_check = now
+            version = current_version(self.store_root)
+            if version is None or version == self._skipped_version:
+                return False
+            if self._snapshot is not None and self._snapshot.version == version:
+                return False
+            snapshot = FeatureSnapshot(os.path.join(self.store_root, SNAPSHOT_DIR, version))
+            missing = set(self.required_columns) - set(snapshot.columns)
+            if missing:
+                # e.g. build_feature_set has run but probabilistic features are not added yet
+                print(f"Skipping feature snapshot '{version}': missing columns {sorted(missing)}")
+                self._skipped_version = version
+                if self._snapshot is not None:
+                    return False
+                # Nothing is being served yet, so start from the newest complete snapshot instead
+                snapshot = self._latest_complete_snapshot()
+                if snapshot is None:
+                    return False
+            self._snapshot = snapshot
+        print(f"Serving feature snapshot '{snapshot.version}' ({len(snapshot)} customers).")
+        return True
+
+    def _latest_complete_snapshot(self):
+        snapshots_path = os.path.join(self.store_root, SNAPSHOT_DIR)
+        for version in sorted(os.listdir(snapshots_path), reverse=True):
+            if version.endswith(".tmp") or version == self._skipped_version:
+                continue
+            snapshot = FeatureSnapshot(os.path.join(snapshots_path, version))
+            if set(self.required_columns) <= set(snapshot.columns):
+                return snapshot
+        return None
+
+    def snapshot(self):
+        """The snapshot to use for one request."""
+        self.refresh()
+        if self._snapshot is None:
+            raise FileNotFoundError(f"No feature snapshot found in '{self.store_root}'. Run `make features` first.")
+        return self._snapshot
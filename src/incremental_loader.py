@@ -1,63 +1,136 @@
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
 import os
-import great_expectations as gx
+import time
 from src.utils_io import load_config, get_watermark, set_watermark
+from src import raw_store
+from src.validation import TransactionValidator, validate_frame, validate_with_great_expectations
+from src.instrumentation import instrumented
 
 CONFIG = load_config()
 
-def generate_synthetic_data(num_customers=500, num_transactions=20000):
-    """Generates and appends realistic synthetic data if needed."""
-    seed = CONFIG['seeds']['data_generation_seed']
-    np.random.seed(seed)
-    
-    output_path = CONFIG['data']['raw_path']
-    if os.path.exists(output_path):
+TRANSACTION_COLUMNS = ['CustomerID', 'TransactionDate', 'Quantity', 'UnitPrice', 'Amount']
+
+def _draw_purchase_rates(rng, num_customers, rate_config):
+    """Draws a relative purchase rate for every customer."""
+    distribution = rate_config.get('distribution', 'uniform')
+    if distribution == 'uniform':
+        return np.ones(num_customers)
+    if distribution == 'gamma':
+        return rng.gamma(rate_config.get('shape', 1.0), rate_config.get('scale', 1.0), size=num_customers)
+    if distribution == 'lognormal':
+        return rng.lognormal(0.0, rate_config.get('sigma', 1.0), size=num_customers)
+    raise ValueError(f"Unknown purchase rate distribution: {distribution}")
+
+def generate_transaction_batches(num_customers, num_transactions, batch_size, seed=None, rate_config=None):
+    """Yields synthetic transactions as DataFrames of at most `batch_size` rows.
+
+    Every column is drawn from its own random stream, one uniform per row, so the
+    generated rows depend only on the seed and not on the batch size.
+    """
+    gen_config = CONFIG['data_generation']
+    if seed is None:
+        seed = CONFIG['seeds']['data_generation_seed']
+    if rate_config is None:
+        rate_config = gen_config['purchase_rate']
+
+    rate_seq, customer_seq, time_seq, quantity_seq, price_seq = np.random.SeedSequence(seed).spawn(5)
+    rates = _draw_purchase_rates(np.random.default_rng(rate_seq), num_customers, rate_config)
+    customer_cdf = np.cumsum(rates)
+    customer_cdf /= customer_cdf[-1]
+    customers = pd.Index([f"C{1000 + i}" for i in range(num_customers)])
+
+    customer_rng, time_rng, quantity_rng, price_rng = (
+        np.random.default_rng(s) for s in (customer_seq, time_seq, quantity_seq, price_seq)
+    )
+    start_date = np.datetime64(gen_config['start_date'], 'ns')
+    hours_per_day = 23 # Matches the 0-22 hour range of the original generator
+    num_slots = gen_config['num_days'] * hours_per_day
+
+    for offset in range(0, num_transactions, batch_size):
+        size = min(batch_size, num_transactions - offset)
+
+        codes = np.searchsorted(customer_cdf, customer_rng.random(size), side='right')
+        np.minimum(codes, num_customers - 1, out=codes)
+
+        slots = (time_rng.random(size) * num_slots).astype(np.int64)
+        days, hours = np.divmod(slots, hours_per_day)
+        transaction_dates = (
+            start_date
+            + days.astype('timedelta64[D]').astype('timedelta64[ns]')
+            + hours.astype('timedelta64[h]').astype('timedelta64[ns]')
+        )
+
+        quantity = 1 + (quantity_rng.random(size) * 9).astype(np.int64)
+        unit_price = np.round(5.0 + price_rng.random(size) * 145.0, 2)
+        amount = np.round(quantity * unit_price, 2)
+
+        yield pd.DataFrame({
+            'CustomerID': pd.Categorical.from_codes(codes, categories=customers),
+            'TransactionDate': transaction_dates,
+            'Quantity': quantity,
+            'UnitPrice': unit_price,
+            'Amount': amount,
+        }, columns=TRANSACTION_COLUMNS)
+
+def generate_synthetic_data(num_customers=None, num_transactions=None, batch_size=None):
+    """Generates realistic synthetic data batch by batch and streams it into the raw store if needed."""
+    gen_config = CONFIG['data_generation']
+    num_customers = num_customers or gen_config['num_customers']
+    num_transactions = num_transactions or gen_config['num_transactions']
+    batch_size = batch_size or gen_config['batch_size']
+
+    if raw_store.store_exists():
         print("Raw data already exists. Skipping generation.")
         return
 
-    print("Generating synthetic raw data...")
-    customers = [f"C{1000 + i}" for i in range(num_customers)]
-    data = []
-    start_date = datetime(2023, 1, 1)
-    
-    for _ in range(num_transactions):
-        customer_id = np.random.choice(customers)
-        transaction_date = start_date + timedelta(
-            days=np.random.randint(0, 690), 
-            hours=np.random.randint(0, 23)
-        )
-        # Add some quantity information
-        quantity = np.random.randint(1, 10)
-        unit_price = round(np.random.uniform(5.0, 150.0), 2)
-        amount = round(quantity * unit_price, 2)
-        
-        data.append([customer_id, transaction_date, quantity, unit_price, amount])
-    
-    df = pd.DataFrame(data, columns=['CustomerID', 'TransactionDate', 'Quantity', 'UnitPrice', 'Amount'])
-    df['TransactionDate'] = pd.to_datetime(df['TransactionDate'])
-    
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    df.to_csv(output_path, index=False)
-    print(f"Synthetic data saved to '{output_path}'")
+    # A raw CSV export from an earlier run (or a real dataset) takes precedence over synthetic data
+    raw_csv_path = CONFIG['data']['raw_path']
+    if os.path.exists(raw_csv_path):
+        validator = TransactionValidator() if CONFIG['validation']['engine'] == 'numpy' else None
+        raw_store.ingest_csv(raw_csv_path, chunksize=batch_size, validator=validator)
+        return
+
+    print(f"Generating {num_transactions} synthetic transactions for {num_customers} customers...")
+    # Batches go to a staging store published after the last one, so an interrupted run leaves no partial store
+    with raw_store.building_store() as staging_path:
+        for batch in generate_transaction_batches(num_customers, num_transactions, batch_size):
+            raw_store.append_transactions(batch, staging_path)
+    print(f"Synthetic data saved to '{CONFIG['data']['raw_store_path']}'")
 
 def validate_data(df):
-    """Validates the dataframe using Great Expectations."""
+    """Validates the dataframe against the expectation suite (NumPy checks or, optionally, Great Expectations)."""
     print("Validating data...")
-    ge_df = gx.from_pandas(df)
-    suite_path = CONFIG['data']['great_expectations_suite']
-    validation_result = ge_df.validate(expectation_suite=suite_path)
-    if not validation_result["success"]:
+    start = time.perf_counter()
+    if CONFIG['validation']['engine'] == 'great_expectations':
+        report = validate_with_great_expectations(df)
+    else:
+        report = validate_frame(df)
+    _check_report(report, start)
+
+def _check_report(report, start):
+    if not report["success"]:
         print("Data validation failed!")
         # In a real pipeline, you would raise an exception or send an alert
-        # For this example, we'll just print the failed expectations
-        for result in validation_result["results"]:
-            if not result["success"]:
-                print(result["expectation_config"]["kwargs"])
         raise ValueError("Data validation failed. Aborting.")
-    print("Data validation successful.")
+    print(f"Data validation successful ({report['rows']} rows in {time.perf_counter() - start:.3f}s).")
+
+@instrumented('validation.stream')
+def _read_and_validate(start):
+    """Reads the new transactions partition file by partition file, validating each as it arrives."""
+    print("Validating data...")
+    start_time = time.perf_counter()
+    validator = TransactionValidator()
+    chunks = []
+    for chunk in raw_store.iter_transactions(start=start):
+        validator.validate_chunk(chunk)
+        chunks.append(chunk)
+    if not chunks:
+        return None
+    _check_report(validator.print_report(), start_time)
+    return pd.concat(chunks, ignore_index=True)
 
+@instrumented('data.load')
 def load_new_data():
     """Loads, validates, and returns only new transactions since the last run."""
     generate_synthetic_data()
@@ -66,15 +139,17 @@ def load_new_data():
     last_run_timestamp = get_watermark(watermark_path)
     
     print(f"Loading data since last run at: {last_run_timestamp}")
-    df = pd.read_csv(CONFIG['data']['raw_path'], parse_dates=['TransactionDate'])
-    
-    new_data = df[df['TransactionDate'] > last_run_timestamp].copy()
+    # Only partitions holding rows newer than the watermark are opened
+    if CONFIG['validation']['engine'] == 'great_expectations':
+        new_data = raw_store.read_transactions(start=last_run_timestamp)
+        if not new_data.empty:
+            validate_data(new_data)
+    else:
+        new_data = _read_and_validate(last_run_timestamp)
     
-    if new_data.empty:
+    if new_data is None or new_data.empty:
         print("No new data to process.")
         return None
-        
-    validate_data(new_data)
     
     # Update watermark to the latest timestamp in the new data
     set_watermark(watermark_path, new_data['TransactionDate'].max())
@@ -1,19 +1,343 @@
-import mlflow
 import pandas as pd
-import joblib
+import importlib
+import json
+import os
+import shutil
+import threading
+import time
+from src.utils_io import load_config
+from src.labeler import segment_label_map, segment_label_lookup, num_segments, SEGMENT_LABELS_ARTIFACT
+from src.instrumentation import instrumented, timer
 
-# Load models and scaler from a production stage in MLflow
-clv_model = mlflow.lightgbm.load_model(f"models:/{CONFIG['models']['clv_model_name']}/Production")
-segmentation_model = mlflow.sklearn.load_model(f"models:/{CONFIG['models']['segmentation_model_name']}/Production")
-scaler = joblib.load("segmentation_scaler.pkl") # This needs to be saved from training
+CONFIG = load_config()
+
+# Features used for clustering, in the order the scaler was fitted on
+SEGMENTATION_FEATURES = ['Recency', 'Frequency', 'MonetaryValue', 'probabilistic_clv_90d']
+
+SCALER_ARTIFACT = "segmentation_scaler.pkl"
+PRODUCTION_FILE = "production.json" # Last Production versions resolved from the registry
+
+# ------------------
+# Registry access (MLflow is only imported here, on first use)
+# ------------------
+def _timed_import(module, timings):
+    start = time.perf_counter()
+    imported = importlib.import_module(module)
+    timings['import_seconds'] = timings.get('import_seconds', 0.0) + time.perf_counter() - start
+    return imported
+
+def _mlflow(timings):
+    mlflow = _timed_import('mlflow', timings)
+    mlflow.set_tracking_uri(CONFIG['mlflow']['tracking_uri'])
+    return mlflow
+
+def resolve_production_versions(timings=None):
+    """(CLV, segmentation) versions in Production; the last resolved ones if the registry is unreachable."""
+    timings = timings if timings is not None else {}
+    cache_dir = CONFIG['model_manager']['cache_dir']
+    pointer_path = os.path.join(cache_dir, PRODUCTION_FILE)
+    previous = None
+    if os.path.exists(pointer_path):
+        with open(pointer_path, 'r') as f:
+            previous = json.load(f)
+    try:
+        _mlflow(timings)
+        production_version = _timed_import('src.prediction_cache', timings).production_version
+        versions = {
+            'clv': production_version(CONFIG['models']['clv_model_name']),
+            'segmentation': production_version(CONFIG['models']['segmentation_model_name']),
+        }
+    except Exception as e:
+        if previous is None:
+            raise
+        print(f"Model registry unavailable ({e}); using the last resolved Production versions.")
+        versions = previous
+    if None in versions.values():
+        raise RuntimeError("No Production models in the registry. Promote them first (make promote-clv / promote-segment).")
+
+    if versions != previous:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(pointer_path + f".tmp{os.getpid()}", 'w') as f:
+            json.dump(versions, f)
+        os.replace(pointer_path + f".tmp{os.getpid()}", pointer_path)
+    return versions['clv'], versions['segmentation']
+
+# ------------------
+# Local model snapshots
+# ------------------
+def _snapshot_path(model_name, version):
+    return os.path.join(CONFIG['model_manager']['cache_dir'], model_name, str(version))
+
+def _download_model(model_name, version, path, timings):
+    mlflow = _mlflow(timings)
+    mlflow.artifacts.download_artifacts(artifact_uri=f"models:/{model_name}/{version}", dst_path=os.path.join(path, "model"))
+
+def _download_segmentation(model_name, version, path, timings):
+    _download_model(model_name, version, path, timings)
+    mlflow = _mlflow(timings)
+    client = mlflow.tracking.MlflowClient()
+    run = client.get_run(client.get_model_version(model_name, version).run_id)
+    try:
+        mlflow.artifacts.download_artifacts(run_id=run.info.run_id, artifact_path=SEGMENT_LABELS_ARTIFACT, dst_path=path)
+    except Exception:
+        pass # Models trained before labels were stored: derived when loading
+
+    # The scaler is logged on the comparison run that the registered candidate is nested in
+    for run_id in (run.info.run_id, run.data.tags.get('mlflow.parentRunId')):
+        if run_id is None:
+            continue
+        try:
+            mlflow.artifacts.download_artifacts(run_id=run_id, artifact_path=SCALER_ARTIFACT, dst_path=path)
+            return
+        except Exception:
+            continue
+    print(f"No {SCALER_ARTIFACT} logged for segmentation model version {version}; using the local '{SCALER_ARTIFACT}'.")
+    shutil.copy2(SCALER_ARTIFACT, os.path.join(path, SCALER_ARTIFACT))
+
+def ensure_snapshot(model_name, version, download, timings):
+    """Local directory holding one model version, downloaded from the registry only if it is not there yet."""
+    path = _snapshot_path(model_name, version)
+    if os.path.exists(path):
+        os.utime(path) # Marks it recently used for pruning
+        timings['source'] = 'local snapshot'
+        return path
+
+    start = time.perf_counter()
+    tmp_path = path + f".tmp{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    download(model_name, version, tmp_path, timings)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process published the same version first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    timings['source'] = 'registry'
+    timings['download_seconds'] = time.perf_counter() - start
+    _prune_snapshots(os.path.dirname(path), CONFIG['model_manager']['keep_versions'],
+                     in_use={str(version)} | _served_versions(model_name))
+    return path
+
+def _served_versions(model_name):
+    """Versions of `model_name` held by this process's model manager."""
+    models = MODELS._models
+    if models is None:
+        return set()
+    return {str(v) for name, v in [(CONFIG['models']['clv_model_name'], models.clv_version),
+                                   (CONFIG['models']['segmentation_model_name'], models.segmentation_version)]
+            if name == model_name}
+
+def _prune_snapshots(model_dir, keep, in_use=()):
+    """Deletes all but the `keep` most recently used versions, never one in `in_use`.
+
+    Recency rather than version number, so rolling Production back to an older
+    version does not delete the snapshot just downloaded for it.
+    """
+    versions = [v for v in os.listdir(model_dir) if v.isdigit()]
+    versions.sort(key=lambda v: os.path.getmtime(os.path.join(model_dir, v)), reverse=True)
+    for version in versions[keep:]:
+        if version not in in_use:
+            shutil.rmtree(os.path.join(model_dir, version), ignore_errors=True)
+
+# ------------------
+# Loading
+# ------------------
+def load_clv_model(model_version, timings=None):
+    """Loads the flat CLV trees when they were exported from this version, else the LightGBM model."""
+    timings = timings if timings is not None else {}
+    model_name = CONFIG['models']['clv_model_name']
+    flat_path = CONFIG['models']['clv_flat_model_path']
+    if CONFIG['serving']['flat_clv_model'] and os.path.exists(flat_path):
+        tree_export = _timed_import('src.tree_export', timings)
+        start = time.perf_counter()
+        flat_model = tree_export.load_flat_model(flat_path)
+        if str(flat_model.model_version) == model_version:
+            timings.update(source='flat arrays', load_seconds=time.perf_counter() - start)
+            return flat_model
+        print(f"Flat CLV model at '{flat_path}' is not the Production version; loading the LightGBM model.")
+
+    path = ensure_snapshot(model_name, model_version, _download_model, timings)
+    _timed_import('lightgbm', timings)
+    mlflow_lightgbm = _timed_import('mlflow.lightgbm', timings)
+    start = time.perf_counter()
+    model = mlflow_lightgbm.load_model(os.path.join(path, "model"))
+    timings['load_seconds'] = time.perf_counter() - start
+    return model
+
+def load_segmentation_model(model_version, timings=None):
+    """(model, scaler, cluster -> label map) of a segmentation model version, from its local snapshot."""
+    timings = timings if timings is not None else {}
+    path = ensure_snapshot(CONFIG['models']['segmentation_model_name'], model_version, _download_segmentation, timings)
+    mlflow_sklearn, joblib = _timed_import('mlflow.sklearn', timings), _timed_import('joblib', timings)
+    start = time.perf_counter()
+    model = mlflow_sklearn.load_model(os.path.join(path, "model"))
+    scaler = joblib.load(os.path.join(path, SCALER_ARTIFACT))
+    labels_path = os.path.join(path, SEGMENT_LABELS_ARTIFACT)
+    if os.path.exists(labels_path):
+        with open(labels_path, 'r') as f:
+            labels = {int(cluster): label for cluster, label in json.load(f).items()}
+    else:
+        # Models trained before labels were stored: derive them once from the full feature set
+        print(f"No {SEGMENT_LABELS_ARTIFACT} for segmentation model version {model_version}; deriving labels from all customers.")
+        df = pd.read_csv(CONFIG['data']['processed_path'])
+        labels = segment_label_map(df.assign(segment=model.predict(scaler.transform(df[SEGMENTATION_FEATURES]))),
+                                   num_clusters=num_segments(model))
+        with open(labels_path, 'w') as f:
+            json.dump({str(cluster): label for cluster, label in labels.items()}, f)
+    timings['load_seconds'] = time.perf_counter() - start
+    return model, scaler, labels
+
+class LoadedModels:
+    """One consistent set of Production models: the CLV model, the segmentation model, its scaler and labels."""
+
+    def __init__(self, clv_version, clv_model, segmentation_version, segmentation_model, scaler, segment_labels, timings):
+        self.clv_version = clv_version
+        self.clv_model = clv_model
+        self.segmentation_version = segmentation_version
+        self.segmentation_model = segmentation_model
+        self.scaler = scaler
+        self.segment_labels = segment_labels
+        self.segment_label_lookup = segment_label_lookup(segment_labels, num_segments(segmentation_model))
+        self.timings = timings
+
+    def clv_feature_names(self):
+        """Feature names the CLV model was trained on, in training order."""
+        if hasattr(self.clv_model, 'feature_name_'):
+            return list(self.clv_model.feature_name_)
+        return self.clv_model.feature_name()
+
+    def predict_clv(self, df_features):
+        """Predicts CLV for a dataframe of features."""
+        return self.clv_model.predict(df_features[self.clv_feature_names()])
+
+    def predict_clv_array(self, X):
+        """Predicts CLV for a NumPy matrix whose columns follow clv_feature_names()."""
+        with timer('inference.clv_predict'):
+            return self.clv_model.predict(X)
+
+    def predict_segment(self, df_features):
+        """Predicts segment for a dataframe of features."""
+        # Ensure only features used for clustering are passed and scaled
+        X_scaled = self.scaler.transform(df_features[SEGMENTATION_FEATURES])
+        return self.segmentation_model.predict(X_scaled)
+
+    def predict_segment_array(self, X):
+        """Predicts segments for a NumPy matrix whose columns follow SEGMENTATION_FEATURES."""
+        # Apply the fitted scaling directly; StandardScaler.transform re-validates its input on every call
+        with timer('inference.segment_scale'):
+            X_scaled = (X - self.scaler.mean_) / self.scaler.scale_
+        with timer('inference.segment_predict'):
+            return self.segmentation_model.predict(X_scaled)
+
+    def label_segments(self, segments):
+        """Business labels for an array of cluster IDs (one array lookup)."""
+        with timer('inference.segment_labels'):
+            return self.segment_label_lookup[segments]
+
+@instrumented('inference.load_models')
+def load_models(clv_version, segmentation_version, previous=None):
+    """Loads both models; a model whose version matches `previous` is reused rather than loaded again."""
+    start = time.perf_counter()
+    timings = {'clv': {}, 'segmentation': {}}
+    if previous is not None and previous.clv_version == clv_version:
+        clv_model, timings['clv'] = previous.clv_model, previous.timings['clv']
+    else:
+        clv_model = load_clv_model(clv_version, timings['clv'])
+    if previous is not None and previous.segmentation_version == segmentation_version:
+        segmentation = previous.segmentation_model, previous.scaler, previous.segment_labels
+        timings['segmentation'] = previous.timings['segmentation']
+    else:
+        segmentation = load_segmentation_model(segmentation_version, timings['segmentation'])
+    timings['total_seconds'] = time.perf_counter() - start
+    print(f"Loaded CLV model v{clv_version} ({timings['clv'].get('source')}) and segmentation model "
+          f"v{segmentation_version} ({timings['segmentation'].get('source')}) in {timings['total_seconds']:.2f}s")
+    return LoadedModels(clv_version, clv_model, segmentation_version, *segmentation, timings)
+
+# ------------------
+# Model manager
+# ------------------
+class ModelManager:
+    """Loads the Production models on first use and hot-swaps to newly promoted versions without a restart.
+
+    Callers grab `models()` once per request; a swap only replaces the reference,
+    so requests already holding the previous models finish with them.
+    """
+
+    def __init__(self, poll_interval=None):
+        self.poll_interval = poll_interval if poll_interval is not None else CONFIG['model_manager']['poll_interval_seconds']
+        self._lock = threading.Lock() # One load at a time
+        self._models = None
+        self._poller = None
+        self.swaps = 0
+        self.resolve_seconds = None
+
+    def models(self):
+        """The models to use for one request (loaded on the first call)."""
+        models = self._models
+        if models is None:
+            with self._lock:
+                if self._models is None:
+                    start = time.perf_counter()
+                    versions = resolve_production_versions()
+                    self.resolve_seconds = time.perf_counter() - start
+                    self._models = load_models(*versions)
+                models = self._models
+        return models
+
+    def refresh(self):
+        """Swaps in the Production versions if they changed since the models in use were loaded."""
+        if self._models is None:
+            return False # Nothing loaded yet; the first models() call resolves the current versions
+        versions = resolve_production_versions()
+        with self._lock:
+            current = self._models
+            if versions == (current.clv_version, current.segmentation_version):
+                return False
+            self._models = load_models(*versions, previous=current)
+            self.swaps += 1
+        print(f"Swapped to CLV model v{versions[0]} and segmentation model v{versions[1]}.")
+        return True
+
+    def start_polling(self):
+        """Checks the registry for a newly promoted version every poll_interval seconds in a daemon thread."""
+        if self._poller is not None or not self.poll_interval:
+            return
+        self._poller = threading.Thread(target=self._poll, name="model-poller", daemon=True)
+        self._poller.start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Model registry poll failed: {e}")
+
+    def info(self):
+        """Versions in use, swap count and import/load timings."""
+        info = {'resolve_seconds': self.resolve_seconds, 'swaps': self.swaps, 'loaded': self._models is not None}
+        if self._models is not None:
+            info.update(clv_version=self._models.clv_version, segmentation_version=self._models.segmentation_version,
+                        timings=self._models.timings)
+        return info
+
+# Shared by the API and batch scoring; nothing is loaded until the first prediction
+MODELS = ModelManager()
+
+def clv_feature_names():
+    return MODELS.models().clv_feature_names()
 
 def predict_clv(df_features):
-    """Predicts CLV for a dataframe of features."""
-    return clv_model.predict(df_features)
+    return MODELS.models().predict_clv(df_features)
+
+def predict_clv_array(X):
+    return MODELS.models().predict_clv_array(X)
 
 def predict_segment(df_features):
-    """Predicts segment for a dataframe of features."""
-    # Ensure only features used for clustering are passed and scaled
-    cluster_features = ['Recency', 'Frequency', 'MonetaryValue', 'probabilistic_clv_90d']
-    X_scaled = scaler.transform(df_features[cluster_features])
-    return segmentation_model.predict(X_scaled)
\ No newline at end of file
+    return MODELS.models().predict_segment(df_features)
+
+def predict_segment_array(X):
+    return MODELS.models().predict_segment_array(X)
+
+def label_segments(segments):
+    return MODELS.models().label_segments(segments)
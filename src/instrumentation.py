@@ -0,0 +1,248 @@
+import bisect
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import functools
+import os
+import resource
+import sys
+import threading
+import time
+from src.utils_io import load_config
+
+CONFIG = load_config()
+
+# Seconds; spans micro-batched API scoring up to full pipeline steps
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# ------------------
+# Metrics (Prometheus text exposition format)
+# ------------------
+def _labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+class Histogram:
+    """Latency histogram per label set, with Prometheus' cumulative `le` buckets."""
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {} # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+        for label_values, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else repr(float(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, label_values, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, label_values)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, label_values)} {count}")
+        return lines
+
+    def summary(self):
+        """{label values: (count, total seconds)}."""
+        with self._lock:
+            return {labels: (count, total) for labels, (_, total, count) in self._series.items()}
+
+class Gauge:
+    """Last value set per label set."""
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_values, value in sorted(dict(self._values).items()):
+            lines.append(f"{self.name}{_labels(self.label_names, label_values)} {value}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """All metrics of this process in the Prometheus text format."""
+        return "\n".join(line for metric in self.metrics for line in metric.expose()) + "\n"
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.register(Histogram('clv_stage_seconds', "Time spent in an instrumented stage", ['stage']))
+STAGE_RSS = REGISTRY.register(Gauge('clv_stage_rss_bytes', "Resident memory at the end of the stage's last run", ['stage']))
+STAGE_PEAK_RSS = REGISTRY.register(Gauge('clv_stage_peak_rss_bytes', "Process peak resident memory at the end of the stage's last run", ['stage']))
+REQUEST_SECONDS = REGISTRY.register(Histogram('clv_request_seconds', "API request latency (to the first byte for streamed responses)", ['endpoint', 'status']))
+
+# ------------------
+# Timers and memory probes
+# ------------------
+def rss_bytes():
+    """Current resident memory of this process (Linux), else its peak."""
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+def peak_rss_bytes():
+    """Peak resident memory of this process since start or the last reset_peak_rss()."""
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # ru_maxrss is in KiB on Linux
+
+def reset_peak_rss():
+    """Restarts peak tracking at the current RSS (Linux 4.0+), so a step's own peak can be measured."""
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def record(stage, seconds):
+    """Adds a duration measured by the caller (e.g. time spent queued) to clv_stage_seconds."""
+    if CONFIG['instrumentation']['enabled']:
+        STAGE_SECONDS.observe(seconds, stage)
+
+@contextmanager
+def timer(stage, memory=False, log=False):
+    """Records the block's duration in clv_stage_seconds; `memory` also probes RSS, `log` prints both."""
+    if not CONFIG['instrumentation']['enabled']:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage)
+        message = f"[timing] {stage}: {seconds:.3f}s"
+        if memory:
+            rss, peak = rss_bytes(), peak_rss_bytes()
+            STAGE_RSS.set(rss, stage)
+            STAGE_PEAK_RSS.set(peak, stage)
+            message += f", RSS {rss / 2**20:.0f} MB (peak {peak / 2**20:.0f} MB)"
+        if log:
+            print(message)
+
+def instrumented(stage):
+    """Decorator for pipeline steps: logs time and memory, and profiles the call when profiling is requested."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with pipeline_profile(stage), timer(stage, memory=True, log=True):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def print_stage_report():
+    """Count and total time of every stage timed in this process, slowest first."""
+    rows = sorted(STAGE_SECONDS.summary().items(), key=lambda item: -item[1][1])
+    print(f"{'stage':<32} {'calls':>6} {'total s':>9} {'mean ms':>9}")
+    for (stage,), (count, total) in rows:
+        print(f"{stage:<32} {count:>6} {total:>9.3f} {1e3 * total / count:>9.3f}")
+
+# ------------------
+# Sampling profiler
+# ------------------
+class SamplingProfiler:
+    """Samples the Python stacks of the given threads every `interval` seconds from a background thread.
+
+    write() emits the folded-stack format (one "frame;frame;... count" line per
+    distinct stack) read by flamegraph.pl, speedscope and inferno.
+    """
+
+    def __init__(self, thread_ids=None, interval=None):
+        self.thread_ids = list(thread_ids or [threading.get_ident()])
+        self.interval = interval or CONFIG['instrumentation']['profile_interval_ms'] / 1000.0
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in self.thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+_active_profile = threading.local()
+
+@contextmanager
+def profiled(name, thread_ids=None):
+    """Samples the block and writes <profile_dir>/<name>-<timestamp>.folded; nested calls join the outer profile."""
+    if getattr(_active_profile, 'profiler', None) is not None:
+        yield _active_profile.profiler
+        return
+    profiler = _active_profile.profiler = SamplingProfiler(thread_ids).start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active_profile.profiler = None
+        path = os.path.join(CONFIG['instrumentation']['profile_dir'], f"{name}-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.folded")
+        profiler.write(path)
+        print(f"Profile of '{name}' ({profiler.samples} samples) written to '{path}'")
+
+def pipeline_profile(name):
+    """Profiles the block if profile_pipeline is set or CLV_PROFILE=1, else does nothing."""
+    if CONFIG['instrumentation']['profile_pipeline'] or os.environ.get('CLV_PROFILE') == '1':
+        return profiled(name)
+    return nullcontext()
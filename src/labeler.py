@@ -1,8 +1,20 @@
 import pandas as pd
+import numpy as np
 
-def assign_segment_labels(df_with_clusters, cluster_col='segment'):
-    """Assigns business-friendly labels to numeric cluster IDs."""
-    
+# Artifact of the segmentation model's run holding its cluster -> label map
+SEGMENT_LABELS_ARTIFACT = "segment_labels.json"
+
+def num_segments(model):
+    """Number of clusters a KMeans/MiniBatchKMeans (n_clusters) or GMM (n_components) can predict."""
+    return getattr(model, 'n_clusters', None) or getattr(model, 'n_components', None)
+
+def segment_label_map(df_with_clusters, cluster_col='segment', num_clusters=None):
+    """Derives the cluster -> business label mapping from cluster centroids.
+
+    Meant to run once at training time on the full population; serving looks
+    the labels up with segment_label_lookup instead of recomputing centroids.
+    Clusters below `num_clusters` that no customer falls into are labelled "Unknown".
+    """
     # Calculate centroids to understand cluster characteristics
     centroids = df_with_clusters.groupby(cluster_col).agg({
         'Recency': 'mean',
@@ -14,7 +26,7 @@ def assign_segment_labels(df_with_clusters, cluster_col='segment'):
     # Order centroids by CLV to assign labels logically
     # Higher CLV -> 'Champion', Lower Recency -> Better
     centroids = centroids.sort_values(by='probabilistic_clv_90d', ascending=False)
-    
+
     if len(centroids) == 3:
         labels = ["High-Value Champion", "Potential Loyalist", "At-Risk/New"]
     elif len(centroids) == 4:
@@ -22,8 +34,28 @@ def assign_segment_labels(df_with_clusters, cluster_col='segment'):
     else: # Default for other k values
         labels = [f"Segment {i}" for i in range(len(centroids))]
 
-    label_map = {row[cluster_col]: labels[i] for i, row in centroids.iterrows()}
-    
+    # Labels follow the CLV rank, not the cluster's position before sorting
+    label_map = {int(cluster): labels[rank] for rank, cluster in enumerate(centroids[cluster_col])}
+    for cluster in range(num_clusters or 0):
+        label_map.setdefault(cluster, "Unknown")
+    return dict(sorted(label_map.items()))
+
+def segment_label_lookup(label_map, num_clusters=None):
+    """Array indexed by cluster ID, so labelling a batch is a single gather.
+
+    Sized by the model's cluster count, since a cluster without training customers
+    (e.g. an empty GMM component) may still be predicted; it reads "Unknown".
+    """
+    size = max(num_clusters or 0, max(label_map, default=-1) + 1)
+    lookup = np.full(size, "Unknown", dtype=object)
+    lookup[list(label_map)] = list(label_map.values())
+    return lookup
+
+def assign_segment_labels(df_with_clusters, cluster_col='segment', label_map=None):
+    """Assigns business-friendly labels to numeric cluster IDs."""
+    if label_map is None:
+        label_map = segment_label_map(df_with_clusters, cluster_col)
+
     df_with_clusters['segment_label'] = df_with_clusters[cluster_col].map(label_map)
     
-    return df_with_clusters, label_map
\ No newline at end of file
+    return df_with_clusters, label_map
@@ -0,0 +1,217 @@
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import json
+import os
+import tempfile
+import time
+import mlflow
+from src.utils_io import load_config
+from src import raw_store, feature_store
+from src.feature_engineering import FEATURE_SOURCE_COLUMNS
+from src.feature_kernel import compute_customer_features
+from src.probabilistic import (
+    probabilistic_cutoff, summarize_transactions, fit_models,
+    fitters_from_params, predict_probabilistic_features, log_probabilistic_models, PROBABILISTIC_FEATURES,
+)
+
+CONFIG = load_config()
+
+# Shard columns and per-shard results are exchanged as memory-mapped .npy files; only paths are pickled
+SHARD_COLUMNS = {'CustomerID': 'codes', 'TransactionDate': 'dates', 'UnitPrice': 'unit_price', 'Amount': 'amount'}
+
+def shard_of_customers(customer_ids, n_shards):
+    """Stable hash partition of CustomerIDs (identical across processes and runs)."""
+    return (pd.util.hash_array(np.asarray(customer_ids, dtype=object)) % np.uint64(n_shards)).astype(np.int64)
+
+def write_shards(df, n_shards, shard_root):
+    """Splits transactions by hashed CustomerID into one directory of .npy columns per shard.
+
+    Workers see customers as integer codes into the returned Index, so no
+    strings cross the process boundary.
+    """
+    ids = df['CustomerID'].astype('category')
+    customers = ids.cat.categories
+    codes = ids.cat.codes.to_numpy().astype(np.int32)
+    columns = {
+        'codes': codes,
+        'dates': df['TransactionDate'].to_numpy(dtype='datetime64[ns]').view(np.int64),
+        'unit_price': df['UnitPrice'].to_numpy(dtype=np.float64),
+        'amount': df['Amount'].to_numpy(dtype=np.float64),
+    }
+
+    row_shard = shard_of_customers(customers, n_shards)[codes]
+    order = np.argsort(row_shard, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(row_shard, minlength=n_shards))]
+
+    shard_dirs = []
+    for shard in range(n_shards):
+        shard_dir = os.path.join(shard_root, f"shard-{shard:03d}")
+        os.makedirs(shard_dir)
+        rows = order[bounds[shard]:bounds[shard + 1]]
+        for name, values in columns.items():
+            np.save(os.path.join(shard_dir, f"{name}.npy"), values[rows])
+        shard_dirs.append(shard_dir)
+    return customers, shard_dirs
+
+def _load_shard(shard_dir):
+    arrays = {col: np.load(os.path.join(shard_dir, f"{name}.npy"), mmap_mode='r') for col, name in SHARD_COLUMNS.items()}
+    arrays['TransactionDate'] = arrays['TransactionDate'].view('datetime64[ns]')
+    return pd.DataFrame(arrays)
+
+def _save_frame(df, shard_dir, name):
+    """Writes a numeric DataFrame next to the shard columns as one .npy file per column."""
+    for column in df.columns:
+        np.save(os.path.join(shard_dir, f"{name}.{column}.npy"), df[column].to_numpy())
+    with open(os.path.join(shard_dir, f"{name}.json"), 'w') as f:
+        json.dump(list(df.columns), f)
+
+def _load_frame(shard_dir, name):
+    """Memory-maps a frame written by _save_frame, or returns None if the shard has none."""
+    columns_path = os.path.join(shard_dir, f"{name}.json")
+    if not os.path.exists(columns_path):
+        return None
+    with open(columns_path, 'r') as f:
+        columns = json.load(f)
+    return pd.DataFrame({c: np.load(os.path.join(shard_dir, f"{name}.{c}.npy"), mmap_mode='r') for c in columns})
+
+def _shard_features(shard_dir, train_end_date, prob_cutoff, observation_period_end):
+    """Worker: RFM/behavioral features, the CLV target and the lifetimes summary for one shard.
+
+    Results are written into the shard directory; only the CPU time goes back.
+    A shard without transactions before a cutoff writes nothing for it.
+    """
+    start = time.process_time() # CPU time, so time-slicing on busy cores does not inflate it
+    df = _load_shard(shard_dir)
+
+    before_cutoff = df['TransactionDate'] <= train_end_date
+    if before_cutoff.any():
+        features = compute_customer_features(df[before_cutoff], train_end_date)
+        features['CustomerID'] = features['CustomerID'].astype(np.int64)
+        clv_target = df[~before_cutoff].groupby('CustomerID')['Amount'].sum().rename('CLV_90_days')
+        features = features.merge(clv_target, left_on='CustomerID', right_index=True, how='left')
+        _save_frame(features, shard_dir, "features")
+
+    prob_df = df[df['TransactionDate'] <= prob_cutoff]
+    if not prob_df.empty:
+        _save_frame(summarize_transactions(prob_df, observation_period_end).reset_index(), shard_dir, "summary")
+    return time.process_time() - start
+
+def _shard_predictions(shard_dir, bg_params, gg_params):
+    """Worker: scores one shard's summary with the centrally fitted model parameters, written next to it."""
+    start = time.process_time()
+    summary = _load_frame(shard_dir, "summary")
+    if summary is not None:
+        bgf, ggf = fitters_from_params(bg_params, gg_params)
+        _save_frame(predict_probabilistic_features(summary.set_index('CustomerID'), bgf, ggf), shard_dir, "predictions")
+    return time.process_time() - start
+
+def _run_phase(pool, fn, items, measure_scaling):
+    """Maps fn over the items in the pool; returns the results, the pool's wall time and, with
+    `measure_scaling`, the wall time of the same work run serially in this process first."""
+    serial_seconds = None
+    if measure_scaling:
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        serial_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    results = list(pool.map(fn, items))
+    return results, time.perf_counter() - start, serial_seconds
+
+def _scaling_report(phase, wall_seconds, worker_seconds, n_workers, serial_seconds=None):
+    """Pool utilisation (worker CPU / (workers x wall)) and, given the serial time T1 of the
+    same phase, speedup T1/TN and scaling efficiency T1/(N x TN)."""
+    busy = sum(worker_seconds)
+    utilisation = busy / (n_workers * wall_seconds) if wall_seconds > 0 else 0.0
+    report = {'wall_seconds': wall_seconds, 'worker_seconds': busy, 'utilisation': utilisation}
+    message = f"  {phase}: wall {wall_seconds:.2f}s, worker CPU {busy:.2f}s, utilisation {utilisation:.0%} of {n_workers} workers"
+    if serial_seconds is not None:
+        speedup = serial_seconds / wall_seconds if wall_seconds > 0 else 0.0
+        report.update(serial_seconds=serial_seconds, speedup=speedup, efficiency=speedup / n_workers)
+        message += f"; serial {serial_seconds:.2f}s, speedup {speedup:.2f}x, efficiency {speedup / n_workers:.0%}"
+    print(message)
+    return report
+
+def build_feature_set_parallel(n_workers=None, measure_scaling=None):
+    """Builds the full enriched feature set (build_feature_set + probabilistic features) across processes.
+
+    `measure_scaling` also runs each parallel phase serially, to report speedup and efficiency against it.
+    """
+    parallel_config = CONFIG['parallel']
+    n_workers = n_workers or parallel_config['n_workers']
+    if measure_scaling is None:
+        measure_scaling = parallel_config['measure_scaling']
+    n_shards = parallel_config.get('n_shards') or n_workers
+    print(f"Building feature set in parallel ({n_shards} shards, {n_workers} workers)...")
+    total_start = time.perf_counter()
+
+    if not raw_store.store_exists():
+        raise FileNotFoundError(f"Raw data not found at {CONFIG['data']['raw_store_path']}. Run `make data` first.")
+    snapshot_date = raw_store.max_timestamp()
+    train_end_date = snapshot_date - pd.Timedelta(days=90)
+    prob_cutoff = probabilistic_cutoff()
+
+    df = raw_store.read_transactions(end=snapshot_date, columns=FEATURE_SOURCE_COLUMNS, categorical_ids=True)
+    # Every shard must measure T against the same observation end as a single-process fit
+    observation_period_end = df.loc[df['TransactionDate'] <= prob_cutoff, 'TransactionDate'].max()
+
+    os.makedirs(parallel_config['shard_dir'], exist_ok=True)
+    report = {}
+    with tempfile.TemporaryDirectory(dir=parallel_config['shard_dir']) as shard_root:
+        customers, shard_dirs = write_shards(df, n_shards, shard_root)
+        del df
+
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            cpu_seconds, wall_seconds, serial_seconds = _run_phase(
+                pool,
+                partial(_shard_features, train_end_date=train_end_date, prob_cutoff=prob_cutoff,
+                        observation_period_end=observation_period_end),
+                shard_dirs, measure_scaling,
+            )
+            report['features'] = _scaling_report("features", wall_seconds, cpu_seconds, n_workers, serial_seconds)
+
+            # The global fits stay centralized; only their (small) parameters go to the workers
+            summaries = [_load_frame(shard_dir, "summary") for shard_dir in shard_dirs]
+            bgf, ggf = fit_models(pd.concat([s for s in summaries if s is not None]).set_index('CustomerID'))
+            del summaries
+
+            cpu_seconds, wall_seconds, serial_seconds = _run_phase(
+                pool, partial(_shard_predictions, bg_params=bgf.params_, gg_params=ggf.params_), shard_dirs, measure_scaling
+            )
+            report['predictions'] = _scaling_report("predictions", wall_seconds, cpu_seconds, n_workers, serial_seconds)
+
+        # Read (and copied out of the memory maps) before the shard directory is removed
+        features = pd.concat([f for f in (_load_frame(d, "features") for d in shard_dirs) if f is not None], ignore_index=True)
+        prob_features = pd.concat([p for p in (_load_frame(d, "predictions") for d in shard_dirs) if p is not None], ignore_index=True)
+
+    log_probabilistic_models(bgf, ggf)
+
+    final_df = pd.merge(features, prob_features, on='CustomerID', how='left')
+    value_cols = final_df.columns.drop('CustomerID')
+    final_df[value_cols] = final_df[value_cols].fillna(0)
+    final_df['CustomerID'] = customers[final_df['CustomerID'].to_numpy()]
+    final_df = final_df.sort_values('CustomerID', ignore_index=True)
+
+    processed_feature_path = CONFIG['data']['processed_path']
+    final_df.to_csv(processed_feature_path, index=False)
+    feature_store.write_snapshot(final_df)
+
+    total_seconds = time.perf_counter() - total_start
+    # The serial baseline runs are measurement overhead, not part of the build
+    parallel_seconds = sum(report[phase]['wall_seconds'] + report[phase].get('serial_seconds', 0.0)
+                           for phase in ('features', 'predictions'))
+    # Reading, sharding, the central fits and the final merge bound the overall speedup (Amdahl)
+    report['total'] = {'wall_seconds': total_seconds, 'serial_seconds': total_seconds - parallel_seconds}
+    print(f"  serial work (read, shard, central fit, merge): {total_seconds - parallel_seconds:.2f}s")
+    print(f"Complete feature set saved to '{processed_feature_path}' in {total_seconds:.2f}s "
+          f"({len(final_df)} customers with {', '.join(PROBABILISTIC_FEATURES)})")
+    return final_df, report
+
+if __name__ == "__main__":
+    mlflow.set_tracking_uri(CONFIG['mlflow']['tracking_uri'])
+    mlflow.set_experiment(CONFIG['mlflow']['experiment_name'])
+
+    with mlflow.start_run(run_name="Main_Pipeline_Features") as parent_run:
+        build_feature_set_parallel()
@@ -0,0 +1,269 @@
+import pandas as pd
+import argparse
+from contextlib import nullcontext
+from datetime import datetime
+import hashlib
+import importlib.util
+import json
+import os
+import time
+import mlflow
+from src.utils_io import load_config, get_watermark
+from src.instrumentation import timer, profiled, print_stage_report
+
+CONFIG = load_config()
+
+# ------------------
+# Stages
+# ------------------
+class Stage:
+    """One pipeline step.
+
+    run(artifacts) returns the stage's in-memory artifact, passed to downstream
+    stages in the same process. A stage is skipped when its fingerprint (upstream
+    fingerprints, config sections, source code of `modules` and `external()`
+    inputs) matches the last successful run and `is_current(output)` holds;
+    downstream stages that do run then get its artifact from `load()`.
+    describe(artifact) gives the JSON-able summary kept in the pipeline state.
+    """
+
+    def __init__(self, name, run, inputs=(), config_sections=(), modules=(), external=None,
+                 load=None, is_current=None, describe=None):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.config_sections = list(config_sections)
+        self.modules = list(modules)
+        self.external = external
+        self.load = load or (lambda: None)
+        self.is_current = is_current or (lambda output: True)
+        self.describe = describe or (lambda artifact: None)
+
+def _code_hash(modules):
+    """Hash of the modules' source files, located without importing them."""
+    digest = hashlib.sha256()
+    for module in sorted(modules):
+        with open(importlib.util.find_spec(module).origin, 'rb') as f:
+            digest.update(module.encode() + b"\0" + f.read())
+    return digest.hexdigest()
+
+def fingerprint(stage, upstream_fingerprints):
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        'stage': stage.name,
+        'upstream': [upstream_fingerprints[name] for name in stage.inputs],
+        'config': {section: CONFIG.get(section) for section in stage.config_sections},
+        'external': stage.external() if stage.external else None,
+    }, sort_keys=True, default=str).encode())
+    digest.update(_code_hash(stage.modules).encode())
+    return digest.hexdigest()[:16]
+
+# ------------------
+# Stage definitions
+# ------------------
+def _raw_store_state():
+    from src import raw_store
+    # Partitions are append-only files, so the manifest identifies the data exactly
+    return {'files': raw_store.load_manifest()['files'], 'watermark': get_watermark(CONFIG['data']['watermark_path'])}
+
+def _run_data(artifacts):
+    from src.incremental_loader import load_new_data
+    new_data = load_new_data()
+    return {'new_rows': 0 if new_data is None else len(new_data)}
+
+def _load_transactions():
+    from src import raw_store
+    from src.feature_engineering import FEATURE_SOURCE_COLUMNS
+    # Read once for both the feature build and the probabilistic fit
+    return raw_store.read_transactions(
+        end=raw_store.max_timestamp(), columns=FEATURE_SOURCE_COLUMNS, categorical_ids=True
+    )
+
+def _run_features(artifacts):
+    from src.feature_engineering import compute_feature_set
+    print("Building feature set...")
+    return compute_feature_set(artifacts['transactions'])
+
+def _load_features():
+    from src.probabilistic import PROBABILISTIC_FEATURES
+    df = pd.read_csv(CONFIG['data']['processed_path'])
+    return df.drop(columns=[c for c in PROBABILISTIC_FEATURES if c in df.columns])
+
+def _run_probabilistic(artifacts):
+    from src.probabilistic import enrich_feature_set
+    from src.feature_engineering import save_feature_set
+    enriched = enrich_feature_set(artifacts['features'], artifacts['transactions'])
+    return {'snapshot_version': save_feature_set(enriched), 'customers': len(enriched)}
+
+def _current_snapshot(output):
+    from src.feature_store import current_version
+    return output is not None and current_version() == output['snapshot_version']
+
+def _latest_model_version(model_name):
+    versions = mlflow.tracking.MlflowClient().search_model_versions(f"name='{model_name}'")
+    return str(max(int(v.version) for v in versions)) if versions else None
+
+def _registered(model_name):
+    def is_current(output):
+        try:
+            mlflow.tracking.MlflowClient().get_model_version(model_name, output['model_version'])
+            return True
+        except Exception:
+            return False
+    return is_current
+
+def _run_train_clv(artifacts):
+    from src.train_regression import train_clv_model
+    from src.tree_export import export_clv_model
+    train_clv_model()
+    export_clv_model()
+    return {'model_version': _latest_model_version(CONFIG['models']['clv_model_name'])}
+
+def _run_train_segmentation(artifacts):
+    from src.train_segmentation import train_segmentation_models
+    train_segmentation_models()
+    return {'model_version': _latest_model_version(CONFIG['models']['segmentation_model_name'])}
+
+def _production_versions():
+    from src.prediction_cache import production_version
+    return {name: production_version(CONFIG['models'][name]) for name in ('clv_model_name', 'segmentation_model_name')}
+
+def _run_score(artifacts):
+    if None in _production_versions().values():
+        print("No Production models yet; promote them (make promote-clv / promote-segment) to score customers.")
+        return {'scored_path': None}
+    from src.batch_scoring import score_all_customers
+    return {'scored_path': score_all_customers()}
+
+def _scored(output):
+    return output['scored_path'] is None or os.path.exists(output['scored_path'])
+
+STAGES = [
+    Stage('data', _run_data, config_sections=['data_generation', 'validation'],
+          modules=['src.incremental_loader', 'src.validation', 'src.raw_store'], external=_raw_store_state,
+          describe=lambda artifact: artifact),
+    Stage('transactions', lambda artifacts: _load_transactions(), inputs=['data'],
+          config_sections=['raw_store'], modules=['src.raw_store'], load=_load_transactions,
+          describe=lambda df: {'rows': len(df)}),
+    Stage('features', _run_features, inputs=['transactions'], config_sections=['feature_engineering', 'customer_state'],
+          modules=['src.feature_engineering', 'src.feature_kernel', 'src.customer_state'], load=_load_features,
+          describe=lambda df: {'customers': len(df)}),
+    Stage('probabilistic', _run_probabilistic, inputs=['features', 'transactions'],
+          config_sections=['probabilistic', 'time_split'],
+          modules=['src.probabilistic', 'src.probabilistic_fit', 'src.feature_store'],
+          is_current=_current_snapshot, describe=lambda artifact: artifact),
+    Stage('train_clv', _run_train_clv, inputs=['probabilistic'],
+          config_sections=['regression_params', 'time_split', 'probabilistic', 'models'],
+          modules=['src.train_regression', 'src.tree_export'],
+          is_current=_registered(CONFIG['models']['clv_model_name']), describe=lambda artifact: artifact),
+    Stage('train_segmentation', _run_train_segmentation, inputs=['probabilistic'],
+          config_sections=['segmentation_params', 'seeds', 'models'],
+          modules=['src.train_segmentation', 'src.segmentation_sweep', 'src.labeler'],
+          is_current=_registered(CONFIG['models']['segmentation_model_name']), describe=lambda artifact: artifact),
+    Stage('score', _run_score, inputs=['probabilistic', 'train_clv', 'train_segmentation'],
+          config_sections=['batch_scoring'], modules=['src.batch_scoring', 'src.inference', 'src.tree_export'],
+          external=_production_versions, is_current=_scored, describe=lambda artifact: artifact),
+]
+
+# ------------------
+# Runner
+# ------------------
+def _load_pipeline_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+def _save_pipeline_state(state, state_path):
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    with open(state_path + ".tmp", 'w') as f:
+        json.dump(state, f, indent=2, default=str)
+    os.replace(state_path + ".tmp", state_path)
+
+def _required_stages(targets, stages):
+    by_name = {stage.name: stage for stage in stages}
+    required = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending.extend(by_name[name].inputs)
+    # STAGES is listed in dependency order
+    return [stage for stage in stages if stage.name in required]
+
+class _Artifacts(dict):
+    """Stage artifacts of this process; a skipped stage's artifact is loaded on first use."""
+
+    def __init__(self, stages, report):
+        super().__init__()
+        self.stages = {stage.name: stage for stage in stages}
+        self.report = report
+
+    def __missing__(self, name):
+        start = time.perf_counter()
+        value = self[name] = self.stages[name].load()
+        self.report[name]['load_seconds'] = time.perf_counter() - start
+        return value
+
+def run_pipeline(targets=None, force=(), stages=STAGES, state_path=None, profile=False):
+    """Runs the stages `targets` depend on, skipping those whose fingerprint matches their last successful run.
+
+    `force` lists stages to rerun regardless; `profile` writes a sampling profile of the whole run.
+    Returns the per-stage timing report.
+    """
+    state_path = state_path or CONFIG['pipeline']['state_path']
+    targets = targets or CONFIG['pipeline']['default_targets']
+    stages = _required_stages(targets, stages)
+    state = _load_pipeline_state(state_path)
+    report = {}
+    artifacts = _Artifacts(stages, report)
+    fingerprints = {}
+    total_start = time.perf_counter()
+
+    mlflow.set_tracking_uri(CONFIG['mlflow']['tracking_uri'])
+    mlflow.set_experiment(CONFIG['mlflow']['experiment_name'])
+    with mlflow.start_run(run_name="Pipeline"), (profiled("pipeline") if profile else nullcontext()):
+        for stage in stages:
+            start = time.perf_counter()
+            current = fingerprint(stage, fingerprints)
+            previous = state.get(stage.name, {})
+            report[stage.name] = {'fingerprint': current}
+            if stage.name not in force and previous.get('fingerprint') == current and stage.is_current(previous.get('output')):
+                fingerprints[stage.name] = current
+                report[stage.name].update(status='skipped', seconds=time.perf_counter() - start)
+                continue
+
+            print(f"[pipeline] Running stage '{stage.name}'...")
+            with timer(f"pipeline.{stage.name}", memory=True, log=True):
+                artifacts[stage.name] = artifact = stage.run(artifacts)
+            # Stages such as 'data' change their own external inputs, so the fingerprint is taken again
+            fingerprints[stage.name] = fingerprint(stage, fingerprints)
+            seconds = time.perf_counter() - start
+            state[stage.name] = {
+                'fingerprint': fingerprints[stage.name], 'output': stage.describe(artifact),
+                'seconds': seconds, 'finished_at': datetime.now().isoformat(),
+            }
+            _save_pipeline_state(state, state_path)
+            report[stage.name].update(status='ran', seconds=seconds, fingerprint=fingerprints[stage.name])
+        mlflow.log_metrics({f"{name}_seconds": r['seconds'] for name, r in report.items()})
+
+    print_report(report, time.perf_counter() - total_start)
+    print()
+    print_stage_report()
+    return report
+
+def print_report(report, total_seconds):
+    print(f"\n{'stage':<20} {'status':<8} {'seconds':>8} {'load s':>7}  fingerprint")
+    for name, result in report.items():
+        load = f"{result['load_seconds']:.2f}" if 'load_seconds' in result else ""
+        print(f"{name:<20} {result['status']:<8} {result['seconds']:>8.2f} {load:>7}  {result['fingerprint']}")
+    print(f"{'total':<20} {'':<8} {total_seconds:>8.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the pipeline stages, skipping those whose inputs are unchanged.")
+    parser.add_argument('targets', nargs='*', help=f"Stages to bring up to date (default: {CONFIG['pipeline']['default_targets']})")
+    parser.add_argument('--force', nargs='*', default=[], help="Stages to rerun even if unchanged")
+    parser.add_argument('--profile', action='store_true', help="Write a flame-graph-ready sampling profile of the run")
+    args = parser.parse_args()
+    run_pipeline(args.targets, force=args.force, profile=args.profile)
@@ -0,0 +1,221 @@
+import numpy as np
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+import time
+import mlflow
+from src.utils_io import load_config, get_watermark
+from src.instrumentation import timer
+
+CONFIG = load_config()
+
+def production_version(model_name):
+    """Version number (as a string) of the registered model in Production, or None."""
+    versions = mlflow.tracking.MlflowClient().get_latest_versions(model_name, ['Production'])
+    return str(versions[0].version) if versions else None
+
+def current_generation():
+    """What the cached predictions depend on beyond their keys: the load watermark.
+
+    Model versions are part of every key, so a promotion needs no registry call here.
+    """
+    return get_watermark(CONFIG['data']['watermark_path']).isoformat()
+
+# ------------------
+# Shared on-disk tier
+# ------------------
+class DiskTier:
+    """SQLite table of predictions shared by every API worker and the dashboard (WAL mode)."""
+
+    MAX_PARAMS = 900 # Stay below SQLite's bound variable limit
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock() # One connection per process, shared by its threads
+
+    def _connect(self):
+        # A connection must not cross a fork, so each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS predictions (kind TEXT, customer_id TEXT, snapshot_version TEXT, "
+                "model_version TEXT, generation TEXT, value REAL, "
+                "PRIMARY KEY (kind, customer_id, snapshot_version, model_version))"
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    def get_many(self, kind, customer_ids, snapshot_version, model_version, generation):
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            for start in range(0, len(customer_ids), self.MAX_PARAMS):
+                chunk = customer_ids[start:start + self.MAX_PARAMS]
+                found.update(connection.execute(
+                    f"SELECT customer_id, value FROM predictions WHERE kind = ? AND snapshot_version = ? "
+                    f"AND model_version = ? AND generation = ? AND customer_id IN ({','.join('?' * len(chunk))})",
+                    [kind, snapshot_version, model_version, generation, *chunk],
+                ).fetchall())
+        return found
+
+    def put_many(self, kind, items, snapshot_version, model_version, generation):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)",
+                    [(kind, customer_id, snapshot_version, model_version, generation, value) for customer_id, value in items],
+                )
+
+    def drop_other_generations(self, generation):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                # IS NOT also drops rows written without a generation (NULL)
+                connection.execute("DELETE FROM predictions WHERE generation IS NOT ?", [generation])
+
+# ------------------
+# Prediction cache
+# ------------------
+class PredictionCache:
+    """Bounded LRU cache of per-customer predictions, keyed by (customer, snapshot version, model version).
+
+    The model version is fixed at construction or passed per call (when the
+    serving models are hot-swapped).
+
+    Everything is dropped once the load watermark advances (checked at most
+    every check_interval seconds); entries of a replaced model version are
+    never looked up again and age out of the LRU. Misses fall through to the
+    shared disk tier before being scored; that tier is only read and written
+    once a generation is known, and only rows of that generation are read.
+    """
+
+    def __init__(self, kind, model_version=None, dtype=np.float64, fill_value=np.nan,
+                 max_entries=None, disk_path=None, check_interval=None):
+        cache_config = CONFIG['prediction_cache']
+        self.kind = kind
+        self.model_version = None if model_version is None else str(model_version)
+        self.dtype = dtype
+        self.fill_value = fill_value # Returned for customers that are not in the snapshot
+        self.max_entries = max_entries or cache_config['max_entries']
+        disk_path = disk_path if disk_path is not None else cache_config['disk_path']
+        self.disk = DiskTier(disk_path) if disk_path else None
+        self.check_interval = check_interval if check_interval is not None else cache_config['check_interval_seconds']
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._last_check = 0.0
+        self.hits = self.disk_hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self):
+        """Hit/miss counters since start."""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self._entries), 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+            'evictions': self.evictions, 'invalidations': self.invalidations,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def check_generation(self, force=False):
+        """Clears the cache if the watermark advanced; a failed check keeps the last known generation."""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+        try:
+            generation = current_generation()
+        except Exception as e:
+            print(f"Prediction cache '{self.kind}' kept its entries: generation check failed ({e}).")
+            return False
+        if generation == self._generation:
+            return False
+        with self._lock:
+            invalidated = self._generation is not None
+            self._generation = generation
+            self._entries.clear()
+            if invalidated:
+                self.invalidations += 1
+        if self.disk is not None:
+            self.disk.drop_other_generations(generation)
+        if invalidated:
+            print(f"Prediction cache '{self.kind}' invalidated (watermark advanced).")
+        return invalidated
+
+    def get_many(self, customer_ids, snapshot_version, model_version=None):
+        """Cached values for the IDs (NaN where missing) and a hit mask."""
+        model_version = self._model_version(model_version)
+        values = np.full(len(customer_ids), np.nan)
+        hit = np.zeros(len(customer_ids), dtype=bool)
+        with self._lock:
+            for i, customer_id in enumerate(customer_ids):
+                key = (customer_id, snapshot_version, model_version)
+                value = self._entries.get(key)
+                if value is not None:
+                    self._entries.move_to_end(key)
+                    values[i] = value
+                    hit[i] = True
+            hits = int(hit.sum())
+            self.hits += hits
+
+        generation = self._generation
+        if self.disk is not None and generation is not None and not hit.all():
+            missing = [customer_ids[i] for i in np.flatnonzero(~hit)]
+            stored = self.disk.get_many(self.kind, missing, snapshot_version, model_version, generation)
+            if stored:
+                for i in np.flatnonzero(~hit):
+                    if customer_ids[i] in stored:
+                        values[i] = stored[customer_ids[i]]
+                        hit[i] = True
+                self._remember(stored.items(), snapshot_version, model_version)
+        with self._lock:
+            self.disk_hits += int(hit.sum()) - hits
+            self.misses += int((~hit).sum())
+        return values, hit
+
+    def put_many(self, customer_ids, values, snapshot_version, model_version=None):
+        model_version = self._model_version(model_version)
+        items = list(zip(customer_ids, np.asarray(values, dtype=np.float64).tolist()))
+        self._remember(items, snapshot_version, model_version)
+        generation = self._generation
+        if self.disk is not None and generation is not None:
+            self.disk.put_many(self.kind, items, snapshot_version, model_version, generation)
+
+    def _model_version(self, model_version):
+        if model_version is None and self.model_version is None:
+            raise ValueError(f"Prediction cache '{self.kind}' needs a model version")
+        return self.model_version if model_version is None else str(model_version)
+
+    def _remember(self, items, snapshot_version, model_version):
+        with self._lock:
+            for customer_id, value in items:
+                self._entries[(customer_id, snapshot_version, model_version)] = value
+                self._entries.move_to_end((customer_id, snapshot_version, model_version))
+            overflow = len(self._entries) - self.max_entries
+            for _ in range(max(overflow, 0)):
+                self._entries.popitem(last=False)
+            self.evictions += max(overflow, 0)
+
+    def score(self, score_fn, snapshot, customer_ids, model_version=None):
+        """score_fn(snapshot, ids) -> (values, found), with cached values reused and new ones stored.
+
+        Unknown customers are not cached, so they are looked up again next time.
+        """
+        self.check_generation()
+        customer_ids = list(customer_ids)
+        with timer(f'cache.{self.kind}_lookup'):
+            values, hit = self.get_many(customer_ids, snapshot.version, model_version)
+        found = hit.copy()
+        if not hit.all():
+            miss = np.flatnonzero(~hit)
+            miss_ids = [customer_ids[i] for i in miss]
+            miss_values, miss_found = score_fn(snapshot, miss_ids)
+            values[miss] = miss_values
+            found[miss] = miss_found
+            with timer(f'cache.{self.kind}_store'):
+                self.put_many([c for c, f in zip(miss_ids, miss_found) if f], np.asarray(miss_values)[miss_found], snapshot.version, model_version)
+        return np.where(found, values, self.fill_value).astype(self.dtype), found
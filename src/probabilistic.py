@@ -1,42 +1,102 @@
 import pandas as pd
 from lifetimes import BetaGeoFitter, GammaGammaFitter
-from lifetimes.utils import summary_data_from_transaction_data
 import mlflow
-import joblib
 from src.utils_io import load_config
+from src import raw_store, feature_store
+from src.feature_kernel import repeat_purchase_summary
+from src.probabilistic_fit import fit_bgnbd, fit_gamma_gamma, BG_PARAMS, GG_PARAMS
+from src.instrumentation import instrumented
 
 CONFIG = load_config()
 
-def fit_probabilistic_models(df):
-    """Fits BG/NBD and Gamma-Gamma models and returns features."""
-    print("Fitting probabilistic models...")
-    
-    # lifetimes requires a specific format: frequency, recency, T, monetary_value
-    summary = summary_data_from_transaction_data(
-        df,
-        customer_id_col='CustomerID',
-        datetime_col='TransactionDate',
-        monetary_value_col='Amount'
+PROBABILISTIC_FEATURES = ['predicted_purchases_90d', 'expected_monetary_value', 'probabilistic_clv_90d']
+
+def probabilistic_cutoff():
+    """The models see the full history up to 90 days before the validation start."""
+    return pd.to_datetime(CONFIG['time_split']['validation_start_date']) - pd.Timedelta(days=90)
+
+@instrumented('probabilistic.summary')
+def summarize_transactions(df, observation_period_end=None):
+    """Builds the frequency/recency/T/monetary_value summary the lifetimes fitters expect.
+
+    Computed with the sorted-array feature kernel; identical to
+    lifetimes.utils.summary_data_from_transaction_data (`make bench-probabilistic`).
+    """
+    return repeat_purchase_summary(
+        df['CustomerID'], df['TransactionDate'], df['Amount'], observation_period_end
     )
-    
+
+def previous_params():
+    """BG/NBD and Gamma-Gamma parameters of the last logged fit (warm starts), or None for each."""
+    try:
+        runs = mlflow.search_runs(
+            filter_string="tags.mlflow.runName = 'Probabilistic_Models' and attributes.status = 'FINISHED'",
+            order_by=["attributes.start_time DESC"],
+            max_results=1,
+        )
+    except Exception:
+        return None, None
+    if runs.empty:
+        return None, None
+    last_run = runs.iloc[0]
+    def params(prefix, names):
+        columns = [f"params.{prefix}_{name}" for name in names]
+        if not all(c in last_run.index and pd.notna(last_run[c]) for c in columns):
+            return None
+        return {name: float(last_run[c]) for name, c in zip(names, columns)}
+    return params("bg", BG_PARAMS), params("gg", GG_PARAMS)
+
+@instrumented('probabilistic.fit')
+def fit_models(summary):
+    """Fits the BG/NBD and Gamma-Gamma models on a customer summary.
+
+    The likelihoods are maximized directly on compressed (weighted) rows and,
+    if enabled, warm-started from the last logged parameters; the result is
+    returned as lifetimes fitters with a `fit_report_` attribute.
+    """
+    prob_config = CONFIG['probabilistic']
+    penalizer_coef, tol = prob_config['penalizer_coef'], prob_config['tol']
+    bg_initial, gg_initial = previous_params() if prob_config['warm_start'] else (None, None)
+
     # Fit BG/NBD model
-    bgf = BetaGeoFitter(penalizer_coef=0.001)
-    bgf.fit(summary['frequency'], summary['recency'], summary['T'])
-    
-    # Predict future purchases
-    summary['predicted_purchases_90d'] = bgf.predict(
-        t=90, 
-        frequency=summary['frequency'], 
-        recency=summary['recency'], 
-        T=summary['T']
+    bg_params, bg_report = fit_bgnbd(
+        summary['frequency'], summary['recency'], summary['T'],
+        penalizer_coef=penalizer_coef, initial_params=bg_initial, tol=tol
     )
     
     # Fit Gamma-Gamma model (only on customers who made repeat purchases)
     returning_customers_summary = summary[summary['frequency'] > 0]
-    ggf = GammaGammaFitter(penalizer_coef=0.001)
-    ggf.fit(
+    gg_params, gg_report = fit_gamma_gamma(
         returning_customers_summary['frequency'],
-        returning_customers_summary['monetary_value']
+        returning_customers_summary['monetary_value'],
+        penalizer_coef=penalizer_coef, initial_params=gg_initial, tol=tol
+    )
+
+    for name, report in [("BG/NBD", bg_report), ("Gamma-Gamma", gg_report)]:
+        print(f"  {name}: {report['rows']} customers as {report['unique_rows']} unique rows, "
+              f"{report['iterations']} iterations from a {'warm' if report['warm_start'] else 'cold'} start "
+              f"in {report['seconds']:.3f}s")
+    bgf, ggf = fitters_from_params(bg_params, gg_params)
+    bgf.fit_report_, ggf.fit_report_ = bg_report, gg_report
+    return bgf, ggf
+
+def fitters_from_params(bg_params, gg_params):
+    """Rebuilds fitted models from their parameters (the fitters themselves do not pickle)."""
+    penalizer_coef = CONFIG['probabilistic']['penalizer_coef']
+    bgf, ggf = BetaGeoFitter(penalizer_coef=penalizer_coef), GammaGammaFitter(penalizer_coef=penalizer_coef)
+    bgf.params_, ggf.params_ = bg_params, gg_params
+    return bgf, ggf
+
+def predict_probabilistic_features(summary, bgf, ggf):
+    """Scores every customer in the summary with already fitted models."""
+    summary = summary.copy()
+    
+    # Predict future purchases (bgf.predict is only aliased on fitters that ran fit())
+    summary['predicted_purchases_90d'] = bgf.conditional_expected_number_of_purchases_up_to_time(
+        t=90, 
+        frequency=summary['frequency'], 
+        recency=summary['recency'], 
+        T=summary['T']
     )
     
     summary['expected_monetary_value'] = ggf.conditional_expected_average_profit(
@@ -45,40 +105,91 @@ def fit_probabilistic_models(df):
     )
     
     # For customers with 0 frequency, expected value is just their single purchase average
-    summary['expected_monetary_value'].fillna(summary['monetary_value'], inplace=True)
+    summary['expected_monetary_value'] = summary['expected_monetary_value'].fillna(summary['monetary_value'])
     
     # Combine predictions
     summary['probabilistic_clv_90d'] = summary['predicted_purchases_90d'] * summary['expected_monetary_value']
-    
-    # Log models and return features
+    return summary.reset_index()[['CustomerID'] + PROBABILISTIC_FEATURES]
+
+def point_in_time_probabilistic_features(transactions, snapshot_dates):
+    """Probabilistic features as of each snapshot date, from models fitted on the history up to it (long format)."""
+    frames = []
+    for snapshot in pd.to_datetime(sorted(snapshot_dates)):
+        summary = summarize_transactions(transactions[transactions['TransactionDate'] <= snapshot], snapshot)
+        features = predict_probabilistic_features(summary, *fit_models(summary))
+        features.insert(1, 'snapshot_date', snapshot)
+        frames.append(features)
+    return pd.concat(frames, ignore_index=True)
+
+def log_probabilistic_models(bgf, ggf):
+    """Logs the fitted models to MLflow as their parameters (which also seed the next fit) and fit timings."""
     with mlflow.start_run(run_name="Probabilistic_Models", nested=True) as run:
-        joblib.dump(bgf, "bgf_model.pkl")
-        joblib.dump(ggf, "ggf_model.pkl")
-        mlflow.log_artifact("bgf_model.pkl", artifact_path="probabilistic_models")
-        mlflow.log_artifact("ggf_model.pkl", artifact_path="probabilistic_models")
-        
-    return summary.reset_index()[['CustomerID', 'predicted_purchases_90d', 'expected_monetary_value', 'probabilistic_clv_90d']]
+        mlflow.log_params({f"bg_{name}": float(value) for name, value in bgf.params_.items()})
+        mlflow.log_params({f"gg_{name}": float(value) for name, value in ggf.params_.items()})
+        for prefix, fitter in [("bg", bgf), ("gg", ggf)]:
+            report = getattr(fitter, 'fit_report_', None)
+            if report:
+                mlflow.log_metrics({
+                    f"{prefix}_fit_seconds": report['seconds'],
+                    f"{prefix}_iterations": report['iterations'],
+                    f"{prefix}_unique_rows": report['unique_rows'],
+                    f"{prefix}_neg_log_likelihood": report['neg_log_likelihood'],
+                })
+        mlflow.log_dict(
+            {'bgnbd': bgf.params_.to_dict(), 'gamma_gamma': ggf.params_.to_dict()},
+            "probabilistic_models/params.json"
+        )
 
-def add_probabilistic_features_to_main_set():
-    """Integrates probabilistic features into the main feature set."""
-    raw_data_path = CONFIG['data']['raw_path']
-    processed_feature_path = CONFIG['data']['processed_path']
+def fit_probabilistic_models(df):
+    """Fits BG/NBD and Gamma-Gamma models and returns features."""
+    print("Fitting probabilistic models...")
     
-    df_raw = pd.read_csv(raw_data_path, parse_dates=['TransactionDate'])
-    df_features = pd.read_csv(processed_feature_path)
+    # lifetimes requires a specific format: frequency, recency, T, monetary_value
+    summary = summarize_transactions(df)
+    bgf, ggf = fit_models(summary)
+    features = predict_probabilistic_features(summary, bgf, ggf)
     
-    # The probabilistic models need the full history up to the prediction start
-    train_end_date = pd.to_datetime(CONFIG['time_split']['validation_start_date']) - pd.Timedelta(days=90)
-    prob_df_train = df_raw[df_raw['TransactionDate'] <= train_end_date]
+    # Log models and return features
+    log_probabilistic_models(bgf, ggf)
+    return features
+
+@instrumented('probabilistic.enrich')
+def enrich_feature_set(df_features, transactions=None):
+    """Adds the probabilistic features to a feature set in memory.
+
+    `transactions` (rows up to at least the probabilistic cutoff) skips reading the raw store again.
+    """
+    # The probabilistic models need the full history up to the prediction start;
+    # partitions after the cutoff are never opened.
+    train_end_date = probabilistic_cutoff()
+    if transactions is not None:
+        prob_df_train = transactions.loc[
+            transactions['TransactionDate'] <= train_end_date, ['CustomerID', 'TransactionDate', 'Amount']
+        ]
+    else:
+        prob_df_train = raw_store.read_transactions(
+            end=train_end_date, columns=['CustomerID', 'TransactionDate', 'Amount']
+        )
     
     prob_features = fit_probabilistic_models(prob_df_train)
     
     # Merge into the main feature set
     df_features_enriched = pd.merge(df_features, prob_features, on='CustomerID', how='left')
-    df_features_enriched.fillna(0, inplace=True)
+    value_cols = df_features_enriched.columns.drop('CustomerID')
+    df_features_enriched[value_cols] = df_features_enriched[value_cols].fillna(0)
+    return df_features_enriched
+
+@instrumented('probabilistic.add_features')
+def add_probabilistic_features_to_main_set():
+    """Integrates probabilistic features into the main feature set."""
+    processed_feature_path = CONFIG['data']['processed_path']
+    
+    df_features = pd.read_csv(processed_feature_path)
+    df_features_enriched = enrich_feature_set(df_features)
     
     # Overwrite the feature file with the enriched version
     df_features_enriched.to_csv(processed_feature_path, index=False)
+    feature_store.write_snapshot(df_features_enriched)
     print("Probabilistic features have been added to the main feature set.")
 
 if __name__ == "__main__":
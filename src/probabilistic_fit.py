@@ -0,0 +1,137 @@
+import pandas as pd
+import numpy as np
+from scipy.optimize import minimize
+from scipy.special import gammaln, digamma
+import time
+
+BG_PARAMS = ['r', 'alpha', 'a', 'b']
+GG_PARAMS = ['p', 'q', 'v']
+
+# lifetimes starts every fit from exp(0.1) for all parameters
+COLD_START = 0.1
+# BFGS may stop with "precision loss" on the flat ridge where a and b go to 0;
+# such a stop still counts as converged if the gradient is this small
+GRADIENT_TOL = 1e-4
+
+def compress_rows(*columns):
+    """Collapses identical rows into unique rows plus their counts (used as likelihood weights)."""
+    unique, counts = np.unique(np.column_stack(columns), axis=0, return_counts=True)
+    return [unique[:, i] for i in range(unique.shape[1])], counts.astype(np.float64)
+
+# ------------------
+# Log-likelihoods with analytic gradients (w.r.t. the log parameters)
+# ------------------
+def bgnbd_objective(log_params, frequency, recency, T, weights, penalizer_coef):
+    """Penalized mean negative BG/NBD log-likelihood and its gradient, as minimized by lifetimes."""
+    params = np.exp(log_params)
+    r, alpha, a, b = params
+    x = frequency
+    repeat = x > 0
+
+    # A_4 only matters for repeat customers; for the others b + x - 1 may underflow to 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        A_1 = gammaln(r + x) - gammaln(r) + r * log_params[1]
+        A_2 = gammaln(a + b) + gammaln(b + x) - gammaln(b) - gammaln(a + b + x)
+        A_3 = -(r + x) * np.log(alpha + T)
+        A_4 = log_params[2] - np.log(b + (np.maximum(x, 1) - 1)) - (r + x) * np.log(recency + alpha)
+        # log(exp(A_3) + exp(A_4)) for repeat customers, A_3 alone otherwise
+        top = np.where(repeat, np.maximum(A_3, A_4), A_3)
+        e_3 = np.exp(A_3 - top)
+        e_4 = np.where(repeat, np.exp(A_4 - top), 0.0)
+    total = e_3 + e_4
+    w_3, w_4 = e_3 / total, e_4 / total
+    ll = A_1 + A_2 + np.log(total) + top
+
+    # Gradient w.r.t. the log parameters (p * d/dp per row), so a and b may approach 0
+    g_r = r * (digamma(r + x) - digamma(r) + log_params[1] - w_3 * np.log(alpha + T) - w_4 * np.log(recency + alpha))
+    g_alpha = r - w_3 * (r + x) * alpha / (alpha + T) - w_4 * (r + x) * alpha / (recency + alpha)
+    g_a = a * (digamma(a + b) - digamma(a + b + x)) + w_4
+    g_b = (b * (digamma(a + b) + digamma(b + x) - digamma(b) - digamma(a + b + x))
+           - np.where(repeat, w_4 * b / (b + (np.maximum(x, 1) - 1)), 0.0))
+
+    weight_sum = weights.sum()
+    value = -(weights * ll).sum() / weight_sum + penalizer_coef * (params ** 2).sum()
+    gradient = np.array([-(weights * g).sum() / weight_sum for g in (g_r, g_alpha, g_a, g_b)])
+    return value, gradient + 2 * penalizer_coef * params ** 2
+
+def gamma_gamma_objective(log_params, frequency, monetary_value, weights, penalizer_coef):
+    """Penalized mean negative Gamma-Gamma log-likelihood and its gradient, as minimized by lifetimes."""
+    params = np.exp(log_params)
+    p, q, v = params
+    x, m = frequency, monetary_value
+    px = p * x
+
+    ll = (gammaln(px + q) - gammaln(px) - gammaln(q) + q * np.log(v)
+          + (px - 1) * np.log(m) + px * np.log(x) - (px + q) * np.log(x * m + v))
+    d_p = x * (digamma(px + q) - digamma(px) + np.log(m) + np.log(x) - np.log(x * m + v))
+    d_q = digamma(px + q) - digamma(q) + np.log(v) - np.log(x * m + v)
+    d_v = q / v - (px + q) / (x * m + v)
+
+    weight_sum = weights.sum()
+    value = -(weights * ll).sum() / weight_sum + penalizer_coef * (params ** 2).sum()
+    gradient = np.array([-(weights * d).sum() / weight_sum for d in (d_p, d_q, d_v)])
+    gradient = params * (gradient + 2 * penalizer_coef * params)
+    return value, gradient
+
+# ------------------
+# Fitting
+# ------------------
+def _minimize(objective, initial_log_params, num_params, args, tol):
+    """BFGS from the warm start; falls back to the lifetimes cold start if that does not converge.
+
+    Returns the scipy result and whether the warm start was used.
+    """
+    starts = [(initial_log_params, True)] if initial_log_params is not None else []
+    starts.append((np.full(num_params, COLD_START), False))
+    for x0, warm in starts:
+        result = minimize(objective, x0, args=args, jac=True, method='BFGS', tol=tol)
+        if result.success or (result.status == 2 and np.abs(result.jac).max() <= GRADIENT_TOL):
+            return result, warm
+    raise RuntimeError(f"{objective.__name__} did not converge: {result.message}")
+
+def fit_bgnbd(frequency, recency, T, penalizer_coef=0.001, initial_params=None, tol=1e-7):
+    """Fits BG/NBD on (compressed) customer rows; returns (params Series, fit report).
+
+    Like lifetimes, time is rescaled so the largest T is 1 while optimizing,
+    so the penalizer acts on the same parameters and the optimum is the same.
+    """
+    start = time.perf_counter()
+    (frequency, recency, T), weights = compress_rows(
+        np.asarray(frequency, dtype=np.float64), np.asarray(recency, dtype=np.float64), np.asarray(T, dtype=np.float64)
+    )
+    scale = 1.0 / T.max()
+    initial_log_params = None
+    if initial_params is not None:
+        initial = np.array([initial_params[name] for name in BG_PARAMS], dtype=np.float64)
+        initial[1] *= scale
+        initial_log_params = np.log(initial)
+
+    result, warm = _minimize(
+        bgnbd_objective, initial_log_params, len(BG_PARAMS), (frequency, recency * scale, T * scale, weights, penalizer_coef), tol
+    )
+    params = np.exp(result.x)
+    params[1] /= scale
+    report = {
+        'rows': int(weights.sum()), 'unique_rows': len(weights), 'iterations': int(result.nit),
+        'warm_start': warm, 'neg_log_likelihood': float(result.fun), 'seconds': time.perf_counter() - start,
+    }
+    return pd.Series(params, index=BG_PARAMS), report
+
+def fit_gamma_gamma(frequency, monetary_value, penalizer_coef=0.001, initial_params=None, tol=1e-7):
+    """Fits Gamma-Gamma on returning customers' (frequency, monetary_value); returns (params Series, fit report)."""
+    start = time.perf_counter()
+    (frequency, monetary_value), weights = compress_rows(
+        np.asarray(frequency, dtype=np.float64), np.asarray(monetary_value, dtype=np.float64)
+    )
+    initial_log_params = None
+    if initial_params is not None:
+        initial_log_params = np.log(np.array([initial_params[name] for name in GG_PARAMS], dtype=np.float64))
+
+    result, warm = _minimize(
+        gamma_gamma_objective, initial_log_params, len(GG_PARAMS), (frequency, monetary_value, weights, penalizer_coef), tol
+    )
+    report = {
+        'rows': int(weights.sum()), 'unique_rows': len(weights), 'iterations': int(result.nit),
+        'warm_start': warm, 'neg_log_likelihood': float(result.fun), 'seconds': time.perf_counter() - start,
+    }
+    return pd.Series(np.exp(result.x), index=GG_PARAMS), report
@@ -0,0 +1,184 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import shutil
+import uuid
+from src.utils_io import load_config
+
+CONFIG = load_config()
+
+MANIFEST_FILE = "manifest.json"
+PARTITION_FORMATS = {'D': '%Y-%m-%d', 'M': '%Y-%m'}
+
+TRANSACTION_SCHEMA = pa.schema([
+    ('CustomerID', pa.string()),
+    ('TransactionDate', pa.timestamp('ns')),
+    ('Quantity', pa.int64()),
+    ('UnitPrice', pa.float64()),
+    ('Amount', pa.float64()),
+])
+
+def _store_path(store_path=None):
+    return store_path or CONFIG['data']['raw_store_path']
+
+def store_exists(store_path=None):
+    """Checks whether the partitioned raw store has been initialised."""
+    return os.path.exists(os.path.join(_store_path(store_path), MANIFEST_FILE))
+
+def load_manifest(store_path=None):
+    """Reads the manifest listing every partition file with its min/max timestamps."""
+    manifest_path = os.path.join(_store_path(store_path), MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {'files': []}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def _write_manifest(manifest, store_path):
+    manifest_path = os.path.join(store_path, MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    # Readers either see the old or the new manifest, never a partial one
+    os.replace(tmp_path, manifest_path)
+
+def append_transactions(df, store_path=None):
+    """Appends a batch of transactions to the store, one new file per touched date partition."""
+    store_path = _store_path(store_path)
+    if df.empty:
+        return []
+
+    partition_format = PARTITION_FORMATS[CONFIG['raw_store']['partition_freq']]
+    df = df.assign(CustomerID=df['CustomerID'].astype(str))
+    partition_keys = df['TransactionDate'].dt.strftime(partition_format)
+
+    batch_id = f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+    new_entries = []
+    for key, part in df.groupby(partition_keys, sort=True):
+        relative_path = os.path.join(f"date={key}", f"part-{batch_id}.parquet")
+        file_path = os.path.join(store_path, relative_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        table = pa.Table.from_pandas(part, schema=TRANSACTION_SCHEMA, preserve_index=False)
+        pq.write_table(table, file_path)
+        new_entries.append({
+            'path': relative_path,
+            'partition': key,
+            'min_ts': part['TransactionDate'].min().isoformat(),
+            'max_ts': part['TransactionDate'].max().isoformat(),
+            'rows': len(part),
+        })
+
+    # Files are written before the manifest references them, so a failed append is invisible
+    manifest = load_manifest(store_path)
+    manifest['files'].extend(new_entries)
+    _write_manifest(manifest, store_path)
+    return new_entries
+
+@contextmanager
+def building_store(store_path=None):
+    """Yields a staging directory to fill with append_transactions; it becomes the store only once the block completes.
+
+    An interrupted or failed build never leaves a manifest at the store path, so
+    store_exists() stays False and the next run starts over.
+    """
+    store_path = _store_path(store_path).rstrip(os.sep)
+    if store_exists(store_path):
+        raise FileExistsError(f"Raw store already exists at '{store_path}'.")
+    staging_path = store_path + ".staging"
+    shutil.rmtree(staging_path, ignore_errors=True) # Left over by an interrupted build
+    os.makedirs(staging_path)
+    try:
+        yield staging_path
+    except BaseException:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise
+    shutil.rmtree(store_path, ignore_errors=True) # Files of a build that predates staging, never in a manifest
+    os.makedirs(os.path.dirname(store_path) or ".", exist_ok=True)
+    os.rename(staging_path, store_path)
+
+def select_files(start=None, end=None, store_path=None):
+    """Returns the manifest entries whose rows may fall in the interval (start, end]."""
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    selected = []
+    for entry in load_manifest(store_path)['files']:
+        if start is not None and pd.Timestamp(entry['max_ts']) <= start:
+            continue
+        if end is not None and pd.Timestamp(entry['min_ts']) > end:
+            continue
+        selected.append(entry)
+    return selected
+
+def _read_entries(entries, start, end, columns, store_path, categorical_ids):
+    read_columns = columns if 'TransactionDate' in columns else columns + ['TransactionDate']
+    tables = [
+        pq.read_table(
+            os.path.join(store_path, entry['path']),
+            columns=read_columns,
+            read_dictionary=['CustomerID'] if categorical_ids and 'CustomerID' in read_columns else None,
+        )
+        for entry in entries
+    ]
+    if not tables:
+        return pd.DataFrame({c: pd.Series(dtype=TRANSACTION_SCHEMA.field(c).type.to_pandas_dtype()) for c in columns})
+
+    df = pa.concat_tables(tables).to_pandas()
+    mask = pd.Series(True, index=df.index)
+    if start is not None:
+        mask &= df['TransactionDate'] > pd.Timestamp(start)
+    if end is not None:
+        mask &= df['TransactionDate'] <= pd.Timestamp(end)
+    if not mask.all():
+        df = df[mask].reset_index(drop=True)
+    return df[columns]
+
+def read_transactions(start=None, end=None, columns=None, store_path=None, categorical_ids=False):
+    """Reads transactions with start < TransactionDate <= end, opening only the overlapping partitions.
+
+    With `categorical_ids`, CustomerID is decoded straight from the Parquet
+    dictionary into a pandas categorical instead of one Python string per row.
+    """
+    store_path = _store_path(store_path)
+    columns = list(columns) if columns is not None else TRANSACTION_SCHEMA.names
+    return _read_entries(select_files(start, end, store_path), start, end, columns, store_path, categorical_ids)
+
+def iter_transactions(start=None, end=None, columns=None, store_path=None, categorical_ids=False):
+    """Like read_transactions, but yields one DataFrame per partition file instead of concatenating them."""
+    store_path = _store_path(store_path)
+    columns = list(columns) if columns is not None else TRANSACTION_SCHEMA.names
+    for entry in select_files(start, end, store_path):
+        df = _read_entries([entry], start, end, columns, store_path, categorical_ids)
+        if not df.empty:
+            yield df
+
+def max_timestamp(store_path=None):
+    """Latest transaction timestamp in the store, read from the manifest only."""
+    files = load_manifest(store_path)['files']
+    if not files:
+        return None
+    return max(pd.Timestamp(entry['max_ts']) for entry in files)
+
+def ingest_csv(csv_path, store_path=None, chunksize=1_000_000, validator=None):
+    """Imports a raw transaction CSV into the partitioned store chunk by chunk.
+
+    With a `validator` (src.validation.TransactionValidator), each chunk is
+    checked before it is written. Chunks go to a staging store that is only
+    published once the whole file is in, so a chunk failing validation (or an
+    interrupted import) leaves no partial store behind.
+    """
+    print(f"Ingesting '{csv_path}' into the partitioned raw store...")
+    rows = 0
+    with building_store(store_path) as staging_path:
+        for chunk in pd.read_csv(csv_path, parse_dates=['TransactionDate'], chunksize=chunksize):
+            if validator is not None:
+                validator.validate_chunk(chunk)
+                if not validator.report()['success']:
+                    validator.print_report()
+                    raise ValueError(f"Data validation failed on rows {rows}-{rows + len(chunk)} of '{csv_path}'. Aborting.")
+            append_transactions(chunk, staging_path)
+            rows += len(chunk)
+    print(f"Ingested {rows} transactions.")
+    return rows
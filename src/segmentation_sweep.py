@@ -0,0 +1,109 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+import tempfile
+import time
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.mixture import GaussianMixture
+from sklearn.metrics import silhouette_score, davies_bouldin_score
+from threadpoolctl import threadpool_limits
+from src.utils_io import load_config
+
+CONFIG = load_config()
+
+# ------------------
+# Candidates
+# ------------------
+def sweep_candidates(num_customers):
+    """(model name, k) pairs to compare; KMeans becomes MiniBatchKMeans above `minibatch_above` customers."""
+    params = CONFIG['segmentation_params']
+    models = []
+    for name in params['models']:
+        if name == 'KMeans' and num_customers > params['minibatch_above']:
+            name = 'MiniBatchKMeans'
+        models.append(name)
+    return [(name, k) for k in params['n_clusters_range'] for name in models]
+
+def build_model(name, k, random_state):
+    params = CONFIG['segmentation_params']
+    if name == 'KMeans':
+        return KMeans(n_clusters=k, random_state=random_state, n_init=10)
+    if name == 'MiniBatchKMeans':
+        return MiniBatchKMeans(n_clusters=k, random_state=random_state, n_init=10, batch_size=params['minibatch_batch_size'])
+    if name == 'GMM':
+        return GaussianMixture(n_components=k, random_state=random_state)
+    raise ValueError(f"Unknown segmentation model: {name}")
+
+# ------------------
+# Scoring
+# ------------------
+def stratified_sample(labels, sample_size, seed):
+    """Reproducible row sample with every cluster represented in proportion to its size (at least 2 rows each)."""
+    if len(labels) <= sample_size:
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    clusters, counts = np.unique(labels, return_counts=True)
+    quotas = np.minimum(counts, np.maximum(2, np.round(counts / len(labels) * sample_size).astype(np.int64)))
+    rows = [rng.choice(np.flatnonzero(labels == cluster), quota, replace=False) for cluster, quota in zip(clusters, quotas)]
+    return np.sort(np.concatenate(rows))
+
+def score_clustering(X, labels, sample_size, seed):
+    """Silhouette and Davies-Bouldin on a stratified sample; silhouette is O(n^2) on the full data."""
+    if len(np.unique(labels)) < 2:
+        # Degenerate fit (e.g. a collapsed mixture): never the best candidate
+        return {'silhouette': -1.0, 'davies_bouldin': np.inf, 'score_rows': 0}
+    rows = stratified_sample(labels, sample_size, seed)
+    return {
+        'silhouette': float(silhouette_score(X[rows], labels[rows])),
+        'davies_bouldin': float(davies_bouldin_score(X[rows], labels[rows])),
+        'score_rows': len(rows),
+    }
+
+# ------------------
+# Parallel sweep
+# ------------------
+def _fit_candidate(candidate, matrix_path, threads, sample_size, seed):
+    """Worker: fits one (model, k) candidate on the memory-mapped matrix and scores it."""
+    name, k = candidate
+    X = np.load(matrix_path, mmap_mode='r')
+    # Each worker gets its share of the cores for BLAS/OpenMP instead of all of them
+    with threadpool_limits(limits=threads):
+        start = time.perf_counter()
+        model = build_model(name, k, seed)
+        labels = model.fit_predict(X)
+        fit_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        scores = score_clustering(X, labels, sample_size, seed)
+        score_seconds = time.perf_counter() - start
+    return {'name': name, 'k': k, 'model': model, **scores, 'fit_seconds': fit_seconds, 'score_seconds': score_seconds}
+
+def run_sweep(X_scaled, n_workers=None):
+    """Fits and scores every candidate across processes; returns one result dict per candidate, in candidate order.
+
+    The scaled matrix is handed to the workers as a memory-mapped .npy file, never pickled.
+    """
+    params = CONFIG['segmentation_params']
+    candidates = sweep_candidates(len(X_scaled))
+    n_workers = min(n_workers or params.get('n_workers') or os.cpu_count(), len(candidates))
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+    print(f"Sweeping {len(candidates)} segmentation candidates on {len(X_scaled)} customers "
+          f"({n_workers} workers x {threads} threads)...")
+
+    os.makedirs(CONFIG['parallel']['shard_dir'], exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=CONFIG['parallel']['shard_dir']) as tmp_dir:
+        matrix_path = os.path.join(tmp_dir, "X_scaled.npy")
+        np.save(matrix_path, np.ascontiguousarray(X_scaled, dtype=np.float64))
+        fit = partial(_fit_candidate, matrix_path=matrix_path, threads=threads,
+                      sample_size=params['score_sample_size'], seed=CONFIG['seeds']['model_training_seed'])
+        if n_workers == 1:
+            results = [fit(candidate) for candidate in candidates]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                results = list(pool.map(fit, candidates))
+
+    for result in results:
+        print(f"  {result['name']:>15} k={result['k']}: silhouette {result['silhouette']:.3f}, "
+              f"Davies-Bouldin {result['davies_bouldin']:.3f} ({result['score_rows']} rows), "
+              f"fit {result['fit_seconds']:.2f}s, scoring {result['score_seconds']:.2f}s")
+    return results
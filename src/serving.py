@@ -0,0 +1,130 @@
+import numpy as np
+from concurrent.futures import Future
+import json
+import queue
+import threading
+import time
+from src.utils_io import load_config
+from src.inference import MODELS, SEGMENTATION_FEATURES
+from src.instrumentation import timer, record
+
+CONFIG = load_config()
+
+# ------------------
+# DataFrame-free scoring on feature store rows
+# ------------------
+def _gather(snapshot, rows, columns):
+    """One gather of the requested rows and model columns into a contiguous matrix."""
+    with timer('serving.feature_gather'):
+        return snapshot.matrix[np.ix_(rows, [snapshot.column_index[c] for c in columns])]
+
+def _rows_for(snapshot, customer_ids):
+    with timer('serving.feature_lookup'):
+        return snapshot.rows_for(customer_ids)
+
+def score_clv(snapshot, customer_ids, models=None):
+    """Scores CLV for known customers; returns (values, found) aligned with customer_ids."""
+    models = models or MODELS.models()
+    rows = _rows_for(snapshot, customer_ids)
+    found = rows >= 0
+    values = np.full(len(rows), np.nan)
+    if found.any():
+        values[found] = models.predict_clv_array(_gather(snapshot, rows[found], models.clv_feature_names()))
+    return values, found
+
+def score_segment(snapshot, customer_ids, models=None):
+    """Scores segments for known customers; returns (clusters, found) aligned with customer_ids."""
+    models = models or MODELS.models()
+    rows = _rows_for(snapshot, customer_ids)
+    found = rows >= 0
+    values = np.full(len(rows), -1, dtype=np.int64)
+    if found.any():
+        values[found] = models.predict_segment_array(_gather(snapshot, rows[found], SEGMENTATION_FEATURES))
+    return values, found
+
+# ------------------
+# Micro-batching
+# ------------------
+class MicroBatcher:
+    """Collects concurrent requests into micro-batches scored by one vectorized call.
+
+    A batch closes when it holds `max_batch_size` IDs or `max_wait_ms` has passed
+    since its first request; results are sliced back to each caller's Future.
+    `score_fn` returns (values, found, *context): anything after the arrays (e.g.
+    the models that scored the batch) is passed unsliced to every caller.
+    """
+
+    def __init__(self, score_fn, max_batch_size=None, max_wait_ms=None, name="micro-batcher"):
+        serving_config = CONFIG['serving']
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size or serving_config['max_batch_size']
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else serving_config['max_wait_ms']) / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, customer_ids):
+        """Queues one request; the Future resolves to (values, found, *context) for its IDs."""
+        future = Future()
+        self._queue.put((list(customer_ids), future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            customer_ids = [cid for ids, _, _ in batch for cid in ids]
+            now = time.perf_counter()
+            for _, _, queued_at in batch:
+                record('serving.batch_wait', now - queued_at)
+            try:
+                with timer('serving.batch_score'):
+                    values, found, *context = self.score_fn(customer_ids)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            offset = 0
+            for ids, future, _ in batch:
+                future.set_result((values[offset:offset + len(ids)], found[offset:offset + len(ids)], *context))
+                offset += len(ids)
+
+# ------------------
+# Bulk NDJSON scoring
+# ------------------
+def stream_bulk_predictions(snapshot, customer_ids, chunk_size=None):
+    """Yields one NDJSON line per customer with CLV and segment, scoring chunk by chunk.
+
+    The whole response is scored against one snapshot and one set of models, even if
+    new ones are published meanwhile.
+    """
+    models = MODELS.models()
+    chunk_size = chunk_size or CONFIG['serving']['bulk_chunk_size']
+    for start in range(0, len(customer_ids), chunk_size):
+        chunk = customer_ids[start:start + chunk_size]
+        clv, found = score_clv(snapshot, chunk, models)
+        segments, _ = score_segment(snapshot, chunk, models)
+        labels = models.label_segments(np.maximum(segments, 0))
+        lines = []
+        for customer_id, is_found, clv_value, segment, label in zip(chunk, found.tolist(), clv.tolist(), segments.tolist(), labels.tolist()):
+            if is_found:
+                lines.append(json.dumps({'CustomerID': customer_id, 'clv': clv_value, 'segment': segment, 'segment_label': label}))
+            else:
+                lines.append(json.dumps({'CustomerID': customer_id, 'error': "customer_id not found"}))
+        yield "\n".join(lines) + "\n"
@@ -0,0 +1,230 @@
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import hashlib
+import os
+import resource
+import time
+import lightgbm as lgb
+import mlflow
+from src.utils_io import load_config
+from src import raw_store
+from src.feature_store import FeatureStore
+from src.feature_engineering import FEATURE_SOURCE_COLUMNS, compute_backtest_set
+from src.instrumentation import instrumented
+
+CONFIG = load_config()
+mlflow.set_tracking_uri(CONFIG['mlflow']['tracking_uri'])
+mlflow.set_experiment(CONFIG['mlflow']['experiment_name'])
+
+TARGET = 'CLV_90_days'
+
+def lgb_params(num_threads):
+    """LightGBM training parameters from regression_params."""
+    params = CONFIG['regression_params']
+    return {
+        'objective': params['objective'],
+        'metric': params['metric'],
+        'learning_rate': params['learning_rate'],
+        'num_leaves': params['num_leaves'],
+        'max_depth': params['max_depth'],
+        'feature_fraction': params['colsample_bytree'],
+        'seed': params['random_state'],
+        'num_threads': num_threads,
+        'verbose': -1,
+    }
+
+def _peak_memory_mb(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss / 1024 # ru_maxrss is in KiB on Linux
+
+# ------------------
+# Binary Dataset cache
+# ------------------
+def _dataset_key(X, y, feature_names, reference_key=None):
+    """Content hash of everything the binned Dataset depends on."""
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(X, dtype=np.float64).data)
+    digest.update(np.ascontiguousarray(y, dtype=np.float64).data)
+    digest.update(repr((feature_names, CONFIG['regression_params']['max_bin'], reference_key, lgb.__version__)).encode())
+    return digest.hexdigest()[:16]
+
+def cached_dataset(X, y, feature_names, reference=None):
+    """Returns (path of the binary Dataset, cache key), constructing and saving it only on a cache miss.
+
+    Validation sets are binned with their training set's bin mappers, so the
+    training set's key is part of theirs.
+    """
+    cache_dir = CONFIG['regression_params']['dataset_cache_dir']
+    os.makedirs(cache_dir, exist_ok=True)
+    reference_path, reference_key = reference if reference is not None else (None, None)
+    key = _dataset_key(X, y, feature_names, reference_key)
+    path = os.path.join(cache_dir, f"{key}.bin")
+    if os.path.exists(path):
+        os.utime(path) # Marks it recently used for pruning
+        return path, key
+
+    params = {'max_bin': CONFIG['regression_params']['max_bin'], 'verbose': -1}
+    reference_dataset = lgb.Dataset(reference_path, params=params).construct() if reference_path else None
+    dataset = lgb.Dataset(X, label=y, feature_name=feature_names, reference=reference_dataset, params=params)
+    dataset.construct().save_binary(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return path, key
+
+def prune_dataset_cache(in_use=()):
+    """Deletes all but the dataset_cache_keep most recently used binaries, never one in `in_use`.
+
+    Called once training is done, so no fold's binary can go before its worker loads it.
+    """
+    cache_dir = CONFIG['regression_params']['dataset_cache_dir']
+    in_use = {os.path.abspath(path) for path in in_use}
+    files = sorted((os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith(".bin")),
+                   key=os.path.getmtime, reverse=True)
+    for path in files[CONFIG['regression_params']['dataset_cache_keep']:]:
+        if os.path.abspath(path) not in in_use:
+            os.remove(path)
+
+# ------------------
+# Time-based cross-validation
+# ------------------
+def fold_origins():
+    """Fold origins spaced fold_step_days apart, centred on validation_start_date."""
+    cv_config = CONFIG['regression_params']['cv']
+    validation_start = pd.to_datetime(CONFIG['time_split']['validation_start_date'])
+    n_folds, step = cv_config['n_folds'], cv_config['fold_step_days']
+    return [validation_start + pd.Timedelta(days=(i - n_folds // 2) * step) for i in range(n_folds)]
+
+def training_frame(backtest_set, cutoff, feature_names):
+    """Feature matrix and horizon target of one snapshot of the backtest set (compute_backtest_set)."""
+    target = f"CLV_{CONFIG['regression_params']['cv']['horizon_days']}_days"
+    rows = backtest_set[backtest_set['snapshot_date'] == cutoff]
+    return rows[feature_names].to_numpy(dtype=np.float64), rows[target].to_numpy(dtype=np.float64)
+
+def _train_fold(fold, num_threads):
+    """Worker: trains one fold from its cached binary Datasets with early stopping on the later period."""
+    train_path, valid_path = fold['train_path'], fold['valid_path']
+    params = lgb_params(num_threads)
+    train_set = lgb.Dataset(train_path, params={'verbose': -1})
+    valid_set = lgb.Dataset(valid_path, reference=train_set, params={'verbose': -1})
+    start = time.perf_counter()
+    booster = lgb.train(
+        params, train_set, num_boost_round=CONFIG['regression_params']['n_estimators'], valid_sets=[valid_set],
+        callbacks=[lgb.early_stopping(CONFIG['regression_params']['early_stopping_rounds'], verbose=False)],
+    )
+    seconds = time.perf_counter() - start
+    rows = train_set.num_data()
+    return {
+        'origin': fold['origin'],
+        'best_iteration': booster.best_iteration,
+        'valid_score': booster.best_score['valid_0'][params['metric']],
+        'train_rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows * booster.current_iteration() / seconds,
+        'peak_memory_mb': _peak_memory_mb(),
+    }
+
+@instrumented('training.clv_cv')
+def cross_validate(feature_names):
+    """Rolling-origin CV: for each origin, train on features at origin - horizon and validate on features at origin.
+
+    Folds run in parallel processes; each gets cores // workers LightGBM threads.
+    """
+    cv_config = CONFIG['regression_params']['cv']
+    horizon = pd.Timedelta(days=cv_config['horizon_days'])
+    origins = fold_origins()
+    df = raw_store.read_transactions(
+        end=max(origins) + horizon, columns=FEATURE_SOURCE_COLUMNS, categorical_ids=True
+    )
+    # Every fold's train and validation cutoffs in one pass over the transactions
+    cutoffs = sorted({origin - horizon for origin in origins} | set(origins))
+    backtest_set = compute_backtest_set(df, cutoffs, [cv_config['horizon_days']])
+    del df
+
+    folds = []
+    for origin in origins:
+        X_train, y_train = training_frame(backtest_set, origin - horizon, feature_names)
+        X_valid, y_valid = training_frame(backtest_set, origin, feature_names)
+        train = cached_dataset(X_train, y_train, feature_names)
+        valid_path, _ = cached_dataset(X_valid, y_valid, feature_names, reference=train)
+        folds.append({'origin': origin.date().isoformat(), 'train_path': train[0], 'valid_path': valid_path})
+    del backtest_set
+
+    cores = os.cpu_count() or 1
+    n_workers = min(cv_config.get('n_workers') or cores, len(folds))
+    num_threads = max(1, cores // n_workers)
+    print(f"Cross-validating on {len(folds)} time-based folds ({n_workers} workers x {num_threads} threads)...")
+    if n_workers == 1:
+        results = [_train_fold(fold, num_threads) for fold in folds]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(partial(_train_fold, num_threads=num_threads), folds))
+    for fold, result in zip(folds, results):
+        result.update(train_path=fold['train_path'], valid_path=fold['valid_path'])
+        print(f"  origin {result['origin']}: {CONFIG['regression_params']['metric']} {result['valid_score']:.2f} "
+              f"at iteration {result['best_iteration']}, {result['rows_per_second']:.0f} rows/s")
+    return results
+
+# ------------------
+# Training
+# ------------------
+@instrumented('training.clv')
+def train_clv_model():
+    """Cross-validates, trains the LightGBM CLV model on the current feature snapshot and registers it."""
+    print("Training CLV model...")
+    total_start = time.perf_counter()
+    snapshot = FeatureStore(required_columns=[TARGET]).snapshot()
+    feature_names = [c for c in snapshot.columns if c != TARGET]
+    X = snapshot.matrix[:, [snapshot.column_index[c] for c in feature_names]]
+    y = snapshot.matrix[:, snapshot.column_index[TARGET]]
+
+    with mlflow.start_run(run_name="CLV_Training", nested=True) as run:
+        mlflow.log_params({**CONFIG['regression_params'], 'snapshot_version': snapshot.version, 'num_features': len(feature_names)})
+
+        cv_results = cross_validate(feature_names)
+        for i, result in enumerate(cv_results):
+            mlflow.log_metrics({
+                f"fold_{i}_{CONFIG['regression_params']['metric']}": result['valid_score'],
+                f"fold_{i}_best_iteration": result['best_iteration'],
+                f"fold_{i}_rows_per_second": result['rows_per_second'],
+                f"fold_{i}_peak_memory_mb": result['peak_memory_mb'],
+            })
+        num_boost_round = max(1, int(np.mean([r['best_iteration'] for r in cv_results])))
+        mlflow.log_metrics({
+            f"cv_{CONFIG['regression_params']['metric']}": float(np.mean([r['valid_score'] for r in cv_results])),
+            'num_boost_round': num_boost_round,
+        })
+
+        # The final model sees every customer of the snapshot, for the CV-chosen number of rounds
+        dataset_start = time.perf_counter()
+        train_path, key = cached_dataset(X, y, feature_names)
+        dataset_seconds = time.perf_counter() - dataset_start
+        train_set = lgb.Dataset(train_path, params={'verbose': -1})
+        n_jobs = CONFIG['regression_params']['n_jobs']
+        start = time.perf_counter()
+        booster = lgb.train(lgb_params(os.cpu_count() if n_jobs == -1 else n_jobs), train_set, num_boost_round=num_boost_round)
+        train_seconds = time.perf_counter() - start
+
+        rows_per_second = len(y) * num_boost_round / train_seconds
+        mlflow.log_params({'dataset_key': key})
+        mlflow.log_metrics({
+            'dataset_seconds': dataset_seconds,
+            'train_seconds': train_seconds,
+            'rows_per_second': rows_per_second,
+            'peak_memory_mb': _peak_memory_mb(),
+            'peak_memory_children_mb': _peak_memory_mb(resource.RUSAGE_CHILDREN),
+            'total_seconds': time.perf_counter() - total_start,
+        })
+        print(f"Trained {num_boost_round} rounds on {len(y)} customers in {train_seconds:.2f}s "
+              f"({rows_per_second:.0f} rows/s, Dataset {dataset_seconds:.2f}s, peak memory {_peak_memory_mb():.0f} MB)")
+
+        mlflow.lightgbm.log_model(booster, "clv_model")
+        model_uri = f"runs:/{run.info.run_id}/clv_model"
+        mlflow.register_model(model_uri, CONFIG['models']['clv_model_name'])
+        print(f"CLV model registered as '{CONFIG['models']['clv_model_name']}'")
+
+    prune_dataset_cache(in_use=[train_path] + [r[k] for r in cv_results for k in ('train_path', 'valid_path')])
+    return booster
+
+if __name__ == "__main__":
+    with mlflow.start_run(run_name="Main_Training_Pipeline") as parent_run:
+        train_clv_model()
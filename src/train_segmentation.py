@@ -1,16 +1,17 @@
 import pandas as pd
-from sklearn.cluster import KMeans, GaussianMixture
 from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import silhouette_score, davies_bouldin_score
 import mlflow
 import joblib
 from src.utils_io import load_config
-from src.labeler import assign_segment_labels
+from src.labeler import segment_label_map, num_segments, SEGMENT_LABELS_ARTIFACT
+from src.segmentation_sweep import run_sweep
+from src.instrumentation import instrumented
 
 CONFIG = load_config()
 mlflow.set_tracking_uri(CONFIG['mlflow']['tracking_uri'])
 mlflow.set_experiment(CONFIG['mlflow']['experiment_name'])
 
+@instrumented('training.segmentation')
 def train_segmentation_models():
     """Trains, compares, and registers the best segmentation model."""
     print("Training and comparing segmentation models...")
@@ -29,26 +30,20 @@ def train_segmentation_models():
         joblib.dump(scaler, "segmentation_scaler.pkl")
         mlflow.log_artifact("segmentation_scaler.pkl")
 
-        for k in CONFIG['segmentation_params']['n_clusters_range']:
-            # K-Means
-            with mlflow.start_run(run_name=f"KMeans_k={k}", nested=True) as run:
-                kmeans = KMeans(n_clusters=k, random_state=CONFIG['seeds']['model_training_seed'], n_init=10)
-                clusters = kmeans.fit_predict(X_scaled)
-                score = silhouette_score(X_scaled, clusters)
-                mlflow.log_params({"model": "KMeans", "k": k})
-                mlflow.log_metric("silhouette", score)
-                if score > best_model_info['score']:
-                    best_model_info.update({'name': 'KMeans', 'score': score, 'run_id': run.info.run_id, 'model': kmeans, 'k': k})
-            
-            # Gaussian Mixture Model
-            with mlflow.start_run(run_name=f"GMM_k={k}", nested=True) as run:
-                gmm = GaussianMixture(n_components=k, random_state=CONFIG['seeds']['model_training_seed'])
-                clusters = gmm.fit_predict(X_scaled)
-                score = silhouette_score(X_scaled, clusters)
-                mlflow.log_params({"model": "GMM", "k": k})
-                mlflow.log_metric("silhouette", score)
-                if score > best_model_info['score']:
-                    best_model_info.update({'name': 'GMM', 'score': score, 'run_id': run.info.run_id, 'model': gmm, 'k': k})
+        # Candidates are fitted in worker processes; runs are logged here, in the parent
+        results = run_sweep(X_scaled)
+        for result in results:
+            with mlflow.start_run(run_name=f"{result['name']}_k={result['k']}", nested=True) as run:
+                mlflow.log_params({"model": result['name'], "k": result['k'], "score_rows": result['score_rows']})
+                mlflow.log_metrics({
+                    "silhouette": result['silhouette'],
+                    "davies_bouldin": result['davies_bouldin'],
+                    "fit_seconds": result['fit_seconds'],
+                    "score_seconds": result['score_seconds'],
+                })
+                if result['silhouette'] > best_model_info['score']:
+                    best_model_info.update({'name': result['name'], 'score': result['silhouette'], 'run_id': run.info.run_id,
+                                            'model': result['model'], 'k': result['k']})
     
     print(f"Best model is {best_model_info['name']} with k={best_model_info['k']} (Silhouette: {best_model_info['score']:.3f})")
 
@@ -56,8 +51,13 @@ def train_segmentation_models():
     best_run_id = best_model_info['run_id']
     best_model = best_model_info['model']
     
-    with mlflow.start_run(run_id=best_run_id):
+    # Labels are derived once from the full population and stored with the model
+    label_map = segment_label_map(df.assign(segment=best_model.predict(X_scaled)), num_clusters=num_segments(best_model))
+    print(f"Segment labels: {label_map}")
+
+    with mlflow.start_run(run_id=best_run_id, nested=True):
         mlflow.sklearn.log_model(best_model, "segmentation_model")
+        mlflow.log_dict({str(cluster): label for cluster, label in label_map.items()}, SEGMENT_LABELS_ARTIFACT)
         model_uri = f"runs:/{best_run_id}/segmentation_model"
         mlflow.register_model(model_uri, CONFIG['models']['segmentation_model_name'])
         print(f"Best model registered as '{CONFIG['models']['segmentation_model_name']}'")
@@ -0,0 +1,264 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import mlflow
+from src.utils_io import load_config
+from src.instrumentation import instrumented
+
+CONFIG = load_config()
+
+# LightGBM missing-value handling per split, as stored in dump_model()
+MISSING_NONE, MISSING_ZERO, MISSING_NAN = 0, 1, 2
+MISSING_TYPES = {'None': MISSING_NONE, 'Zero': MISSING_ZERO, 'NaN': MISSING_NAN}
+ZERO_THRESHOLD = 1e-35 # LightGBM's kZeroThreshold
+
+# Output transforms of the supported objectives (applied to the summed raw score)
+OBJECTIVE_TRANSFORMS = {
+    'regression': 'identity', 'regression_l1': 'identity', 'huber': 'identity', 'fair': 'identity',
+    'quantile': 'identity', 'mape': 'identity',
+    'poisson': 'exp', 'gamma': 'exp', 'tweedie': 'exp',
+}
+
+# ------------------
+# Export
+# ------------------
+def _flatten_tree(tree_structure, nodes):
+    """Appends one tree's nodes to the flat arrays in pre-order (left subtree first); returns the root index.
+
+    In this order each subtree occupies a contiguous block of node indices and
+    its leaves a contiguous run of leaf numbers, left to right.
+    """
+    root = len(nodes['feature'])
+    stack = [(tree_structure, None, None)]
+    while stack:
+        node, parent, side = stack.pop()
+        index = len(nodes['feature'])
+        if parent is not None:
+            nodes[side][parent] = index
+        is_leaf = 'leaf_value' in node
+        if not is_leaf and node['decision_type'] != '<=':
+            raise ValueError("Categorical splits are not supported by the flat evaluator")
+        nodes['feature'].append(-1 if is_leaf else node['split_feature'])
+        nodes['threshold'].append(0.0 if is_leaf else node['threshold'])
+        nodes['left'].append(-1)
+        nodes['right'].append(-1)
+        nodes['default_left'].append(False if is_leaf else node['default_left'])
+        nodes['missing_type'].append(MISSING_NONE if is_leaf else MISSING_TYPES[node['missing_type']])
+        nodes['value'].append(node['leaf_value'] if is_leaf else 0.0)
+        if not is_leaf:
+            stack.append((node['right_child'], index, 'right'))
+            stack.append((node['left_child'], index, 'left'))
+    return root
+
+def flatten_booster(booster):
+    """Converts a LightGBM Booster (or LGBMRegressor) into the arrays of a FlatTreeEnsemble."""
+    booster = getattr(booster, 'booster_', booster)
+    model = booster.dump_model()
+    if model['num_tree_per_iteration'] != 1:
+        raise ValueError("Only single-output models can be flattened")
+    objective = model['objective'].split()[0]
+    if objective not in OBJECTIVE_TRANSFORMS:
+        raise ValueError(f"Objective '{objective}' is not supported by the flat evaluator")
+
+    nodes = {key: [] for key in ('feature', 'threshold', 'left', 'right', 'default_left', 'missing_type', 'value')}
+    roots = []
+    for tree in model['tree_info']:
+        if tree.get('is_linear'):
+            raise ValueError("Linear trees are not supported by the flat evaluator")
+        roots.append(_flatten_tree(tree['tree_structure'], nodes))
+
+    return {
+        'feature': np.asarray(nodes['feature'], dtype=np.int32),
+        'threshold': np.asarray(nodes['threshold'], dtype=np.float64),
+        'left': np.asarray(nodes['left'], dtype=np.int32),
+        'right': np.asarray(nodes['right'], dtype=np.int32),
+        'default_left': np.asarray(nodes['default_left'], dtype=bool),
+        'missing_type': np.asarray(nodes['missing_type'], dtype=np.int8),
+        'value': np.asarray(nodes['value'], dtype=np.float64),
+        'roots': np.asarray(roots, dtype=np.int32),
+        'meta': {
+            'feature_names': model['feature_names'],
+            'transform': OBJECTIVE_TRANSFORMS[objective],
+            'average_output': bool(model.get('average_output', False)),
+        },
+    }
+
+def save_flat_model(arrays, path, model_version=None):
+    """Writes the flattened ensemble to a single .npz file."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    meta = dict(arrays['meta'], model_version=model_version)
+    np.savez(path, meta=np.array(json.dumps(meta)), **{k: v for k, v in arrays.items() if k != 'meta'})
+
+def load_flat_model(path):
+    """Loads a FlatTreeEnsemble saved by save_flat_model (no LightGBM import needed)."""
+    with np.load(path) as data:
+        arrays = {key: data[key] for key in data.files if key != 'meta'}
+        arrays['meta'] = json.loads(str(data['meta']))
+    return FlatTreeEnsemble(arrays)
+
+# ------------------
+# Evaluator
+# ------------------
+# Lowest-set-bit position of a 64-bit word via a de Bruijn multiply
+DE_BRUIJN_64 = np.uint64(0x03F79D71B4CB0A89)
+DE_BRUIJN_POSITIONS = np.zeros(64, dtype=np.int64)
+DE_BRUIJN_POSITIONS[((np.uint64(1) << np.arange(64, dtype=np.uint64)) * DE_BRUIJN_64) >> np.uint64(58)] = np.arange(64)
+MAX_LEAVES = 64
+CHUNK_ROWS = 1024 # Rows scored together; bounds the (rows, features, trees) mask gather
+
+class FlatTreeEnsemble:
+    """Batch evaluator over the flattened trees; matches Booster.predict for numerical splits.
+
+    Uses bitvector scoring (QuickScorer) instead of walking nodes: each tree's
+    leaves are bits of one word, and every split a row fails (goes right at)
+    clears the leaves of its left subtree. The exit leaf is the lowest bit
+    left. Splits are grouped per feature and sorted by threshold, so the
+    failed splits of a feature are a prefix found by one searchsorted, and the
+    AND of their masks is precomputed for every prefix length. Scoring is then
+    one table row AND per used feature and a leaf value gather.
+    """
+
+    def __init__(self, arrays):
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.left = arrays['left']
+        self.right = arrays['right']
+        self.default_left = arrays['default_left']
+        self.missing_type = arrays['missing_type']
+        self.value = arrays['value']
+        self.roots = arrays['roots']
+        self.meta = arrays['meta']
+        self.model_version = self.meta.get('model_version')
+        self._build_tables()
+
+    def _build_tables(self):
+        num_trees = len(self.roots)
+        num_nodes = len(self.feature)
+        is_leaf = self.feature < 0
+        tree_of_node = np.repeat(np.arange(num_trees), np.diff(np.r_[self.roots, num_nodes]))
+        # Leaf number within its tree, left to right (pre-order keeps leaves in that order)
+        leaves_before = np.r_[0, np.cumsum(is_leaf)]
+        tree_leaf_base = leaves_before[self.roots]
+        leaf_number = leaves_before[:-1] - tree_leaf_base[tree_of_node]
+        leaves_per_tree = np.bincount(tree_of_node, weights=is_leaf, minlength=num_trees).astype(np.int64)
+        if leaves_per_tree.max(initial=1) > MAX_LEAVES:
+            raise ValueError(f"The flat evaluator supports at most {MAX_LEAVES} leaves per tree")
+
+        self.leaf_values = np.zeros((num_trees, leaves_per_tree.max(initial=1)))
+        self.leaf_values[tree_of_node[is_leaf], leaf_number[is_leaf]] = self.value[is_leaf]
+
+        # Mask of each split: all leaves except those of its left subtree [left child, right child)
+        split = np.flatnonzero(~is_leaf)
+        split_tree = tree_of_node[split]
+        first_leaf = leaves_before[self.left[split]] - tree_leaf_base[split_tree]
+        last_leaf = leaves_before[self.right[split]] - tree_leaf_base[split_tree]
+        ones = np.uint64(0xFFFFFFFFFFFFFFFF)
+        left_leaves = (ones >> (np.uint64(64) - (last_leaf - first_leaf).astype(np.uint64))) << first_leaf.astype(np.uint64)
+        split_mask = ~left_leaves
+
+        # A NaN goes to the default side if the split tracks missing values, else it is scored as 0.0
+        missing = self.missing_type[split]
+        threshold = self.threshold[split]
+        nan_left = np.where(missing != MISSING_NONE, self.default_left[split], 0.0 <= threshold)
+        zero_left = np.where(missing == MISSING_ZERO, self.default_left[split], 0.0 <= threshold)
+
+        self.used_features = np.unique(self.feature[split])
+        # One searchsorted over every threshold, then per-feature counts of thresholds below each grid position
+        self.threshold_grid = np.unique(threshold)
+        self.prefix_counts = np.zeros((len(self.used_features), len(self.threshold_grid) + 1), dtype=np.int64)
+        self.nan_rows = np.zeros(len(self.used_features), dtype=np.int64)
+        self.zero_rows = np.full(len(self.used_features), -1, dtype=np.int64)
+        tables, offset = [], 0
+        for i, feature in enumerate(self.used_features):
+            nodes = np.flatnonzero(self.feature[split] == feature)
+            nodes = nodes[np.argsort(threshold[nodes], kind='stable')]
+            # Rows 0..n: AND over the n lowest-threshold splits; then the NaN row and the zero row
+            table = np.full((len(nodes) + 3, num_trees), ones, dtype=np.uint64)
+            table[1 + np.arange(len(nodes)), split_tree[nodes]] = split_mask[nodes]
+            table[:len(nodes) + 1] = np.bitwise_and.accumulate(table[:len(nodes) + 1], axis=0)
+            for row, goes_left in ((len(nodes) + 1, nan_left), (len(nodes) + 2, zero_left)):
+                failed = nodes[~goes_left[nodes]]
+                np.bitwise_and.at(table[row], split_tree[failed], split_mask[failed])
+            tables.append(table)
+            self.prefix_counts[i, 1:] = np.searchsorted(threshold[nodes], self.threshold_grid, side='right')
+            self.prefix_counts[i] += offset
+            self.nan_rows[i] = offset + len(nodes) + 1
+            if (missing[nodes] == MISSING_ZERO).any():
+                self.zero_rows[i] = offset + len(nodes) + 2
+            offset += len(table)
+        self.table = np.concatenate(tables) if tables else np.full((1, num_trees), ones, dtype=np.uint64)
+        self._tree_offsets = np.arange(num_trees) * self.leaf_values.shape[1]
+        self._feature_index = np.arange(len(self.used_features))
+
+    def feature_name(self):
+        """Feature names in training order (same call as on a Booster)."""
+        return list(self.meta['feature_names'])
+
+    def num_trees(self):
+        return len(self.roots)
+
+    def predict_raw(self, X):
+        """Summed leaf values per row, before the objective's output transform."""
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[None, :]
+        chunks = [self._predict_chunk(X[start:start + CHUNK_ROWS]) for start in range(0, len(X), CHUNK_ROWS)]
+        return np.concatenate(chunks) if chunks else np.zeros(0)
+
+    def _predict_chunk(self, X):
+        values = X[:, self.used_features]
+        # Splits with threshold < x send x right (LightGBM goes left when x <= threshold)
+        rows = self.prefix_counts[self._feature_index, np.searchsorted(self.threshold_grid, values, side='left')]
+        is_nan = np.isnan(values)
+        if is_nan.any():
+            rows = np.where(is_nan, self.nan_rows, rows)
+        if (self.zero_rows >= 0).any():
+            rows = np.where((self.zero_rows >= 0) & (np.abs(values) <= ZERO_THRESHOLD), self.zero_rows, rows)
+        masks = np.bitwise_and.reduce(self.table[rows], axis=1)
+        lowest_bit = masks & (~masks + np.uint64(1))
+        leaves = DE_BRUIJN_POSITIONS[(lowest_bit * DE_BRUIJN_64) >> np.uint64(58)]
+        raw = self.leaf_values.ravel()[leaves + self._tree_offsets].sum(axis=1)
+        if self.meta['average_output']:
+            raw /= len(self.roots)
+        return raw
+
+    def predict(self, X):
+        """Predictions on the scale of Booster.predict."""
+        raw = self.predict_raw(X)
+        return np.exp(raw) if self.meta['transform'] == 'exp' else raw
+
+# ------------------
+# Export step (runs after train_clv_model)
+# ------------------
+def check_flat_model(booster, flat_model, X, rtol=1e-9, atol=1e-9):
+    """Asserts the flat evaluator reproduces booster.predict on X."""
+    booster = getattr(booster, 'booster_', booster)
+    np.testing.assert_allclose(flat_model.predict(X), booster.predict(X), rtol=rtol, atol=atol)
+
+@instrumented('training.clv_export')
+def export_clv_model(booster=None, model_version=None):
+    """Flattens a registered CLV model (default: the newest version), checks it against LightGBM and saves/logs the arrays.
+
+    Serving only uses the arrays once their version is the one in Production.
+    """
+    model_name = CONFIG['models']['clv_model_name']
+    if booster is None:
+        if model_version is None:
+            versions = mlflow.tracking.MlflowClient().search_model_versions(f"name='{model_name}'")
+            model_version = max(int(v.version) for v in versions)
+        booster = mlflow.lightgbm.load_model(f"models:/{model_name}/{model_version}")
+    print(f"Exporting CLV model '{model_name}' (version {model_version}) to flat arrays...")
+
+    arrays = flatten_booster(booster)
+    flat_model = FlatTreeEnsemble(arrays)
+    features = pd.read_csv(CONFIG['data']['processed_path'])
+    check_flat_model(booster, flat_model, features[flat_model.feature_name()].to_numpy(dtype=np.float64))
+
+    path = CONFIG['models']['clv_flat_model_path']
+    save_flat_model(arrays, path, model_version=model_version)
+    with mlflow.start_run(run_name="CLV_Tree_Export", nested=True):
+        mlflow.log_params({'model_version': model_version, 'num_trees': flat_model.num_trees()})
+        mlflow.log_artifact(path)
+    print(f"Flat CLV model ({flat_model.num_trees()} trees, {len(arrays['feature'])} nodes) saved to '{path}'")
+    return path
@@ -0,0 +1,165 @@
+import pandas as pd
+import numpy as np
+import json
+import time
+from src.utils_io import load_config
+from src.instrumentation import instrumented
+
+CONFIG = load_config()
+
+# ------------------
+# Expectation checks: each returns a boolean mask of failing rows
+# ------------------
+def _bound(values, bound):
+    """Parses a suite bound in the column's type (date strings for datetime columns)."""
+    if bound is None:
+        return None
+    if np.issubdtype(values.dtype, np.datetime64):
+        return np.datetime64(pd.Timestamp(bound).to_datetime64(), 'ns')
+    return bound
+
+def _null_mask(values):
+    if np.issubdtype(values.dtype, np.datetime64):
+        return np.isnat(values)
+    if values.dtype.kind == 'f':
+        return np.isnan(values)
+    if values.dtype == object:
+        return pd.isna(values)
+    return np.zeros(len(values), dtype=bool)
+
+def _not_null(values, kwargs):
+    return _null_mask(values)
+
+def _greater_than(values, kwargs):
+    # Like Great Expectations, nulls are left to the not-null expectations
+    min_value = _bound(values, kwargs['min_value'])
+    return ~_null_mask(values) & ~(values > min_value)
+
+def _between(values, kwargs):
+    min_value, max_value = _bound(values, kwargs.get('min_value')), _bound(values, kwargs.get('max_value'))
+    inside = ~_null_mask(values)
+    if min_value is not None:
+        inside &= values > min_value if kwargs.get('strict_min') else values >= min_value
+    if max_value is not None:
+        inside &= values < max_value if kwargs.get('strict_max') else values <= max_value
+    return ~inside & ~_null_mask(values)
+
+CHECKS = {
+    'expect_column_values_to_not_be_null': _not_null,
+    'expect_column_values_to_be_greater_than': _greater_than,
+    'expect_column_values_to_be_between': _between,
+}
+
+def load_suite(suite_path=None):
+    with open(suite_path or CONFIG['data']['great_expectations_suite'], 'r') as f:
+        return json.load(f)
+
+def compile_suite(suite):
+    """Turns the suite's expectations into (name, column, check, kwargs) tuples of NumPy mask checks."""
+    compiled = []
+    for expectation in suite['expectations']:
+        expectation_type, kwargs = expectation['expectation_type'], expectation['kwargs']
+        if expectation_type not in CHECKS:
+            raise ValueError(
+                f"Expectation '{expectation_type}' is not supported by the NumPy validator; "
+                f"set validation.engine to 'great_expectations' to run this suite."
+            )
+        name = f"{expectation_type}({kwargs['column']})"
+        compiled.append((name, kwargs['column'], CHECKS[expectation_type], kwargs))
+    return compiled
+
+# ------------------
+# Streaming validator
+# ------------------
+class TransactionValidator:
+    """Validates transactions chunk by chunk against the compiled suite, accumulating per-expectation results."""
+
+    def __init__(self, suite_path=None, sample_failures=None):
+        self.expectations = compile_suite(load_suite(suite_path))
+        self.sample_failures = sample_failures if sample_failures is not None else CONFIG['validation']['sample_failures']
+        self.rows = 0
+        self.results = {
+            name: {'column': column, 'unexpected_count': 0, 'null_count': 0, 'seconds': 0.0, 'samples': [],
+                   'mostly': kwargs.get('mostly'), 'checks_nulls': check is _not_null}
+            for name, column, check, kwargs in self.expectations
+        }
+
+    def validate_chunk(self, df):
+        for name, column, check, kwargs in self.expectations:
+            result = self.results[name]
+            start = time.perf_counter()
+            if column not in df.columns:
+                raise KeyError(f"Column '{column}' required by {name} is missing from the data")
+            values = df[column].to_numpy()
+            failing = check(values, kwargs)
+            result['null_count'] += int(_null_mask(values).sum())
+            result['seconds'] += time.perf_counter() - start
+            failures = int(failing.sum())
+            if failures:
+                result['unexpected_count'] += failures
+                missing = self.sample_failures - len(result['samples'])
+                if missing > 0:
+                    rows = df.iloc[np.flatnonzero(failing)[:missing]]
+                    result['samples'].extend(rows.astype(str).to_dict(orient='records'))
+        self.rows += len(df)
+
+    def report(self):
+        """Per-expectation failure counts, sample failing rows and time, plus overall success."""
+        expectations = {}
+        for name, result in self.results.items():
+            # As in Great Expectations, `mostly` is the share of non-null values that must pass
+            checked = self.rows - (0 if result['checks_nulls'] else result['null_count'])
+            failed_share = result['unexpected_count'] / checked if checked else 0.0
+            mostly = result['mostly'] if result['mostly'] is not None else 1.0
+            expectations[name] = {
+                'success': failed_share <= 1.0 - mostly,
+                'unexpected_count': result['unexpected_count'],
+                'unexpected_percent': 100 * failed_share,
+                'samples': result['samples'],
+                'seconds': result['seconds'],
+            }
+        return {
+            'success': all(e['success'] for e in expectations.values()),
+            'rows': self.rows,
+            'expectations': expectations,
+        }
+
+    def print_report(self):
+        report = self.report()
+        for name, result in report['expectations'].items():
+            status = "ok" if result['success'] else "FAILED"
+            print(f"  {status:>6} {name}: {result['unexpected_count']} unexpected "
+                  f"({result['unexpected_percent']:.4g}%) in {result['seconds'] * 1e3:.1f}ms")
+            for sample in result['samples']:
+                print(f"           e.g. {sample}")
+        return report
+
+@instrumented('validation.numpy')
+def validate_frame(df, chunk_size=None, suite_path=None):
+    """Validates an in-memory DataFrame chunk by chunk with the NumPy validator; returns the report."""
+    chunk_size = chunk_size or CONFIG['validation']['chunk_size']
+    validator = TransactionValidator(suite_path)
+    for start in range(0, len(df), chunk_size):
+        validator.validate_chunk(df.iloc[start:start + chunk_size])
+    return validator.print_report()
+
+# ------------------
+# Optional full mode
+# ------------------
+@instrumented('validation.great_expectations')
+def validate_with_great_expectations(df, suite_path=None):
+    """Runs the full suite with Great Expectations (whole batch in memory); returns the report."""
+    import great_expectations as gx # Heavy import, only paid in this mode
+    validation_result = gx.from_pandas(df).validate(expectation_suite=suite_path or CONFIG['data']['great_expectations_suite'])
+    expectations = {}
+    for result in validation_result["results"]:
+        config = result["expectation_config"]
+        name = f"{config['expectation_type']}({config['kwargs'].get('column')})"
+        expectations[name] = {
+            'success': result["success"],
+            'unexpected_count': result["result"].get("unexpected_count", 0),
+            'samples': result["result"].get("partial_unexpected_list", []),
+        }
+        if not result["success"]:
+            print(f"  FAILED {name}: {config['kwargs']}")
+    return {'success': validation_result["success"], 'rows': len(df), 'expectations': expectations}
@@ -0,0 +1,59 @@
+"""Checks the single-pass feature kernel against calculate_rfm + add_behavioral_features,
+and the multi-snapshot kernel against one compute_customer_features call per cutoff.
+
+Usage: python -m pytest -q tests
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.bench_feature_kernel import reference_features, check_equivalence
+from benchmarks import bench_backtest
+from src.feature_kernel import compute_customer_features, compute_snapshot_features
+
+def _transactions(num_customers, num_rows, num_timestamps, seed=0):
+    """Every customer buys at least once; timestamps are drawn from `num_timestamps` distinct seconds."""
+    rng = np.random.default_rng(seed)
+    customers = np.r_[np.arange(num_customers), rng.integers(0, num_customers, num_rows - num_customers)]
+    seconds = rng.permutation(num_timestamps)[rng.integers(0, num_timestamps, num_rows)]
+    return pd.DataFrame({
+        'CustomerID': pd.Categorical([f"C{i:06d}" for i in customers]),
+        'TransactionDate': pd.Timestamp("2023-01-01") + pd.to_timedelta(seconds, unit='s'),
+        'UnitPrice': np.round(rng.uniform(1, 20, num_rows), 2),
+        'Amount': np.round(rng.uniform(1, 500, num_rows), 2),
+    })
+
+def _check(df):
+    snapshot_date = df['TransactionDate'].max()
+    kernel = compute_customer_features(df, snapshot_date)
+    check_equivalence(reference_features(df.astype({'CustomerID': str}), snapshot_date), kernel)
+
+def test_kernel_matches_reference():
+    _check(_transactions(num_customers=500, num_rows=5_000, num_timestamps=2_000))
+
+def test_sort_key_beyond_int32():
+    # The (customer, date rank) sort key must not wrap around in int32
+    df = _transactions(num_customers=45_000, num_rows=55_000, num_timestamps=1_000_000)
+    assert 45_000 * df['TransactionDate'].nunique() > 2**31
+    _check(df)
+
+def test_snapshot_kernel_matches_per_cutoff():
+    df = _transactions(num_customers=300, num_rows=3_000, num_timestamps=200 * 86_400)
+    windows_days = [30, 90]
+    # One cutoff equals a transaction timestamp; the earliest falls before most customers' first purchase
+    first_purchase = df.groupby('CustomerID', observed=True)['TransactionDate'].min()
+    snapshot_dates = [first_purchase.sort_values().iloc[5], df['TransactionDate'].iloc[0], pd.Timestamp("2023-04-01")]
+    assert (first_purchase > snapshot_dates[0]).any()
+    kernel = compute_snapshot_features(df, snapshot_dates, windows_days)
+    reference = bench_backtest.per_cutoff_features(df, sorted(snapshot_dates), windows_days)
+    bench_backtest.check_equivalence(reference, kernel, windows_days)
+
+def test_snapshot_kernel_rejects_no_snapshots():
+    with pytest.raises(ValueError):
+        compute_snapshot_features(_transactions(10, 20, 100), [], [30])
+
+if __name__ == "__main__":
+    test_kernel_matches_reference()
+    test_sort_key_beyond_int32()
+    test_snapshot_kernel_matches_per_cutoff()
+    test_snapshot_kernel_rejects_no_snapshots()
+    print("Feature kernel matches the reference")